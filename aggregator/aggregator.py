@@ -2,15 +2,21 @@
 
 
 import sys
+import asyncio
 
 import aiohttp_cors
 
 from aiohttp import web
 
 from .endpoints.info import get_info
-from .endpoints.query import send_beacon_query, send_beacon_query_websocket
+from .endpoints.query import send_beacon_query, send_beacon_query_websocket, send_beacon_query_sse
 from .endpoints.cache import invalidate_cache
-from .utils.utils import application_security
+from .endpoints.filtering_terms import send_filtering_terms, send_filtering_terms_autocomplete
+from .utils.utils import application_security, json_response, warm_start_services, cache_generation, warm_cache_periodically
+from .utils.change_feed import follow_registries
+from .utils.result_cache import RESULT_CACHE
+from .utils.metrics import METRICS, get_metrics, monitor_event_loop
+from .utils.tracing import tracing, export_spans, export_spans_periodically
 from .utils.validate import api_key
 from .utils.logging import LOG
 from .config import CONFIG
@@ -50,13 +56,47 @@ async def query(request):
         websocket = await send_beacon_query_websocket(request)
         # Return websocket connection
         return websocket
+    elif "text/event-stream" in request.headers.get("Accept", ""):
+        # Use asynchronous Server-Sent Events over plain HTTP, for clients that can't use websockets
+        return await send_beacon_query_sse(request)
     else:
         # Use standard synchronous http
         # Send request for processing
         response = await send_beacon_query(request)
 
-        # Return results
-        return web.json_response(response)
+        # Return results, compressed if the client accepts it
+        return await json_response(request, response)
+
+
+@routes.get("/filtering_terms")
+async def filtering_terms(request):
+    """Return filtering terms of Beacons."""
+    LOG.debug("GET /filtering_terms received.")
+
+    # Filtering terms are harvested from Beacons when the catalogue is refreshed
+    response = await send_filtering_terms(request)
+
+    # Return results
+    return web.json_response(response)
+
+
+@routes.get("/filtering_terms/autocomplete")
+async def filtering_terms_autocomplete(request):
+    """Return filtering terms of Beacons matching a prefix."""
+    LOG.debug("GET /filtering_terms/autocomplete received.")
+
+    # Send request for processing
+    response = await send_filtering_terms_autocomplete(request)
+
+    # Return results
+    return web.json_response(response)
+
+
+@routes.get("/metrics")
+async def metrics(request):
+    """Return metrics of all workers in the Prometheus text format."""
+    LOG.debug("GET /metrics received.")
+    return web.Response(text=await get_metrics(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
 
 
 @routes.delete("/cache")
@@ -65,7 +105,7 @@ async def cache(request):
     LOG.debug("DELETE /beacons received.")
 
     # Send request for processing
-    await invalidate_cache()
+    await invalidate_cache(request.host)
 
     # Return confirmation
     return web.Response(text="Cache has been deleted.")
@@ -90,6 +130,61 @@ def set_cors(app):
         cors.add(route)
 
 
+async def load_catalogue(app):
+    """Load catalogue snapshot from a previous run."""
+    LOG.info("Loading catalogue snapshot.")
+    await warm_start_services()
+
+
+async def start_following(app):
+    """Start following change feeds of registries."""
+    app["following"] = follow_registries()
+
+
+async def stop_following(app):
+    """Stop following change feeds."""
+    for task in app["following"]:
+        task.cancel()
+
+
+async def start_cache_warming(app):
+    """Start warming cached results of popular queries."""
+    if RESULT_CACHE.enabled and CONFIG.warm_queries:
+        LOG.info("Starting cache warming.")
+        app["cache_warming"] = asyncio.ensure_future(warm_cache_periodically())
+
+
+async def stop_cache_warming(app):
+    """Stop warming cached results."""
+    if "cache_warming" in app:
+        app["cache_warming"].cancel()
+
+
+async def start_monitoring(app):
+    """Start measuring event loop lag and writing metrics."""
+    app["monitoring"] = asyncio.ensure_future(monitor_event_loop())
+
+
+async def stop_monitoring(app):
+    """Stop monitoring, and write final metrics of this worker."""
+    app["monitoring"].cancel()
+    METRICS.write()
+
+
+async def start_tracing(app):
+    """Start exporting tracing spans."""
+    if CONFIG.tracing:
+        LOG.info("Exporting tracing spans to %s.", CONFIG.tracing)
+        app["tracing"] = asyncio.ensure_future(export_spans_periodically())
+
+
+async def stop_tracing(app):
+    """Stop exporting, and export remaining spans."""
+    if "tracing" in app:
+        app["tracing"].cancel()
+        await export_spans()
+
+
 async def response_headers(_, res):
     """Modify response headers before returning response."""
     res.headers["Server"] = "Beacon-Network"
@@ -98,11 +193,20 @@ async def response_headers(_, res):
 async def init_app():
     """Initialise the web server."""
     LOG.info("Initialising web server.")
-    app = web.Application(middlewares=[api_key()])
+    app = web.Application(middlewares=[tracing(), cache_generation(), api_key()])
     app.on_response_prepare.append(response_headers)
     app.router.add_routes(routes)
     if CONFIG.cors:
         set_cors(app)
+    app.on_startup.append(load_catalogue)
+    app.on_startup.append(start_following)
+    app.on_cleanup.append(stop_following)
+    app.on_startup.append(start_cache_warming)
+    app.on_cleanup.append(stop_cache_warming)
+    app.on_startup.append(start_monitoring)
+    app.on_cleanup.append(stop_monitoring)
+    app.on_startup.append(start_tracing)
+    app.on_cleanup.append(stop_tracing)
     return app
 
 
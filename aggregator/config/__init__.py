@@ -31,7 +31,19 @@ def parse_config_file(path):
         "registries": load_json(config.get("app", "registries")) or [],
         "beacons": bool(strtobool(config.get("app", "beacons"))) or True,
         "aggregators": bool(strtobool(config.get("app", "aggregators"))) or False,
+        "catalogue_snapshot": config.get("app", "catalogue_snapshot", fallback=""),
         "cors": os.environ.get("APP_CORS", config.get("app", "cors")),
+        "compression": bool(strtobool(config.get("app", "compression", fallback="True"))),
+        "compression_level": int(config.get("app", "compression_level", fallback=6)),
+        "compression_threshold": int(config.get("app", "compression_threshold", fallback=1024)),
+        "result_cache_ttl": int(config.get("app", "result_cache_ttl", fallback=0)),
+        "result_cache_memory": int(config.get("app", "result_cache_memory", fallback=1000)),
+        "result_cache_file": config.get("app", "result_cache_file", fallback=""),
+        "result_cache_size": int(config.get("app", "result_cache_size", fallback=100)),
+        "warm_queries": int(config.get("app", "warm_queries", fallback=10)),
+        "http_cache_size": int(config.get("app", "http_cache_size", fallback=1000)),
+        "metrics_dir": os.environ.get("APP_METRICS_DIR", config.get("app", "metrics_dir", fallback="")),
+        "tracing": os.environ.get("APP_TRACING", config.get("app", "tracing", fallback="")),
         "name": config.get("info", "name"),
         "type_group": config.get("info", "type_group"),
         "type_artifact": config.get("info", "type_artifact"),
@@ -6,14 +6,20 @@ import uvloop
 
 
 from ..utils.logging import LOG
-from ..utils.utils import clear_cache
+from ..utils.utils import clear_cache, warm_popular_queries
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
-async def invalidate_cache():
-    """Delete local Beacon cache."""
+async def invalidate_cache(host=None):
+    """Delete local Beacon cache.
+
+    If the host of this aggregator is given, popular queries are warmed in the background
+    against the refreshed catalogue, so that they don't all fan out cold at once.
+    """
     LOG.debug("Invalidate cached Beacons.")
 
     await clear_cache()
+    if host is not None:
+        asyncio.ensure_future(warm_popular_queries(host))
     LOG.debug("Cache invalidating procedure complete.")
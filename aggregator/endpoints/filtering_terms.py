@@ -0,0 +1,34 @@
+"""Filtering Terms Endpoint."""
+
+from aiohttp import web
+
+from ..utils.logging import LOG
+from ..utils.utils import get_services, get_filtering_terms, autocomplete_filtering_terms
+
+
+async def send_filtering_terms(request):
+    """Return filtering terms of all services from memory."""
+    LOG.debug("Return merged filtering terms.")
+
+    # Make sure the catalogue is loaded, which starts the harvest on a cold cache
+    await get_services(request.host)
+
+    return await get_filtering_terms()
+
+
+async def send_filtering_terms_autocomplete(request):
+    """Return filtering terms matching a prefix, best matches first."""
+    LOG.debug("Autocomplete filtering terms.")
+
+    prefix = request.query.get("q", "")
+    try:
+        limit = int(request.query.get("limit", 10))
+    except ValueError:
+        raise web.HTTPBadRequest(text="Query parameter limit must be an integer.")
+    if not 0 < limit <= 100:
+        raise web.HTTPBadRequest(text="Query parameter limit must be between 1 and 100.")
+
+    # Make sure the catalogue is loaded, which starts the harvest on a cold cache
+    await get_services(request.host)
+
+    return await autocomplete_filtering_terms(prefix, limit)
@@ -1,37 +1,56 @@
 """Aggregator Query Endpoint."""
 
 import asyncio
+import time
+import ujson
 import uvloop
 
 from aiohttp import web
 
 from ..config import CONFIG
 from ..utils.logging import LOG
-from ..utils.utils import get_access_token, get_services, query_service, parse_results
+from ..utils.utils import get_access_token, get_services, get_filtering_terms, query_service, parse_results, ws_bundle_return, parse_projection
+from ..utils.utils import record_query
+from ..utils.metrics import METRICS
+from ..utils.tracing import span
+from ..utils.diagnostics import diagnostics_requested
+from ..utils.validate import normalize_query
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
+# Seconds between keep-alive comments on an idle event stream, proxies may close silent connections
+SSE_HEARTBEAT = 15
+
 
 async def send_beacon_query(request):
     """Send Beacon queries and respond synchronously."""
     LOG.debug("Normal response (sync).")
 
     tasks = []  # requests to be done
-    services = await get_services(request.host)  # service urls (beacons, aggregators) to be queried
+    filtering_terms = "&filters=filter" in request.query_string  # UI also requests the filtering terms of services
+    params = await normalize_query(request.query_string.replace("&filters=filter", ""))  # reject malformed queries before fan-out
+    projection = parse_projection(request.query.get("fields", ""))  # fields of responses to keep, all if not set
+    diagnostics = diagnostics_requested(request)  # add timings to response
+    start = time.monotonic()
+    with span("catalogue"):
+        services = await get_services(request.host)  # service urls (beacons, aggregators) to be queried
+    catalogue = time.monotonic() - start
     access_token = await get_access_token(request)  # Get access token if one exists
+    record_query(request.host, params, access_token)  # popular queries are warmed before their results expire
 
     for service in services:
         # Generate task queue
-        if "&filters=filter" in request.query_string:
-            task = asyncio.ensure_future(query_service(service, request.query_string.replace("&filters=filter", ""), access_token))
-            tasks.append(task)
-            task = asyncio.ensure_future(query_service(service, "filter", access_token))
-            tasks.append(task)
-        else:
-            task = asyncio.ensure_future(query_service(service, request.query_string, access_token))
-            tasks.append(task)
+        task = asyncio.ensure_future(query_service(service, params, access_token, projection=projection, timing=diagnostics))
+        tasks.append(task)
     # Prepare and initiate co-routines
     results = await asyncio.gather(*tasks)
+    if diagnostics:
+        # Sent in the Server-Timing header of the response
+        request["timing"] = {"catalogue": catalogue, "fanout": time.monotonic() - start - catalogue}
+
+    if filtering_terms:
+        # Filtering terms are served from memory instead of querying every service again
+        results.extend(await get_filtering_terms(responses=True))
 
     # Check if this aggregator is aggregating aggregators
     # Aggregators return lists instead of objects, so they need to be broken down into a single list
@@ -44,29 +63,107 @@ async def send_beacon_query(request):
 async def send_beacon_query_websocket(request):
     """Send Beacon queries and respond asynchronously via websocket."""
     LOG.debug("Websocket response (async).")
+    # Validate query before upgrading the connection, so that malformed queries get a HTTP 400
+    filtering_terms = "&filters=filter" in request.query_string  # UI also requests the filtering terms of services
+    params = await normalize_query(request.query_string.replace("&filters=filter", ""))
+    projection = parse_projection(request.query.get("fields", ""))
+    diagnostics = diagnostics_requested(request)
+
     # Prepare websocket connection
-    ws = web.WebSocketResponse()
+    # permessage-deflate is used if compression is enabled and the client offers it
+    ws = web.WebSocketResponse(compress=CONFIG.compression)
     await ws.prepare(request)
+    METRICS.inc("aggregator_sessions_total", transport="websocket")
+    METRICS.add("aggregator_sessions", 1, transport="websocket")
 
-    # Task variables
-    tasks = []  # requests to be done
-    services = await get_services(request.host)  # service urls (beacons, aggregators) to be queried
-    access_token = await get_access_token(request)  # Get access token if one exists
+    try:
+        # Task variables
+        tasks = []  # requests to be done
+        with span("catalogue"):
+            services = await get_services(request.host)  # service urls (beacons, aggregators) to be queried
+        access_token = await get_access_token(request)  # Get access token if one exists
+        record_query(request.host, params, access_token)  # popular queries are warmed before their results expire
 
-    for service in services:
-        # Generate task queue
-        LOG.debug(f"Query service: {service}")
-        if "&filters=filter" in request.query_string:
-            task = asyncio.ensure_future(query_service(service, request.query_string.replace("&filters=filter", ""), access_token, ws=ws))
-            tasks.append(task)
-            task = asyncio.ensure_future(query_service(service, "filter", access_token, ws=ws))
-            tasks.append(task)
-        else:
-            task = asyncio.ensure_future(query_service(service, request.query_string, access_token, ws=ws))
+        for service in services:
+            # Generate task queue
+            LOG.debug("Query service: %s", service)
+            task = asyncio.ensure_future(query_service(service, params, access_token, ws=ws, projection=projection, timing=diagnostics))
             tasks.append(task)
-    # Prepare and initiate co-routines
-    await asyncio.gather(*tasks)
-    # Close websocket after all results have been sent
-    await ws.close()
+        if filtering_terms:
+            # Filtering terms are served from memory instead of querying every service again
+            for response in await get_filtering_terms(responses=True):
+                task = asyncio.ensure_future(ws_bundle_return(response, ws))
+                tasks.append(task)
+        # Prepare and initiate co-routines
+        await asyncio.gather(*tasks)
+        # Close websocket after all results have been sent
+        await ws.close()
+    finally:
+        METRICS.add("aggregator_sessions", -1, transport="websocket")
 
     return ws
+
+
+def sse_event(data, event=None, event_id=None):
+    """Format data as a Server-Sent Event."""
+    lines = []
+    if event is not None:
+        lines.append(f"event: {event}")
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {ujson.dumps(data, escape_forward_slashes=False)}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+async def send_beacon_query_sse(request):
+    """Send Beacon queries and respond asynchronously via Server-Sent Events.
+
+    Each result is sent as an event as soon as its service responds, comments are sent
+    as heartbeats while waiting, and a final `done` event closes the stream.
+    """
+    LOG.debug("Server-Sent Events response (async).")
+    # Validate query and authorization before the stream is opened, so that malformed requests get a HTTP 400
+    filtering_terms = "&filters=filter" in request.query_string  # UI also requests the filtering terms of services
+    params = await normalize_query(request.query_string.replace("&filters=filter", ""))
+    projection = parse_projection(request.query.get("fields", ""))
+    diagnostics = diagnostics_requested(request)
+    access_token = await get_access_token(request)  # Get access token if one exists
+    with span("catalogue"):
+        services = await get_services(request.host)  # service urls (beacons, aggregators) to be queried
+
+    # Prepare event stream, X-Accel-Buffering disables buffering at nginx reverse proxies
+    stream = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    await stream.prepare(request)
+
+    record_query(request.host, params, access_token)  # popular queries are warmed before their results expire
+    pending = {asyncio.ensure_future(query_service(service, params, access_token, projection=projection, timing=diagnostics)) for service in services}
+    METRICS.inc("aggregator_sessions_total", transport="sse")
+    METRICS.add("aggregator_sessions", 1, transport="sse")
+
+    event_id = 0
+    try:
+        if filtering_terms:
+            # Filtering terms are served from memory instead of querying every service again
+            for response in await get_filtering_terms(responses=True):
+                event_id += 1
+                await stream.write(sse_event(response, event_id=event_id))
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=SSE_HEARTBEAT, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                await stream.write(b": heartbeat\n\n")
+            for task in done:
+                result = task.result()
+                # Aggregators respond with lists, which are broken down into single events
+                for sub_result in result if isinstance(result, list) else [result]:
+                    if sub_result is not None:
+                        event_id += 1
+                        await stream.write(sse_event(sub_result, event_id=event_id))
+        await stream.write(sse_event({"results": event_id}, event="done"))
+    finally:
+        # Client may have disconnected, stop querying services on its behalf
+        for task in pending:
+            task.cancel()
+        METRICS.add("aggregator_sessions", -1, transport="sse")
+
+    await stream.write_eof()
+    return stream
@@ -0,0 +1,40 @@
+"""Gunicorn Configuration for Pre-Fork Loading.
+
+The application is loaded in the gunicorn master process before the workers
+are forked, so configuration, certificates and the catalogue snapshot are
+loaded once and shared copy-on-write by all workers. Workers serve the shared
+snapshot until they have fetched the catalogue themselves. Workers also inherit
+a common directory for their metrics.
+
+Usage: gunicorn aggregator.aggregator:init_app -c python:aggregator.prefork
+"""
+
+import gc
+import tempfile
+
+# Import the application in the master process
+preload_app = True
+
+
+def when_ready(server):
+    """Load shared data in the master process after the application has been imported."""
+    from aggregator.utils.utils import preload_catalogue
+    from aggregator.utils.metrics import METRICS
+
+    preload_catalogue()
+    # Workers share a metrics directory, so that /metrics of any worker covers all of them
+    if METRICS.path:
+        # Metrics of workers of a previous run
+        METRICS.remove()
+    else:
+        METRICS.path = tempfile.mkdtemp(prefix="aggregator-metrics-")
+    # Move loaded objects out of garbage collector's reach, otherwise collections in
+    # workers would touch the objects and copy their memory pages to each worker
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    """Remove metrics of an exited worker, so that they are not exported forever."""
+    from aggregator.utils.metrics import METRICS
+
+    METRICS.remove(worker.pid)
@@ -0,0 +1,112 @@
+"""Registry Change Feeds.
+
+Each worker follows the change feeds of the registries at GET /changes, and applies the streamed
+changes to its copies of their service lists. The catalogue is then rebuilt from memory, instead
+of every worker of every aggregator fetching the service lists again after each change. After a
+disconnection the feed is resumed from the sequence number of the last applied change, and only
+if the registry no longer has the changes since then is the service list fetched again.
+Registries without a change feed are fetched when the cache is invalidated, as before.
+"""
+
+import asyncio
+import ujson
+
+import aiohttp
+
+from yarl import URL
+
+from ..config import CONFIG
+from .logging import LOG
+from .utils import REGISTRY_CATALOGUES, FOLLOWED_REGISTRIES, _registry_catalogue, clear_local_cache, request_security
+
+# Seconds before reconnecting after a failure, doubled for every following failure up to the maximum
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 300
+
+# Seconds without data after which a feed is considered dead, registries send heartbeats every 15 seconds
+READ_TIMEOUT = 60
+
+
+async def read_events(lines):
+    """Parse Server-Sent Events from the lines of a stream, and yield their fields as dicts."""
+    event = {}
+    async for line in lines:
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line:
+            # A blank line ends the event
+            if "data" in event:
+                yield event
+            event = {}
+        elif not line.startswith(":"):
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            event[field] = event["data"] + "\n" + value if field == "data" and "data" in event else value
+
+
+def apply_change(registry, event):
+    """Apply a change to the service list of a registry."""
+    catalogue = REGISTRY_CATALOGUES[registry]
+    if event.get("event") in ("registered", "updated", "deleted"):
+        service = ujson.loads(event["data"])
+        catalogue["services"] = [listed for listed in catalogue["services"] if listed.get("id") != service.get("id")]
+        if event["event"] != "deleted":
+            catalogue["services"].append(service)
+        # The list no longer matches the catalogue version of the registry
+        catalogue["etag"] = None
+    catalogue["sequence"] = int(event.get("id", catalogue["sequence"]))
+
+
+async def follow_changes(session, registry, fetched=False):
+    """Apply changes streamed by a registry until the stream ends, return False if the registry has no change feed."""
+    sequence = REGISTRY_CATALOGUES[registry]["sequence"]
+    headers = {"Accept": "text/event-stream"}
+    async with session.get(URL(registry).join(URL("changes")), params={"since": sequence}, headers=headers, ssl=await request_security()) as response:
+        if response.status == 404:
+            return False
+        if response.status == 410:
+            # Changes since the sequence number are gone, the service list is fetched again
+            REGISTRY_CATALOGUES.pop(registry, None)
+            raise ValueError("changes since the last applied change are no longer available")
+        if response.status != 200:
+            raise ValueError(f"registry responded with {response.status}")
+        LOG.info("Following change feed of %s from sequence number %s.", registry, sequence)
+        FOLLOWED_REGISTRIES.add(registry)
+        if fetched:
+            await clear_local_cache()
+        async for event in read_events(response.content):
+            apply_change(registry, event)
+            # The catalogue is rebuilt from the service lists in memory on the next query
+            await clear_local_cache()
+    return True
+
+
+async def follow_registry(registry):
+    """Follow change feed of a registry until cancelled."""
+    failures = 0
+    while True:
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=READ_TIMEOUT)) as session:
+                fetched = REGISTRY_CATALOGUES.get(registry, {}).get("sequence") is None
+                if fetched:
+                    await _registry_catalogue(session, registry)
+                if registry not in REGISTRY_CATALOGUES:
+                    raise ValueError("service list could not be fetched")
+                if REGISTRY_CATALOGUES[registry]["sequence"] is None or not await follow_changes(session, registry, fetched):
+                    LOG.info("Registry %s has no change feed.", registry)
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOG.warning("Error at following change feed of %s: %s.", registry, e)
+        finally:
+            if registry in FOLLOWED_REGISTRIES:
+                # The feed was connected, so the failure is not a repeated one
+                FOLLOWED_REGISTRIES.discard(registry)
+                failures = 0
+        await asyncio.sleep(min(RECONNECT_DELAY * 2**failures, MAX_RECONNECT_DELAY))
+        failures += 1
+
+
+def follow_registries():
+    """Start following change feeds of all registries, and return the tasks."""
+    return [asyncio.ensure_future(follow_registry(registry["url"])) for registry in CONFIG.registries if registry.get("url")]
@@ -0,0 +1,92 @@
+"""Query Diagnostics.
+
+When /query is requested with `diagnostics=true`, each service result gets a `_timing` block
+with the durations of DNS lookup, connecting, time to first byte and the whole query, collected
+with aiohttp trace hooks. Synchronous responses also get a `Server-Timing` header with the
+durations of the catalogue lookup, fan-out and serialization, shown by browser devtools.
+"""
+
+import functools
+import time
+
+from contextvars import ContextVar
+
+import aiohttp
+
+# Timings of the service query in progress, None if diagnostics are not requested
+TIMING = ContextVar("timing", default=None)
+
+
+def diagnostics_requested(request):
+    """Return True if the client asked for diagnostics."""
+    return request.query.get("diagnostics", "").lower() == "true"
+
+
+def timed(function):
+    """Collect timings of a service query if called with timing=True."""
+
+    @functools.wraps(function)
+    async def wrapper(*args, timing=False, **kwargs):
+        if not timing:
+            return await function(*args, **kwargs)
+        token = TIMING.set({"start": time.monotonic()})
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            TIMING.reset(token)
+
+    return wrapper
+
+
+def add_timing(result):
+    """Return result with timings of the current service query, cached results are not modified."""
+    timing = TIMING.get()
+    if timing is None:
+        return result
+    block = {name: round(timing[name] * 1000, 1) for name in ("dns", "connect", "ttfb") if name in timing}
+    block["total"] = round((time.monotonic() - timing["start"]) * 1000, 1)
+    if "ttfb" not in timing:
+        # No request was made, the result came from a cache
+        block["cached"] = True
+    if isinstance(result, list):
+        # Results of aggregators share the timing of the query to the aggregator
+        return [{**sub_result, "_timing": block} if isinstance(sub_result, dict) else sub_result for sub_result in result]
+    return {**result, "_timing": block} if isinstance(result, dict) else result
+
+
+def request_timing():
+    """Return aiohttp trace config, which records timings of outgoing requests in milliseconds."""
+
+    def mark(name):
+        async def hook(session, context, params):
+            if (timing := TIMING.get()) is not None:
+                timing[name] = time.monotonic()
+
+        return hook
+
+    def measure(name, since):
+        async def hook(session, context, params):
+            if (timing := TIMING.get()) is not None and since in timing:
+                timing[name] = time.monotonic() - timing[since]
+
+        return hook
+
+    async def exclude_dns(session, context, params):
+        # Creating a connection includes resolving the host, which is reported separately
+        if (timing := TIMING.get()) is not None and "connect" in timing:
+            timing["connect"] = max(timing["connect"] - timing.get("dns", 0), 0)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(mark("request_start"))
+    trace_config.on_dns_resolvehost_start.append(mark("dns_start"))
+    trace_config.on_dns_resolvehost_end.append(measure("dns", "dns_start"))
+    trace_config.on_connection_create_start.append(mark("connect_start"))
+    trace_config.on_connection_create_end.append(measure("connect", "connect_start"))
+    trace_config.on_connection_create_end.append(exclude_dns)
+    trace_config.on_request_end.append(measure("ttfb", "request_start"))
+    return trace_config
+
+
+def server_timing(timings):
+    """Format durations in seconds as a Server-Timing header value."""
+    return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in timings.items())
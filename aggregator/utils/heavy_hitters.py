@@ -0,0 +1,97 @@
+"""Popular Query Tracking.
+
+A count-min sketch estimates how often each query has been seen in constant memory,
+and a heap keeps the keys with the highest estimates.
+"""
+
+import hashlib
+import heapq
+import struct
+
+from array import array
+
+from ..config import CONFIG
+
+
+class CountMinSketch:
+    """Approximate frequency counter, estimates are never lower than the true counts."""
+
+    def __init__(self, width=2048, depth=4):
+        """Initialise counters, memory is width * depth counters regardless of the number of keys."""
+        self.width = width
+        self.depth = depth
+        self.rows = [array("L", [0] * width) for _ in range(depth)]
+
+    def _columns(self, key):
+        """Return a counter column for each row, derived from a single digest."""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=4 * self.depth).digest()
+        return [value % self.width for value in struct.unpack(f"<{self.depth}I", digest)]
+
+    def add(self, key):
+        """Count key, and return its new estimate."""
+        estimate = None
+        for row, column in zip(self.rows, self._columns(key)):
+            row[column] += 1
+            estimate = row[column] if estimate is None else min(estimate, row[column])
+        return estimate
+
+    def estimate(self, key):
+        """Return estimated count of key."""
+        return min(row[column] for row, column in zip(self.rows, self._columns(key)))
+
+    def decay(self):
+        """Halve all counters, so that past popularity fades."""
+        for row in self.rows:
+            for column in range(self.width):
+                row[column] >>= 1
+
+
+class HeavyHitters:
+    """Track the k most frequent keys."""
+
+    def __init__(self, k=10, width=2048, depth=4):
+        """Initialise sketch and top-k heap."""
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}  # key -> estimate
+        self.heap = []  # (estimate, key), may contain outdated entries
+
+    def add(self, key):
+        """Count key, and keep it if it is among the k most frequent."""
+        estimate = self.sketch.add(key)
+        if key in self.top or len(self.top) < self.k:
+            self.top[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+        elif estimate > self._minimum()[0]:
+            _, evicted = heapq.heappop(self.heap)
+            del self.top[evicted]
+            self.top[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+        if len(self.heap) > 4 * self.k:
+            # Drop outdated entries of frequently updated keys
+            self._rebuild()
+
+    def _minimum(self):
+        """Return the least frequent kept entry, dropping outdated heap entries."""
+        while self.heap[0][1] not in self.top or self.top[self.heap[0][1]] != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0]
+
+    def most_common(self, n=None):
+        """Return kept keys, most frequent first."""
+        return [key for key, _ in sorted(self.top.items(), key=lambda item: -item[1])][:n]
+
+    def decay(self):
+        """Halve all counts, so that queries that are no longer popular are replaced."""
+        self.sketch.decay()
+        self.top = {key: estimate >> 1 for key, estimate in self.top.items()}
+        self._rebuild()
+
+    def _rebuild(self):
+        """Rebuild heap from kept entries."""
+        self.heap = [(estimate, key) for key, estimate in self.top.items()]
+        heapq.heapify(self.heap)
+
+
+# Canonical query strings of anonymous /query requests
+POPULAR_QUERIES = HeavyHitters(k=max(CONFIG.warm_queries, 1))
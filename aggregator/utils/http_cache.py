@@ -0,0 +1,121 @@
+"""HTTP Cache for Service Query Responses.
+
+Responses are cached per service as allowed by their Cache-Control, Expires and ETag headers.
+Fresh responses are served without contacting the service, and stale responses with an ETag
+are revalidated with a conditional GET request. Responses to POST queries are only reused while
+they are fresh, as services answer a conditional POST with 412 Precondition Failed instead of
+304 Not Modified. The aggregator acts as a shared cache, so responses
+marked private are never stored, and responses to requests with an access token are only stored
+if the service explicitly allows it.
+"""
+
+import hashlib
+import time
+
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from multidict import CIMultiDict
+
+from ..config import CONFIG
+from .metrics import METRICS
+
+
+def parse_cache_control(header):
+    """Parse Cache-Control header into a dict of lowercase directives."""
+    directives = {}
+    for directive in header.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"') if value else True
+    return directives
+
+
+def freshness_lifetime(headers, directives):
+    """Return seconds the response stays fresh after it was received."""
+    try:
+        # A shared cache prefers s-maxage over max-age, and both over Expires
+        if "s-maxage" in directives:
+            lifetime = int(directives["s-maxage"])
+        elif "max-age" in directives:
+            lifetime = int(directives["max-age"])
+        elif "Expires" in headers:
+            date = parsedate_to_datetime(headers["Date"]).timestamp() if "Date" in headers else time.time()
+            lifetime = parsedate_to_datetime(headers["Expires"]).timestamp() - date
+        else:
+            lifetime = 0
+        # Time the response already spent in caches between the service and the aggregator
+        return lifetime - int(headers.get("Age", 0))
+    except (TypeError, ValueError):
+        # Malformed dates and numbers mean the response is already stale
+        return 0
+
+
+class HttpCache:
+    """Cache service responses in memory according to HTTP caching rules."""
+
+    def __init__(self, size):
+        """Initialise cache, a size of 0 disables caching."""
+        self.size = size
+        self.entries = OrderedDict()  # key -> (expires, etag, result)
+
+    @property
+    def enabled(self):
+        """Return True if caching is enabled."""
+        return self.size > 0
+
+    def key(self, url, params, access_token=None):
+        """Return cache key of a query, responses to different users are kept apart."""
+        key = f"{url}?{params}"
+        if access_token:
+            key += "#" + hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+        return key
+
+    def __contains__(self, key):
+        """Return True if a response is stored for key, fresh or stale."""
+        return key in self.entries
+
+    def lookup(self, key):
+        """Return (fresh, etag, result) of a stored response, or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            METRICS.inc("aggregator_cache_requests_total", cache="http", result="miss")
+            return None
+        self.entries.move_to_end(key)
+        fresh = entry[0] > time.time()
+        METRICS.inc("aggregator_cache_requests_total", cache="http", result="hit" if fresh else "stale")
+        return fresh, entry[1], entry[2]
+
+    def store(self, key, headers, result, authorized=False, method="GET"):
+        """Store response, if its headers allow it, only responses to GET are kept for revalidation."""
+        directives = parse_cache_control(headers.get("Cache-Control", ""))
+        if "no-store" in directives or "private" in directives or headers.get("Vary", "").strip() == "*":
+            self.entries.pop(key, None)
+            return
+        # Responses to requests with credentials may only be stored by a shared cache if explicitly allowed
+        if authorized and not any(directive in directives for directive in ("public", "s-maxage", "must-revalidate")):
+            self.entries.pop(key, None)
+            return
+        lifetime = 0 if "no-cache" in directives else freshness_lifetime(headers, directives)
+        etag = headers.get("ETag") if method == "GET" else None
+        if lifetime <= 0 and etag is None:
+            # Neither fresh nor revalidatable, there is no use in keeping it
+            self.entries.pop(key, None)
+            return
+        self.entries[key] = (time.time() + lifetime, etag, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def revalidate(self, key, headers, authorized=False):
+        """Refresh a stored response after the service replied 304 Not Modified, and return its result."""
+        _, etag, result = self.entries[key]
+        METRICS.inc("aggregator_cache_requests_total", cache="http", result="revalidated")
+        # 304 responses carry the same caching headers as a full response would
+        headers = CIMultiDict(headers)
+        headers.setdefault("ETag", etag)
+        self.store(key, headers, result, authorized)
+        return result
+
+
+HTTP_CACHE = HttpCache(size=CONFIG.http_cache_size)
@@ -0,0 +1,234 @@
+"""Prometheus Metrics.
+
+Each worker process keeps its metrics in memory, and periodically writes them to a file
+in a directory shared by all workers. The /metrics endpoint of any worker merges the files,
+so that the metrics of the whole aggregator are exposed in the Prometheus text format.
+Files of exited workers are removed by the gunicorn master, see prefork.py.
+"""
+
+import asyncio
+import os
+import re
+import time
+import ujson
+
+import aiohttp
+
+from ..config import CONFIG
+from .logging import LOG
+
+# Seconds between event loop lag measurements and writes of the metrics file
+METRICS_INTERVAL = 5
+
+# Files of workers in the metrics directory are named by process ID, other files are left alone
+WORKER_FILE = re.compile(r"^(\d+)\.json(\.tmp)?$")
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Name: (type, help), and for gauges how values of different workers are merged
+DESCRIPTIONS = {
+    "aggregator_service_requests_total": ("counter", "Queries sent to services by service and response status."),
+    "aggregator_service_request_duration_seconds": ("histogram", "Duration of queries sent to services."),
+    "aggregator_catalogue_services": ("gauge", "Number of services in the catalogue.", max),
+    "aggregator_catalogue_refresh_duration_seconds": ("histogram", "Duration of catalogue refreshes from registries."),
+    "aggregator_cache_requests_total": ("counter", "Cache lookups by cache and result."),
+    "aggregator_sessions": ("gauge", "Open streaming sessions by transport.", sum),
+    "aggregator_sessions_total": ("counter", "Streaming sessions by transport."),
+    "aggregator_event_loop_lag_seconds": ("histogram", "Delay of scheduled callbacks on the event loop."),
+}
+
+
+def metric_key(name, labels):
+    """Return hashable key of a metric and its labels."""
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Metrics:
+    """Counters, gauges and histograms of a worker."""
+
+    def __init__(self, path=""):
+        """Initialise metrics, written to directory at path if set."""
+        self.path = path
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+    def inc(self, name, value=1, **labels):
+        """Increment counter."""
+        key = metric_key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        """Add value to gauge, use negative value to subtract."""
+        key = metric_key(name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set gauge."""
+        self.gauges[metric_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Add observation to histogram."""
+        key = metric_key(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = [0] * (len(BUCKETS) + 2)
+        histogram = self.histograms[key]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+    def snapshot(self):
+        """Return metrics in a JSON serializable form."""
+        return {
+            "pid": os.getpid(),
+            "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+            "gauges": [[name, labels, value] for (name, labels), value in self.gauges.items()],
+            "histograms": [[name, labels, value] for (name, labels), value in self.histograms.items()],
+        }
+
+    def write(self):
+        """Write metrics of this worker to the shared directory."""
+        if not self.path:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            path = os.path.join(self.path, f"{os.getpid()}.json")
+            # Write to a temporary file first, so that other workers never read a partial file
+            with open(f"{path}.tmp", "w") as snapshot:
+                snapshot.write(ujson.dumps(self.snapshot()))
+            os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            LOG.error("Error at writing metrics: %s.", e)
+
+    def collect(self):
+        """Return snapshots of all workers, including the up to date snapshot of this worker."""
+        snapshots = [self.snapshot()]
+        if not self.path or not os.path.isdir(self.path):
+            return snapshots
+        for filename in os.listdir(self.path):
+            if (match := WORKER_FILE.match(filename)) is None or match.group(2) or filename == f"{os.getpid()}.json":
+                continue
+            try:
+                with open(os.path.join(self.path, filename), "r") as snapshot:
+                    snapshots.append(ujson.loads(snapshot.read()))
+            except Exception as e:
+                LOG.error("Error at reading metrics from %s: %s.", filename, e)
+        return snapshots
+
+    def remove(self, pid=None):
+        """Remove files of a worker that has exited, or of all workers, from the shared directory."""
+        if not self.path or not os.path.isdir(self.path):
+            return
+        for filename in os.listdir(self.path):
+            if (match := WORKER_FILE.match(filename)) is not None and pid in (None, int(match.group(1))):
+                try:
+                    os.remove(os.path.join(self.path, filename))
+                except FileNotFoundError:
+                    pass
+
+
+def worker_alive(pid):
+    """Return True if worker process exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(snapshots):
+    """Merge worker snapshots, counters and histograms of exited workers are kept, their gauges are not."""
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in snapshots:
+        alive = worker_alive(snapshot["pid"])
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot["gauges"] if alive else []:
+            gauges.setdefault((name, tuple(tuple(label) for label in labels)), []).append(value)
+        for name, labels, value in snapshot["histograms"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            histograms[key] = [a + b for a, b in zip(histograms.get(key, [0] * len(value)), value)]
+    gauges = {key: DESCRIPTIONS[key[0]][2](values) for key, values in gauges.items()}
+    return counters, gauges, histograms
+
+
+def format_labels(labels, extra=()):
+    """Format labels as {name="value",...}."""
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render(snapshots):
+    """Render merged snapshots in the Prometheus text exposition format."""
+    counters, gauges, histograms = merge(snapshots)
+    lines = []
+    for name, description in DESCRIPTIONS.items():
+        lines.append(f"# HELP {name} {description[1]}")
+        lines.append(f"# TYPE {name} {description[0]}")
+        for (metric, labels), value in sorted({**counters, **gauges}.items()):
+            if metric == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric == name:
+                for bound, count in zip(BUCKETS, histogram):
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram[-2]}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram[-2]}")
+    return "\n".join(lines) + "\n"
+
+
+async def get_metrics():
+    """Return metrics of all workers in the Prometheus text format."""
+    LOG.debug("Collecting metrics.")
+    snapshots = await asyncio.get_event_loop().run_in_executor(None, METRICS.collect)
+    return render(snapshots)
+
+
+async def monitor_event_loop():
+    """Measure event loop lag, and write metrics of this worker periodically."""
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(METRICS_INTERVAL)
+        # The sleep takes longer than requested by the time callbacks wait for a busy loop
+        METRICS.observe("aggregator_event_loop_lag_seconds", max(loop.time() - start - METRICS_INTERVAL, 0))
+        await loop.run_in_executor(None, METRICS.write)
+
+
+def request_metrics():
+    """Return aiohttp trace config, which records duration and status of outgoing requests."""
+
+    async def on_request_start(session, context, params):
+        context.start = time.monotonic()
+
+    async def on_request_end(session, context, params):
+        record_request(params.url, params.response.status, time.monotonic() - context.start)
+
+    async def on_request_exception(session, context, params):
+        record_request(params.url, "error", time.monotonic() - context.start)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+def record_request(url, status, duration):
+    """Record request to a service, labeled by origin to keep the number of series bounded."""
+    service = str(url.origin())
+    METRICS.inc("aggregator_service_requests_total", service=service, status=status)
+    METRICS.observe("aggregator_service_request_duration_seconds", duration, service=service)
+
+
+METRICS = Metrics(path=CONFIG.metrics_dir)
@@ -0,0 +1,117 @@
+"""Prefix Index for Filtering Term Autocomplete."""
+
+import heapq
+import re
+
+from bisect import bisect_left, bisect_right
+
+from .logging import LOG
+
+# Upper bound for the range of keys starting with a given prefix
+MAX_CHAR = "\U0010ffff"
+
+# Share of changed terms above which the index is rebuilt instead of updated key by key
+REBUILD_RATIO = 0.1
+
+
+def term_label(term):
+    """Return lowercase label of a term, beacons may send a null or non-string label."""
+    return str(term.get("label") or "").lower()
+
+
+def indexable(term):
+    """Return True if a term can be indexed, ids that are not strings are skipped."""
+    return isinstance(term.get("id"), str) and term["id"] != ""
+
+
+def index_keys(term):
+    """Return lowercase search keys of a term: its id, its full label and each word of the label."""
+    keys = {term["id"].lower()}
+    label = term_label(term)
+    if label:
+        keys.add(label)
+        keys.update(word for word in re.split(r"[\s,;:()/_-]+", label) if word)
+    return keys
+
+
+def build_prefix_index(terms):
+    """Build a sorted array of (key, term) pairs for prefix lookups with bisect.
+
+    Keys and terms are kept in separate lists, so that bisect can search the keys directly.
+    """
+    LOG.debug("Building prefix index.")
+    terms = [term for term in terms if indexable(term)]
+    entries = sorted((key, term["id"]) for term in terms for key in index_keys(term))
+    return {
+        "keys": [key for key, _ in entries],
+        "ids": [term_id for _, term_id in entries],
+        "terms": {term["id"]: term for term in terms},
+    }
+
+
+def update_prefix_index(index, terms):
+    """Update index to hold `terms`, re-indexing only the terms that were added, removed or relabelled.
+
+    The index is updated in place without yielding to the event loop, so lookups never see it half
+    updated. If many terms changed, a new index is built instead, and returned.
+    """
+    LOG.debug("Updating prefix index.")
+    new = {term["id"]: term for term in terms if indexable(term)}
+    old = index["terms"]
+    removed = {term_id: index_keys(term) for term_id, term in old.items() if term_id not in new}
+    added = {term_id: index_keys(term) for term_id, term in new.items() if term_id not in old}
+    for term_id in old.keys() & new.keys():
+        old_keys, new_keys = index_keys(old[term_id]), index_keys(new[term_id])
+        if old_keys != new_keys:
+            removed[term_id], added[term_id] = old_keys - new_keys, new_keys - old_keys
+    if len(removed) + len(added) > REBUILD_RATIO * max(len(new), 1):
+        return build_prefix_index(new.values())
+
+    keys, ids = index["keys"], index["ids"]
+    for term_id, term_keys in removed.items():
+        for key in term_keys:
+            # Pairs with the same key are sorted by term id
+            position = bisect_left(ids, term_id, bisect_left(keys, key), bisect_right(keys, key))
+            del keys[position], ids[position]
+    for term_id, term_keys in added.items():
+        for key in term_keys:
+            position = bisect_left(ids, term_id, bisect_left(keys, key), bisect_right(keys, key))
+            keys.insert(position, key)
+            ids.insert(position, term_id)
+    index["terms"] = new
+    return index
+
+
+def rank(term, prefix):
+    """Sort key for matched terms, smaller is better.
+
+    Exact id matches come first, then labels starting with the prefix, then labels
+    with a word starting with the prefix. Ties are broken by the number of beacons
+    providing the term, and then by label length.
+    """
+    label = term_label(term)
+    if term["id"].lower() == prefix:
+        match = 0
+    elif label.startswith(prefix) or term["id"].lower().startswith(prefix):
+        match = 1
+    else:
+        match = 2
+    return (match, -len(term.get("beacons", [])), len(label), term["id"])
+
+
+def search_prefix_index(index, prefix, limit=10):
+    """Return at most `limit` ranked terms with a key starting with `prefix`.
+
+    All matching terms are ranked, only the best `limit` of them are kept sorted.
+    """
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+
+    keys = index["keys"]
+    start = bisect_left(keys, prefix)
+    end = bisect_left(keys, prefix + MAX_CHAR, lo=start)
+
+    # A term can match with several keys, deduplicate by term id
+    matches = set(index["ids"][start:end])
+    return heapq.nsmallest(limit, (index["terms"][term_id] for term_id in matches), key=lambda term: rank(term, prefix))
@@ -0,0 +1,166 @@
+"""Two-Tier Cache for Service Query Results.
+
+The first tier is a small in-memory LRU cache of each worker process.
+The optional second tier is an SQLite file shared by all workers, which
+keeps results warm across restarts and worker recycling.
+"""
+
+import asyncio
+import os
+import sqlite3
+import time
+import ujson
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ..config import CONFIG
+from .logging import LOG
+from .metrics import METRICS
+
+# Expired and excess rows are removed from the second tier after this many writes
+COMPACT_INTERVAL = 1000
+
+
+class ResultCache:
+    """Cache query results in memory, and optionally in an SQLite file."""
+
+    def __init__(self, ttl, memory_size, path="", disk_size=0):
+        """Initialise cache, a ttl of 0 disables caching."""
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.path = path
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.writes = 0
+        self.connection = None
+        # SQLite connections are used from a single thread, so the event loop is never blocked by disk I/O
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache") if path else None
+
+    @property
+    def enabled(self):
+        """Return True if caching is enabled."""
+        return self.ttl > 0
+
+    @property
+    def shared(self):
+        """Return True if results are shared by all workers in the SQLite file."""
+        return self.executor is not None
+
+    async def get(self, key):
+        """Return cached result, or None if it is missing or expired."""
+        entry = self.memory.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self.memory.move_to_end(key)
+                METRICS.inc("aggregator_cache_requests_total", cache="result_memory", result="hit")
+                return entry[1]
+            del self.memory[key]
+        METRICS.inc("aggregator_cache_requests_total", cache="result_memory", result="miss")
+        if self.executor is not None:
+            entry = await asyncio.get_event_loop().run_in_executor(self.executor, self._disk_get, key)
+            if entry is not None:
+                # Promote to the first tier with the expiry time recorded on disk
+                self._memory_set(key, entry[1], entry[0])
+                METRICS.inc("aggregator_cache_requests_total", cache="result_disk", result="hit")
+                return entry[1]
+            METRICS.inc("aggregator_cache_requests_total", cache="result_disk", result="miss")
+        return None
+
+    async def set(self, key, value):
+        """Store result in both tiers."""
+        expires = time.time() + self.ttl
+        self._memory_set(key, value, expires)
+        if self.executor is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self._disk_set, key, ujson.dumps(value, escape_forward_slashes=False), expires)
+
+    async def clear(self):
+        """Remove all results from both tiers."""
+        self.memory.clear()
+        if self.executor is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self._disk_clear)
+
+    def _memory_set(self, key, value, expires):
+        """Store result in the first tier, evicting the least recently used results."""
+        self.memory[key] = (expires, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _disk(self):
+        """Open the second tier on first use."""
+        if self.connection is None:
+            LOG.debug("Opening result cache at %s.", self.path)
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            # Incremental auto vacuum must be set before the table is created
+            self.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # WAL allows all workers to read while one of them writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS results (
+                       key TEXT PRIMARY KEY, value TEXT, size INTEGER, expires REAL, accessed REAL)"""
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+            self._disk_compact()
+        return self.connection
+
+    def _disk_get(self, key):
+        """Read result from the second tier."""
+        try:
+            connection = self._disk()
+            row = connection.execute("SELECT expires, value FROM results WHERE key=?", (key,)).fetchone()
+            if row is None or row[0] <= time.time():
+                return None
+            connection.execute("UPDATE results SET accessed=? WHERE key=?", (time.time(), key))
+            return row[0], ujson.loads(row[1])
+        except Exception as e:
+            LOG.error("Error at reading result cache: %s.", e)
+            return None
+
+    def _disk_set(self, key, value, expires):
+        """Write result to the second tier."""
+        try:
+            connection = self._disk()
+            connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires, time.time()),
+            )
+            self.writes += 1
+            if self.writes % COMPACT_INTERVAL == 0:
+                self._disk_compact()
+        except Exception as e:
+            LOG.error("Error at writing result cache: %s.", e)
+
+    def _disk_clear(self):
+        """Remove all results from the second tier."""
+        try:
+            self._disk().execute("DELETE FROM results")
+        except Exception as e:
+            LOG.error("Error at clearing result cache: %s.", e)
+
+    def _disk_compact(self):
+        """Remove expired results, evict least recently used results over the size cap, and release free pages."""
+        connection = self.connection
+        connection.execute("DELETE FROM results WHERE expires<=?", (time.time(),))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total > self.disk_size:
+            # Walk from the most recently used result, and delete everything after the cap is reached
+            cutoff = connection.execute(
+                """SELECT accessed FROM (SELECT accessed, SUM(size) OVER (ORDER BY accessed DESC) AS running FROM results)
+                   WHERE running>? ORDER BY accessed DESC LIMIT 1""",
+                (self.disk_size,),
+            ).fetchone()
+            if cutoff is not None:
+                connection.execute("DELETE FROM results WHERE accessed<=?", (cutoff[0],))
+        connection.execute("PRAGMA incremental_vacuum")
+        LOG.debug("Result cache compacted.")
+
+
+RESULT_CACHE = ResultCache(
+    ttl=CONFIG.result_cache_ttl,
+    memory_size=CONFIG.result_cache_memory,
+    path=CONFIG.result_cache_file,
+    disk_size=CONFIG.result_cache_size * 1024 * 1024,
+)
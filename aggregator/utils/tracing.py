@@ -0,0 +1,200 @@
+"""Distributed Tracing.
+
+Spans are recorded around the stages of a request, and the trace context is propagated to
+services and registries in W3C `traceparent` headers, so that a query fanning out through
+a chain of aggregators can be followed end to end. Finished spans are exported periodically
+in the OTLP JSON format, either as lines of a file or to an OTLP/HTTP collector.
+"""
+
+import asyncio
+import functools
+import os
+import re
+import time
+import ujson
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import aiohttp
+
+from aiohttp import web
+
+from ..config import CONFIG
+from .logging import LOG
+
+# Seconds between exports of finished spans
+EXPORT_INTERVAL = 5
+
+# Finished spans are dropped if exports can't keep up, so that memory stays bounded
+MAX_SPANS = 10000
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+CURRENT_SPAN = ContextVar("span", default=None)
+SPANS = []
+
+
+class Span:
+    """A timed stage of a request."""
+
+    def __init__(self, name, trace_id, parent_id=None, kind=1, **attributes):
+        """Start span, kind is 1 for internal, 2 for server and 3 for client spans."""
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+    def traceparent(self):
+        """Return W3C trace context header value for requests made within this span."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self):
+        """Return span in the OTLP JSON format."""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [{"key": key, "value": {"stringValue": str(value)}} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+@contextmanager
+def span(name, kind=1, **attributes):
+    """Record a span as a child of the current span, yields None if tracing is disabled."""
+    parent = CURRENT_SPAN.get()
+    if not CONFIG.tracing or parent is None:
+        yield None
+        return
+    current = Span(name, parent.trace_id, parent.span_id, kind, **attributes)
+    token = CURRENT_SPAN.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        finish(current)
+
+
+def traced(name, kind=1):
+    """Record a span around each call of a coroutine function."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with span(name, kind):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def set_attribute(key, value):
+    """Set attribute of the current span."""
+    if (current := CURRENT_SPAN.get()) is not None:
+        current.attributes[key] = value
+
+
+def trace_headers():
+    """Return trace context headers for an outbound request."""
+    current = CURRENT_SPAN.get()
+    return {} if current is None else {"traceparent": current.traceparent()}
+
+
+def finish(current):
+    """End span, and queue it for export."""
+    current.end = time.time_ns()
+    if len(SPANS) < MAX_SPANS:
+        SPANS.append(current)
+
+
+def tracing():
+    """Record a server span for each request, continuing the trace of the client if it sent one."""
+
+    @web.middleware
+    async def tracing_middleware(request, handler):
+        if not CONFIG.tracing:
+            return await handler(request)
+        match = TRACEPARENT.match(request.headers.get("traceparent", "").strip().lower())
+        trace_id, parent_id = (match.group(1), match.group(2)) if match else (os.urandom(16).hex(), None)
+        current = Span(f"{request.method} {request.path}", trace_id, parent_id, kind=2, host=request.host)
+        token = CURRENT_SPAN.set(current)
+        try:
+            response = await handler(request)
+            current.attributes["status"] = response.status
+            return response
+        except web.HTTPException as e:
+            current.attributes["status"] = e.status
+            raise
+        except BaseException as e:
+            current.error = repr(e)
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+            finish(current)
+
+    return tracing_middleware
+
+
+def otlp_payload(spans):
+    """Wrap spans in an OTLP export request."""
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": CONFIG.name}}]},
+                "scopeSpans": [{"scope": {"name": "beacon-network"}, "spans": [finished.to_otlp() for finished in spans]}],
+            }
+        ]
+    }
+
+
+def write_spans(path, payload):
+    """Append export request to a file as a single line.
+
+    The line is written with a single call, so that lines of different workers are not interleaved.
+    """
+    descriptor = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(descriptor, (ujson.dumps(payload, escape_forward_slashes=False) + "\n").encode("utf-8"))
+    finally:
+        os.close(descriptor)
+
+
+async def export_spans():
+    """Export finished spans to the configured file or collector."""
+    if not SPANS:
+        return
+    payload = otlp_payload(SPANS[:])
+    SPANS.clear()
+    try:
+        if CONFIG.tracing.startswith(("http://", "https://")):
+            async with aiohttp.ClientSession() as session:
+                async with session.post(CONFIG.tracing, json=payload) as response:
+                    if response.status >= 300:
+                        LOG.error("Trace collector responded with %s.", response.status)
+        else:
+            await asyncio.get_event_loop().run_in_executor(None, write_spans, CONFIG.tracing, payload)
+    except Exception as e:
+        LOG.error("Error at exporting spans: %s.", e)
+
+
+async def export_spans_periodically():
+    """Export finished spans periodically."""
+    while True:
+        await asyncio.sleep(EXPORT_INTERVAL)
+        await export_spans()
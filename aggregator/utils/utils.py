@@ -2,8 +2,13 @@
 
 import os
 import sys
+import time
 import ujson
 import ssl
+import zlib
+import multiprocessing
+
+from functools import lru_cache
 
 from urllib import parse
 
@@ -17,10 +22,43 @@ from aiocache.serializers import JsonSerializer
 
 from ..config import CONFIG
 from .logging import LOG
+from .prefix_index import build_prefix_index, update_prefix_index, search_prefix_index
+from .result_cache import RESULT_CACHE
+from .http_cache import HTTP_CACHE
+from .heavy_hitters import POPULAR_QUERIES
+from .metrics import METRICS, request_metrics
+from .tracing import span, traced, set_attribute, trace_headers
+from .diagnostics import timed, add_timing, request_timing, server_timing
 
 # Used by query_service() and ws_bundle_return() in a similar manner as ../endpoints/query.py
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
+# Filtering terms of the cached service catalogue, harvested in the background by get_services()
+FILTERING_TERMS = {"task": None, "responses": [], "terms": [], "index": build_prefix_index([])}
+
+# Generation of the cached service catalogue, incremented by clear_cache()
+# If this module is loaded before gunicorn forks the workers (see prefork.py), the counter
+# is in memory shared by all workers, and clearing the cache in one worker clears it in all
+CACHE_GENERATION = multiprocessing.Value("Q", 0)
+CATALOGUE = {"generation": 0, "preloaded": None}
+
+# Service lists of registries by URL with their ETags and sequence numbers, revalidated with conditional requests
+# on catalogue refresh, unless they are kept up to date by following the change feeds of the registries
+REGISTRY_CATALOGUES = {}
+
+# Registries whose change feed is followed by this worker, see change_feed.py
+FOLLOWED_REGISTRIES = set()
+
+# Host of this aggregator as seen by clients, recorded with popular queries for refreshing the catalogue
+WARMING = {"host": None}
+
+# Process ID of the worker that warms popular queries periodically, shared by all workers like CACHE_GENERATION,
+# so that each warming cycle queries the services once instead of once per worker
+WARMER = multiprocessing.Value("i", 0)
+
+# Maximum number of concurrent service queries while warming cached results
+WARM_CONCURRENCY = 10
+
 
 async def parse_version(semver):
     """
@@ -42,6 +80,35 @@ async def parse_version(semver):
         return int(version)
 
 
+def _catalogue_sequence(headers):
+    """Return sequence number of a registry catalogue, None if the registry has no change feed."""
+    sequence = headers.get("Catalogue-Sequence", "")
+    return int(sequence) if sequence.isdigit() else None
+
+
+async def _registry_catalogue(session, registry):
+    """Return services listed by registry, the previous list is reused if it has not changed or is kept up to date."""
+    if registry in FOLLOWED_REGISTRIES:
+        LOG.debug("Service list of %s is kept up to date by its change feed.", registry)
+        return REGISTRY_CATALOGUES[registry]["services"]
+    headers = trace_headers()
+    if REGISTRY_CATALOGUES.get(registry, {}).get("etag"):
+        headers["If-None-Match"] = REGISTRY_CATALOGUES[registry]["etag"]
+    async with session.get(registry, headers=headers, ssl=await request_security()) as response:
+        if response.status == 304 and registry in REGISTRY_CATALOGUES:
+            LOG.debug("Service list of %s has not changed.", registry)
+            if (sequence := _catalogue_sequence(response.headers)) is not None:
+                REGISTRY_CATALOGUES[registry]["sequence"] = sequence
+            return REGISTRY_CATALOGUES[registry]["services"]
+        if response.status == 200:
+            result = await response.json()
+            if "ETag" in response.headers or "Catalogue-Sequence" in response.headers:
+                REGISTRY_CATALOGUES[registry] = {"etag": response.headers.get("ETag"), "services": result, "sequence": _catalogue_sequence(response.headers)}
+            return result
+    return []
+
+
+@traced("registry", kind=3)
 async def http_get_service_urls(registry):
     """Query an external registry for known service urls of desired type."""
     LOG.debug("Query external registry for given service type.")
@@ -50,19 +117,17 @@ async def http_get_service_urls(registry):
     # Query Registry for services
     async with aiohttp.ClientSession() as session:
         try:
-            async with session.get(registry, ssl=await request_security()) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    for r in result:
-                        # Parse types: query beacons, or query aggregators, or both?
-                        # Check if service has a type tag of Beacons
-                        if CONFIG.beacons and r.get("type", {}).get("artifact") == "beacon":
-                            # Create a tuple of URL and service version
-                            # the version is used later in deciding the request body
-                            service_urls.append((r["url"], await parse_version(r.get("type").get("version")), "beacon"))
-                        # Check if service has a type tag of Aggregators
-                        if CONFIG.aggregators and r.get("type", {}).get("artifact") == "beacon-aggregator":
-                            service_urls.append((r["url"], await parse_version(r.get("type").get("version")), "beacon-aggregator"))
+            result = await _registry_catalogue(session, registry)
+            for r in result:
+                # Parse types: query beacons, or query aggregators, or both?
+                # Check if service has a type tag of Beacons
+                if CONFIG.beacons and r.get("type", {}).get("artifact") == "beacon":
+                    # Create a tuple of URL and service version
+                    # the version is used later in deciding the request body
+                    service_urls.append((r["url"], await parse_version(r.get("type").get("version")), "beacon"))
+                # Check if service has a type tag of Aggregators
+                if CONFIG.aggregators and r.get("type", {}).get("artifact") == "beacon-aggregator":
+                    service_urls.append((r["url"], await parse_version(r.get("type").get("version")), "beacon-aggregator"))
         except Exception as e:
             LOG.debug(f"Query error {e}.")
             web.HTTPInternalServerError(text="An error occurred while attempting to query services.")
@@ -70,11 +135,23 @@ async def http_get_service_urls(registry):
     return service_urls
 
 
+def is_preloaded(services):
+    """Return True if services are the catalogue snapshot loaded at startup, which is not copied into the cache."""
+    return CATALOGUE["preloaded"] is not None and services is CATALOGUE["preloaded"]["services"]
+
+
 # Cache Beacon URLs if they're not already cached
-@cached(ttl=86400, key="beacon_urls", serializer=JsonSerializer())
-async def get_services(url_self):
-    """Return service urls."""
+@cached(ttl=86400, key="beacon_urls", serializer=JsonSerializer(), skip_cache_func=is_preloaded)
+async def get_services(url_self, preloaded=True):
+    """Return service urls.
+
+    Until the catalogue is first fetched, the snapshot loaded at startup is served as is. If it was
+    loaded before fork, it is shared by all workers instead of each worker deserializing a copy.
+    """
+    if preloaded and CATALOGUE["preloaded"] is not None:
+        return CATALOGUE["preloaded"]["services"]
     LOG.debug("Fetch service urls.")
+    start = time.monotonic()
 
     # Query Registries for their known Beacon services, fetch only URLs
     service_urls = set()
@@ -86,9 +163,80 @@ async def get_services(url_self):
     service_urls = [await process_url(url) for url in service_urls]
     service_urls = await remove_self(url_self, service_urls)
 
+    if service_urls:
+        # Persist catalogue for fast startup and for registry outages
+        await asyncio.get_event_loop().run_in_executor(None, save_catalogue_snapshot, url_self, service_urls)
+    elif (snapshot := load_catalogue_snapshot()) is not None:
+        LOG.warning("No services received from registries, using catalogue snapshot.")
+        service_urls = snapshot["services"]
+
+    # The fetched catalogue is cached from now on
+    CATALOGUE["preloaded"] = None
+
+    # Refresh filtering terms of the new catalogue in the background
+    FILTERING_TERMS["task"] = asyncio.ensure_future(harvest_filtering_terms(service_urls))
+
+    METRICS.set("aggregator_catalogue_services", len(service_urls))
+    METRICS.observe("aggregator_catalogue_refresh_duration_seconds", time.monotonic() - start)
     return service_urls
 
 
+def load_catalogue_snapshot():
+    """Load the last successfully fetched catalogue from file, if there is one."""
+    if not CONFIG.catalogue_snapshot or not os.path.isfile(CONFIG.catalogue_snapshot):
+        return None
+    try:
+        with open(CONFIG.catalogue_snapshot, "r") as contents:
+            return ujson.loads(contents.read())
+    except Exception as e:
+        LOG.error("Error at loading catalogue snapshot: %s.", e)
+        return None
+
+
+def save_catalogue_snapshot(url_self, services):
+    """Save catalogue to file.
+
+    The file is written under a temporary name and then renamed, so workers never read a partial file.
+    """
+    if not CONFIG.catalogue_snapshot:
+        return
+    temporary = f"{CONFIG.catalogue_snapshot}.{os.getpid()}"
+    try:
+        if os.path.dirname(CONFIG.catalogue_snapshot):
+            os.makedirs(os.path.dirname(CONFIG.catalogue_snapshot), exist_ok=True)
+        with open(temporary, "w") as contents:
+            contents.write(ujson.dumps({"host": url_self, "services": services}, escape_forward_slashes=False))
+        os.replace(temporary, CONFIG.catalogue_snapshot)
+    except Exception as e:
+        LOG.error("Error at saving catalogue snapshot: %s.", e)
+
+
+def preload_catalogue():
+    """Load catalogue snapshot and request SSL context before workers are forked.
+
+    Workers share the loaded objects copy-on-write instead of loading their own.
+    """
+    LOG.info("Preloading catalogue snapshot and request security.")
+    CATALOGUE["preloaded"] = load_catalogue_snapshot()
+    request_ssl_context()
+
+
+async def warm_start_services():
+    """Serve catalogue snapshot, so that queries can be served immediately after startup.
+
+    An up-to-date catalogue is then fetched from registries in the background.
+    """
+    # The snapshot preloaded before fork is outdated after the first invalidation, workers
+    # forked later, e.g. to replace a worker that exited, load the latest one instead
+    if CATALOGUE["preloaded"] is None or CATALOGUE["generation"] != CACHE_GENERATION.value:
+        CATALOGUE["preloaded"] = load_catalogue_snapshot()
+    if CATALOGUE["preloaded"] is None:
+        LOG.debug("No catalogue snapshot found.")
+        return
+    LOG.info("Loaded catalogue snapshot of %s services.", len(CATALOGUE["preloaded"]["services"]))
+    asyncio.ensure_future(get_services(CATALOGUE["preloaded"]["host"], preloaded=False, cache_read=False))
+
+
 async def process_url(url):
     """Process URLs to the desired form.
 
@@ -104,7 +252,7 @@ async def process_url(url):
     if url[1] == 2:
         query_endpoints = ["individuals", "g_variants", "biosamples", "runs", "analyses", "interactors", "cohorts", "filtering_terms"]
 
-    LOG.debug(f"Using endpoint {query_endpoints}")
+    LOG.debug("Using endpoint %s", query_endpoints)
     urls = []
     # Add endpoint
     if url[0].endswith("/"):
@@ -182,7 +330,7 @@ async def pre_process_payload(version, params):
 
     This function serves as a translator between Beacon 1.0 and 2.0 specifications.
     """
-    LOG.debug(f"Processing payload for version {str(version)}.")
+    LOG.debug("Processing payload for version %s.", version)
 
     # parse the query string into a dict
     raw_data = dict(parse.parse_qsl(params))
@@ -267,10 +415,56 @@ async def find_query_endpoint(service, params):
                     return endpoint
 
 
-async def _service_response(response, ws):
-    """Process response to web socket or HTTP."""
-    result = await response.json()
-    LOG.debug(f"result: {result}")
+def parse_projection(fields):
+    """Parse comma separated field paths into a projection tree.
+
+    e.g. `exists,datasetAlleleResponses.datasetId` -> {"exists": {}, "datasetAlleleResponses": {"datasetId": {}}}
+    """
+    projection = {}
+    for path in fields.split(","):
+        node = projection
+        for key in filter(None, path.strip().split(".")):
+            node = node.setdefault(key, {})
+    return projection
+
+
+def project(result, projection):
+    """Keep only the fields of projection in result.
+
+    Projections apply to each item of a list, and an empty projection keeps everything.
+    """
+    if not projection:
+        return result
+    if isinstance(result, list):
+        return [project(item, projection) for item in result]
+    if isinstance(result, dict):
+        return {key: project(result[key], sub_projection) for key, sub_projection in projection.items() if key in result}
+    return result
+
+
+async def _service_response(response, ws, projection=None, cache_key=None, http_key=None, authorized=False, method="GET"):
+    """Process response to web socket or HTTP.
+
+    If an HTTP cache key is given, the response is stored as its headers allow, and a
+    304 Not Modified response to a conditional GET is answered with the stored result.
+    """
+    if response.status == 304:
+        result = HTTP_CACHE.revalidate(http_key, response.headers, authorized)
+    else:
+        with span("parse"):
+            result = await response.json()
+        if http_key is not None:
+            HTTP_CACHE.store(http_key, response.headers, result, authorized, method)
+    if cache_key is not None:
+        # Results are cached before projection, so that they can serve any projection
+        await RESULT_CACHE.set(cache_key, result)
+    return await _service_result(project(result, projection), ws)
+
+
+async def _service_result(result, ws):
+    """Return result, or send it to web socket."""
+    result = add_timing(result)  # if diagnostics are requested
+    LOG.debug("result: %s", result)
     if ws is not None:
         # If the response comes from another aggregator, it's a list, and it needs to be broken down into dicts
         if isinstance(result, list):
@@ -290,44 +484,82 @@ async def _service_response(response, ws):
         return result
 
 
-async def _get_request(session, service, params, headers, ws):
-    """Get request for 1.0 beacons."""
+async def _get_request(session, service, params, headers, ws, projection=None, cache_key=None, http_key=None, etag=None):
+    """Get request for 1.0 beacons, conditional if a stale response with an ETag is stored."""
+    if etag is not None:
+        # Ask the service to confirm that the stored response is still valid
+        headers = {**headers, "If-None-Match": etag}
     async with session.get(service[0], params=params, headers=headers, ssl=await request_security()) as response:
-        LOG.info(f"GET query to service: {service[0]}")
+        LOG.info("GET query to service: %s", service[0])
         # On successful response, forward response
-        if response.status == 200:
-            return await _service_response(response, ws)
+        if response.status == 200 or (response.status == 304 and http_key in HTTP_CACHE):
+            return await _service_response(response, ws, projection, cache_key, http_key, "Authorization" in headers)
 
         else:
             # HTTP errors
             error = {"service": service[0], "queryParams": params, "responseStatus": response.status, "exists": None}
-            LOG.error(f"Query to {service} failed: {response}.")
+            LOG.error("Query to %s failed: %s.", service, response)
             if ws is not None:
                 return await ws.send_str(ujson.dumps(error, escape_forward_slashes=False))
             else:
                 return error
 
 
-async def query_service(service, params, access_token, ws=None):
-    """Query service with params."""
+async def _http_cached_result(http_key, cache_key=None):
+    """Return fresh HTTP cached result, or None and the ETag of a stale result, if it has one."""
+    entry = HTTP_CACHE.lookup(http_key)
+    if entry is None:
+        return None, None
+    fresh, etag, result = entry
+    if fresh:
+        # The service allows its response to be reused without asking again
+        LOG.debug("Fresh HTTP cached result for %s.", http_key)
+        if cache_key is not None:
+            await RESULT_CACHE.set(cache_key, result)
+        return result, None
+    return None, etag
+
+
+@traced("query_service", kind=3)
+@timed
+async def query_service(service, params, access_token, ws=None, projection=None, cache_read=True):
+    """Query service with params.
+
+    If a projection is given, only the selected fields of a successful response are kept.
+    With cache_read=False a cached result is not used, but the new result is still cached.
+    With timing=True results include durations of the query, see diagnostics.py.
+    """
     LOG.debug("Querying service.")
-    headers = {}
+    # Ask services for compressed responses, aiohttp decompresses them transparently
+    headers = {"Accept-Encoding": "gzip, deflate" if CONFIG.compression else "identity"}
     if access_token:
         headers.update({"Authorization": f"Bearer {access_token}"})
     endpoint = await find_query_endpoint(service, params)
     # Pre-process query string into payload format
     if endpoint is not None:
+        set_attribute("service", endpoint[0])
+        # Services, and aggregators in particular, can continue the trace of this query
+        headers.update(trace_headers())
+        # Anonymous results are the same for all users, and can be cached by endpoint and canonical query
+        cache_key = f"{endpoint[0]}?{params}" if access_token is None and RESULT_CACHE.enabled else None
+        if cache_key is not None and cache_read and (result := await RESULT_CACHE.get(cache_key)) is not None:
+            LOG.debug("Cached result for %s.", cache_key)
+            return await _service_result(project(result, projection), ws)
+        http_key = HTTP_CACHE.key(endpoint[0], params, access_token) if HTTP_CACHE.enabled else None
+        result, etag = await _http_cached_result(http_key, cache_key) if http_key is not None else (None, None)
+        if result is not None:
+            return await _service_result(project(result, projection), ws)
         data = await pre_process_payload(endpoint[1], params)
-        # Query service in a session
-        async with aiohttp.ClientSession() as session:
+        # Query service in a session, duration and status of each request are recorded in metrics
+        async with aiohttp.ClientSession(trace_configs=[request_metrics(), request_timing()]) as session:
             try:
                 async with session.post(endpoint[0], json=data, headers=headers, ssl=await request_security()) as response:
-                    LOG.info(f"POST query to service: {endpoint}")
-                    # On successful response, forward response
+                    LOG.info("POST query to service: %s", endpoint)
+                    # On successful response, forward response, POST requests are never conditional
                     if response.status == 200:
-                        return await _service_response(response, ws)
+                        return await _service_response(response, ws, projection, cache_key, http_key, "Authorization" in headers, "POST")
                     elif response.status == 405:
-                        return await _get_request(session, endpoint, params, headers, ws)
+                        return await _get_request(session, endpoint, params, headers, ws, projection, cache_key, http_key, etag)
                     else:
                         # HTTP errors
                         error = {
@@ -337,16 +569,88 @@ async def query_service(service, params, access_token, ws=None):
                             "exists": None,
                         }
 
-                        LOG.error(f"Query to {service} failed: {response}.")
+                        LOG.error("Query to %s failed: %s.", service, response)
                         if ws is not None:
                             return await ws.send_str(ujson.dumps(error, escape_forward_slashes=False))
                         else:
                             return error
             except Exception as e:
-                LOG.debug(f"Query error {e}.")
+                LOG.debug("Query error %s.", e)
                 web.HTTPInternalServerError(text="An error occurred while attempting to query services.")
 
 
+def record_query(host, params, access_token):
+    """Count canonical query, so that the most popular queries can be warmed."""
+    # Results of queries with an access token are not cached, so there is nothing to warm
+    if access_token is None and RESULT_CACHE.enabled and CONFIG.warm_queries:
+        WARMING["host"] = host
+        POPULAR_QUERIES.add(params)
+
+
+async def warm_popular_queries(url_self):
+    """Refresh cached results of the most popular queries from all services."""
+    LOG.debug("Warming cached results of popular queries.")
+    queries = POPULAR_QUERIES.most_common(CONFIG.warm_queries)
+    if not queries or not RESULT_CACHE.enabled:
+        return
+
+    services = await get_services(url_self)
+    semaphore = asyncio.Semaphore(WARM_CONCURRENCY)
+
+    async def warm(service, params):
+        async with semaphore:
+            try:
+                await query_service(service, params, None, cache_read=False)
+            except Exception as e:
+                LOG.debug("Warming error %s.", e)
+
+    await asyncio.gather(*[warm(service, params) for params in queries for service in services])
+    LOG.info("Warmed %s popular queries from %s services.", len(queries), len(services))
+
+
+def process_alive(pid):
+    """Return True if a process with the given ID exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def is_warmer():
+    """Return True if this worker warms its popular queries.
+
+    Workers see results warmed by other workers only in the SQLite tier of the result cache. With it a single worker
+    warms, and another worker takes over if it has exited. Without it every worker warms its own popular queries.
+    """
+    if not RESULT_CACHE.shared:
+        return True
+    pid = os.getpid()
+    with WARMER.get_lock():
+        if WARMER.value != pid and (WARMER.value == 0 or not process_alive(WARMER.value)):
+            WARMER.value = pid
+        return WARMER.value == pid
+
+
+async def warm_cache_periodically():
+    """Warm popular queries before their cached results expire, and let past popularity fade.
+
+    Each worker counts the queries it receives, see is_warmer() for which workers warm their popular queries.
+    """
+    # Refresh well before the ttl runs out, so that popular queries are never served cold
+    interval = max(int(CONFIG.result_cache_ttl * 0.8), 1)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if WARMING["host"] is not None and is_warmer():
+                await warm_popular_queries(WARMING["host"])
+        except Exception as e:
+            LOG.error("Error at warming cached results: %s.", e)
+        POPULAR_QUERIES.decay()
+
+
 async def ws_bundle_return(result, ws):
     """Create a bundle to be returned with websocket."""
     LOG.debug("Creating websocket bundle item.")
@@ -356,6 +660,124 @@ async def ws_bundle_return(result, ws):
     return await ws.send_str(ujson.dumps(result, escape_forward_slashes=False))
 
 
+def merge_filtering_terms(responses):
+    """Merge filtering terms of services into a single list, deduplicated by term id.
+
+    Each term keeps a record of the services that provided it in `beacons`.
+    """
+    LOG.debug("Merging filtering terms.")
+    terms = {}
+
+    for service_url, result in responses:
+        # Beacon 2.0 places the terms in response.filteringTerms, tolerate terms at the top level as well
+        beacon_id = result.get("meta", {}).get("beaconId") or service_url
+        for term in result.get("response", {}).get("filteringTerms") or result.get("filteringTerms") or []:
+            if not isinstance(term, dict) or not isinstance(term.get("id"), str) or not term["id"]:
+                continue
+            # Labels may be null or not strings, they are served as strings
+            label = str(term.get("label") or "")
+            if term["id"] not in terms:
+                terms[term["id"]] = {"id": term["id"], "label": label, "type": term.get("type", ""), "beacons": []}
+            elif not terms[term["id"]]["label"]:
+                terms[term["id"]]["label"] = label
+            if beacon_id not in terms[term["id"]]["beacons"]:
+                terms[term["id"]]["beacons"].append(beacon_id)
+
+    return [terms[term_id] for term_id in sorted(terms)]
+
+
+async def harvest_filtering_terms(services):
+    """Fetch filtering terms from services and replace the in-memory index.
+
+    Only services with a `filtering_terms` endpoint (Beacon 2.0) are contacted.
+    The previous index is served until the new one is complete.
+    """
+    LOG.debug("Harvesting filtering terms.")
+
+    services = [service for service in services if any("filtering_terms" in str(endpoint[0]) for endpoint in service)]
+    # Filtering terms are harvested anonymously, they are shared with all users
+    results = await asyncio.gather(*[query_service(service, "filter", None) for service in services])
+
+    responses = []
+    for service, result in zip(services, results):
+        # Failed queries return None, or an error object with responseStatus
+        if isinstance(result, dict) and "responseStatus" not in result:
+            endpoint = [endpoint for endpoint in service if "filtering_terms" in str(endpoint[0])][0]
+            responses.append((endpoint[0], result))
+
+    # Only changed terms are re-indexed, lookups keep using the old index until it is updated
+    terms = merge_filtering_terms(responses)
+    index = update_prefix_index(FILTERING_TERMS["index"], terms)
+    FILTERING_TERMS.update({"responses": [result for _, result in responses], "terms": terms, "index": index})
+    LOG.info("Harvested %s filtering terms from %s/%s services.", len(FILTERING_TERMS["terms"]), len(responses), len(services))
+
+
+async def get_filtering_terms(responses=False):
+    """Return harvested filtering terms, or the raw service responses they were merged from.
+
+    If the first harvest is still running, wait for it to complete.
+    """
+    LOG.debug("Return filtering terms from memory.")
+    task = FILTERING_TERMS["task"]
+    if task is not None and not task.done():
+        await asyncio.shield(task)
+    return FILTERING_TERMS["responses"] if responses else FILTERING_TERMS["terms"]
+
+
+async def autocomplete_filtering_terms(prefix, limit):
+    """Return filtering terms with an id, label or label word starting with prefix."""
+    LOG.debug("Search filtering terms by prefix.")
+    task = FILTERING_TERMS["task"]
+    if task is not None and not task.done():
+        await asyncio.shield(task)
+    return search_prefix_index(FILTERING_TERMS["index"], prefix, limit=limit)
+
+
+def accepted_encodings(header):
+    """Parse Accept-Encoding header into a list of accepted content codings."""
+    encodings = []
+    for item in header.lower().split(","):
+        coding, _, quality = item.partition(";")
+        # Codings with quality 0 are explicitly refused by the client
+        if quality.strip().replace(" ", "") in ["q=0", "q=0.0", "q=0.00", "q=0.000"]:
+            continue
+        encodings.append(coding.strip())
+    return encodings
+
+
+def compress(body, wbits):
+    """Compress body with the configured level, wbits select the gzip or deflate container."""
+    compressor = zlib.compressobj(CONFIG.compression_level, zlib.DEFLATED, wbits)
+    return compressor.compress(body) + compressor.flush()
+
+
+async def json_response(request, data):
+    """Return JSON response, compressed if it is large and the client accepts compression.
+
+    Compression is done in the default executor so that it doesn't block the event loop.
+    """
+    start = time.monotonic()
+    with span("serialize"):
+        body = ujson.dumps(data, escape_forward_slashes=False).encode("utf-8")
+    response = web.Response(body=body, content_type="application/json")
+    if "timing" in request:
+        # Durations of the query stages were recorded in diagnostics mode
+        response.headers["Server-Timing"] = server_timing({**request["timing"], "serialize": time.monotonic() - start})
+
+    if CONFIG.compression:
+        response.headers["Vary"] = "Accept-Encoding"
+        if len(body) >= CONFIG.compression_threshold:
+            encodings = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+            for coding, wbits in [("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)]:
+                if coding in encodings:
+                    LOG.debug("Compressing response of %s bytes with %s.", len(body), coding)
+                    response.body = await asyncio.get_event_loop().run_in_executor(None, compress, body, wbits)
+                    response.headers["Content-Encoding"] = coding
+                    break
+
+    return response
+
+
 async def validate_service_key(key):
     """Validate received service key."""
     LOG.debug("Validating service key.")
@@ -371,8 +793,33 @@ async def validate_service_key(key):
 
 
 async def clear_cache():
-    """Clear cache of Beacons."""
+    """Clear cache of Beacons, and notify other workers to clear theirs."""
+    await clear_local_cache()
+    with CACHE_GENERATION.get_lock():
+        CACHE_GENERATION.value += 1
+        CATALOGUE["generation"] = CACHE_GENERATION.value
+
+
+def cache_generation():
+    """Clear cache of Beacons if it was cleared in another worker."""
+
+    @web.middleware
+    async def cache_generation_middleware(request, handler):
+        # Reading a shared counter is cheap compared to a catalogue refresh
+        if (generation := CACHE_GENERATION.value) != CATALOGUE["generation"]:
+            LOG.debug("Cache was cleared by another worker at generation %s.", generation)
+            CATALOGUE["generation"] = generation
+            await clear_local_cache()
+        return await handler(request)
+
+    return cache_generation_middleware
+
+
+async def clear_local_cache():
+    """Clear cache of Beacons in this worker."""
     LOG.debug("Check if cache of Beacons exists.")
+    # The snapshot loaded at startup is outdated as well
+    CATALOGUE["preloaded"] = None
 
     try:
         cache = SimpleMemoryCache()
@@ -475,6 +922,13 @@ def application_security():
 # We expect this to be used frequently
 @cached(ttl=86400, key="request_security")
 async def request_security():
+    """Return requests' SSL context, see request_ssl_context()."""
+    return request_ssl_context()
+
+
+# Loaded once per process, or once before fork with preload_catalogue()
+@lru_cache(maxsize=None)
+def request_ssl_context():
     """Determine requests' level of security.
 
     Security levels:
@@ -1,10 +1,84 @@
 """Validation Utilities."""
 
+from urllib import parse
+
 from aiohttp import web
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import ValidationError
 
+from ..schemas import load_schema
 from .utils import validate_service_key
 from .logging import LOG
 
+# Compiled once, the query schema is used on every incoming query
+QUERY_VALIDATOR = Draft7Validator(load_schema("query"))
+
+# Parameters whose values are case-insensitive in the Beacon specifications
+UPPERCASE_PARAMS = ["referenceBases", "alternateBases", "variantType", "includeDatasetResponses"]
+COORDINATE_PARAMS = ["start", "end", "startMin", "startMax", "endMin", "endMax"]
+# Parameters consumed by the Aggregator itself, these are not relayed to services
+AGGREGATOR_PARAMS = ["fields", "diagnostics"]
+
+
+def canonical_reference_name(name):
+    """Convert chromosome name into the form used by the Beacon specifications.
+
+    e.g. chr1 -> 1, chrx -> X, chrM -> MT
+    """
+    name = name.strip()
+    if name[:3].lower() == "chr":
+        name = name[3:]
+    name = name.upper()
+    if name == "M":
+        name = "MT"
+    return name
+
+
+def validate_coordinates(params):
+    """Check that given coordinate ranges are not inverted."""
+    pairs = [("start", "end"), ("startMin", "startMax"), ("endMin", "endMax"), ("startMin", "endMax")]
+    for low, high in pairs:
+        if low in params and high in params and int(params[low]) > int(params[high]):
+            raise web.HTTPBadRequest(text=f"Could not validate query: {low} ({params[low]}) is greater than {high} ({params[high]}).")
+
+
+async def normalize_query(query_string):
+    """Validate and canonicalize query string before it is sent to services.
+
+    Malformed queries are rejected here, instead of being forwarded to every service.
+    The returned query string has canonical values and a fixed parameter order,
+    so equal queries produce equal strings, which can be used as cache keys.
+    """
+    LOG.debug("Normalize query.")
+
+    # Blank values are dropped, they are ignored by the payload pre-processing anyway
+    pairs = [(key, value) for key, value in parse.parse_qsl(query_string) if key not in AGGREGATOR_PARAMS]
+    params = dict(pairs)
+    if len(params) < len(pairs):
+        # Services would see only one of the values, lists of values are separated with commas
+        repeated = sorted({key for key, _ in pairs if sum(other == key for other, _ in pairs) > 1})
+        raise web.HTTPBadRequest(text=f"Could not validate query: repeated parameters {', '.join(repeated)}")
+
+    if "referenceName" in params:
+        params["referenceName"] = canonical_reference_name(params["referenceName"])
+    for key in UPPERCASE_PARAMS:
+        if key in params:
+            params[key] = params[key].strip().upper()
+    for key in COORDINATE_PARAMS:
+        # isdecimal() rejects digits such as superscripts, which int() does not accept
+        if key in params and params[key].strip().isdecimal():
+            # Remove leading zeros and whitespace
+            params[key] = str(int(params[key]))
+
+    try:
+        QUERY_VALIDATOR.validate(params)
+    except ValidationError as e:
+        LOG.debug("ERROR: Could not validate query -> %s, %s", query_string, e.message)
+        raise web.HTTPBadRequest(text=f"Could not validate query: {e.message}")
+    validate_coordinates(params)
+
+    return parse.urlencode(sorted(params.items()), safe=",")
+
 
 def api_key():
     """Check if API key is valid."""
@@ -6,7 +6,7 @@ THE_PORT=${APP_PORT:="8080"}
 if [ "$BEACON_RUN_APP" = "aggregator" ]; then
     echo 'Start Beacon Network Service: Aggregator'
     # exec beacon_aggregator
-    exec gunicorn aggregator.aggregator:init_app --bind $THE_HOST:$THE_PORT --worker-class aiohttp.GunicornUVLoopWebWorker --workers 4
+    exec gunicorn aggregator.aggregator:init_app -c python:aggregator.prefork --bind $THE_HOST:$THE_PORT --worker-class aiohttp.GunicornUVLoopWebWorker --workers 4
 elif [ "$BEACON_RUN_APP" = "registry" ]; then
     echo 'Start Beacon Network Service: Registry'
     # exec beacon_registry
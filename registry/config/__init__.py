@@ -24,6 +24,11 @@ def parse_config_file(path):
         "db_name": os.environ.get("DB_NAME", config.get("app", "db_name")) or "db",
         "api_otp": bool(strtobool(os.environ.get("API_OTP", config.get("app", "api_otp")))),
         "cors": os.environ.get("APP_CORS", config.get("app", "cors")) or "*",
+        "catalogue_refresh": int(config.get("app", "catalogue_refresh", fallback=60)),
+        "key_cache_ttl": int(config.get("app", "key_cache_ttl", fallback=30)),
+        "update_workers": int(config.get("app", "update_workers", fallback=5)),
+        "update_timeout": int(config.get("app", "update_timeout", fallback=30)),
+        "migrate": bool(strtobool(config.get("app", "migrate", fallback="True"))),
         "name": config.get("info", "name"),
         "type_group": config.get("info", "type_group"),
         "type_artifact": config.get("info", "type_artifact"),
@@ -13,13 +13,61 @@ CREATE TABLE IF NOT EXISTS services (
     organization_logo VARCHAR(512),
     created_at TIMESTAMP WITH TIME ZONE,
     updated_at TIMESTAMP WITH TIME ZONE,
+    --Content hash and ETag of the last fetched service info, used to skip unchanged service infos on update
+    info_hash VARCHAR(64),
+    info_etag VARCHAR(256),
+    PRIMARY KEY (id)
+);
+
+--Services are listed and aggregators looked up by type and API version
+CREATE INDEX IF NOT EXISTS services_type_api_version ON services (type, api_version);
+
+--Deleted services are remembered, so that clients fetching catalogue changes learn of deletions
+CREATE TABLE IF NOT EXISTS deleted_services (
+    id VARCHAR(256),
+    type VARCHAR(256),
+    api_version VARCHAR(8),
+    deleted_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id)
+);
+
+--Outbox of catalogue changes, recorded in the same transaction as the change and delivered to aggregators in the background
+CREATE TABLE IF NOT EXISTS catalogue_events (
+    id BIGSERIAL,
+    service_id VARCHAR(256),
+    action VARCHAR(16),
+    created_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id)
+);
+
+--Delivery state of catalogue changes per aggregator
+CREATE TABLE IF NOT EXISTS aggregator_deliveries (
+    aggregator_id VARCHAR(256),
+    delivered_event BIGINT,
+    attempts INTEGER,
+    next_attempt_at TIMESTAMP WITH TIME ZONE,
+    last_error VARCHAR(512),
+    PRIMARY KEY (aggregator_id)
+);
+
+--Progress of background updates of service infos started at /update/services
+CREATE TABLE IF NOT EXISTS update_jobs (
+    id VARCHAR(32),
+    status VARCHAR(16),
+    total INTEGER,
+    succeeded INTEGER,
+    changed INTEGER,
+    failed VARCHAR(256)[],
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
     PRIMARY KEY (id)
 );
 
 --Services that have been registered have individual service keys that are used for self-maintenance
 --These service keys are used at PUT and DELETE /services endpoints
+--Service keys are removed with their services, and follow renamed services
 CREATE TABLE service_keys (
-    service_id VARCHAR(64),
+    service_id VARCHAR(256) REFERENCES services (id) ON UPDATE CASCADE ON DELETE CASCADE,
     service_key VARCHAR(128)
 );
 
@@ -31,8 +79,66 @@ CREATE TABLE api_keys (
     comment VARCHAR(256)
 );
 
+CREATE INDEX api_keys_api_key ON api_keys (api_key);
+
 --Admin key used to poll /update/services endpoint
 CREATE TABLE admin_keys (
     admin_key VARCHAR(64),
     comment VARCHAR(256)
 );
+
+CREATE INDEX admin_keys_admin_key ON admin_keys (admin_key);
+
+--Registry workers are notified of changes at commit, so that they update their in-memory caches
+CREATE OR REPLACE FUNCTION notify_catalogue_event() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('registry_changes', 'catalogue ' || NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS catalogue_events_notify ON catalogue_events;
+CREATE TRIGGER catalogue_events_notify AFTER INSERT ON catalogue_events
+    FOR EACH ROW EXECUTE FUNCTION notify_catalogue_event();
+
+--Keys are sent as hashes, as they are kept in memory, so that notifications don't reveal them
+CREATE OR REPLACE FUNCTION notify_key_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'service_keys' THEN
+        PERFORM pg_notify('registry_changes', 'service ' || OLD.service_id);
+    ELSIF TG_TABLE_NAME = 'api_keys' THEN
+        PERFORM pg_notify('registry_changes', 'api ' || encode(sha256(convert_to(OLD.api_key, 'UTF8')), 'hex'));
+    ELSE
+        PERFORM pg_notify('registry_changes', 'admin ' || encode(sha256(convert_to(OLD.admin_key, 'UTF8')), 'hex'));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS service_keys_notify ON service_keys;
+CREATE TRIGGER service_keys_notify AFTER UPDATE OR DELETE ON service_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_key_change();
+DROP TRIGGER IF EXISTS api_keys_notify ON api_keys;
+CREATE TRIGGER api_keys_notify AFTER UPDATE OR DELETE ON api_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_key_change();
+DROP TRIGGER IF EXISTS admin_keys_notify ON admin_keys;
+CREATE TRIGGER admin_keys_notify AFTER UPDATE OR DELETE ON admin_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_key_change();
+
+--Versions of registry/db/migrations included above, so that they are not applied to a new database
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER,
+    name VARCHAR(256),
+    applied_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (version)
+);
+
+INSERT INTO schema_migrations (version, name, applied_at) VALUES
+    (1, 'deleted_services', NOW()),
+    (2, 'key_indexes', NOW()),
+    (3, 'update_jobs', NOW()),
+    (4, 'service_info_state', NOW()),
+    (5, 'outbox', NOW()),
+    (6, 'notifications', NOW()),
+    (7, 'performance_indexes', NOW())
+    ON CONFLICT (version) DO NOTHING;
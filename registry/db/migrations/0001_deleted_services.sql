@@ -0,0 +1,8 @@
+--Deleted services are remembered, so that clients fetching catalogue changes learn of deletions
+CREATE TABLE IF NOT EXISTS deleted_services (
+    id VARCHAR(256),
+    type VARCHAR(256),
+    api_version VARCHAR(8),
+    deleted_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id)
+);
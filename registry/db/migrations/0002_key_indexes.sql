@@ -0,0 +1,3 @@
+--Keys are looked up on every authenticated request
+CREATE INDEX IF NOT EXISTS api_keys_api_key ON api_keys (api_key);
+CREATE INDEX IF NOT EXISTS admin_keys_admin_key ON admin_keys (admin_key);
@@ -0,0 +1,11 @@
+--Progress of background updates of service infos started at /update/services
+CREATE TABLE IF NOT EXISTS update_jobs (
+    id VARCHAR(32),
+    status VARCHAR(16),
+    total INTEGER,
+    succeeded INTEGER,
+    failed VARCHAR(256)[],
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id)
+);
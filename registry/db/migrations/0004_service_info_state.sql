@@ -0,0 +1,6 @@
+--Content hash and ETag of the last fetched service info, used to skip unchanged service infos on update
+ALTER TABLE services ADD COLUMN IF NOT EXISTS info_hash VARCHAR(64);
+ALTER TABLE services ADD COLUMN IF NOT EXISTS info_etag VARCHAR(256);
+
+--Number of services whose service info changed in an update
+ALTER TABLE update_jobs ADD COLUMN IF NOT EXISTS changed INTEGER;
@@ -0,0 +1,18 @@
+--Outbox of catalogue changes, recorded in the same transaction as the change and delivered to aggregators in the background
+CREATE TABLE IF NOT EXISTS catalogue_events (
+    id BIGSERIAL,
+    service_id VARCHAR(256),
+    action VARCHAR(16),
+    created_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (id)
+);
+
+--Delivery state of catalogue changes per aggregator
+CREATE TABLE IF NOT EXISTS aggregator_deliveries (
+    aggregator_id VARCHAR(256),
+    delivered_event BIGINT,
+    attempts INTEGER,
+    next_attempt_at TIMESTAMP WITH TIME ZONE,
+    last_error VARCHAR(512),
+    PRIMARY KEY (aggregator_id)
+);
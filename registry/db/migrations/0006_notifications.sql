@@ -0,0 +1,35 @@
+--Registry workers are notified of changes at commit, so that they update their in-memory caches
+CREATE OR REPLACE FUNCTION notify_catalogue_event() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('registry_changes', 'catalogue ' || NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS catalogue_events_notify ON catalogue_events;
+CREATE TRIGGER catalogue_events_notify AFTER INSERT ON catalogue_events
+    FOR EACH ROW EXECUTE FUNCTION notify_catalogue_event();
+
+--Keys are sent as hashes, as they are kept in memory, so that notifications don't reveal them
+CREATE OR REPLACE FUNCTION notify_key_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'service_keys' THEN
+        PERFORM pg_notify('registry_changes', 'service ' || OLD.service_id);
+    ELSIF TG_TABLE_NAME = 'api_keys' THEN
+        PERFORM pg_notify('registry_changes', 'api ' || encode(sha256(convert_to(OLD.api_key, 'UTF8')), 'hex'));
+    ELSE
+        PERFORM pg_notify('registry_changes', 'admin ' || encode(sha256(convert_to(OLD.admin_key, 'UTF8')), 'hex'));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS service_keys_notify ON service_keys;
+CREATE TRIGGER service_keys_notify AFTER UPDATE OR DELETE ON service_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_key_change();
+DROP TRIGGER IF EXISTS api_keys_notify ON api_keys;
+CREATE TRIGGER api_keys_notify AFTER UPDATE OR DELETE ON api_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_key_change();
+DROP TRIGGER IF EXISTS admin_keys_notify ON admin_keys;
+CREATE TRIGGER admin_keys_notify AFTER UPDATE OR DELETE ON admin_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_key_change();
@@ -0,0 +1,14 @@
+--Services are listed and aggregators looked up by type and API version
+CREATE INDEX IF NOT EXISTS services_type_api_version ON services (type, api_version);
+
+--Service keys are removed with their services, and follow renamed services, keys of services that no longer exist are dropped first
+DELETE FROM service_keys WHERE service_id NOT IN (SELECT id FROM services);
+ALTER TABLE service_keys ALTER COLUMN service_id TYPE VARCHAR(256);
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'service_keys_service_id_fkey') THEN
+        ALTER TABLE service_keys ADD CONSTRAINT service_keys_service_id_fkey
+            FOREIGN KEY (service_id) REFERENCES services (id) ON UPDATE CASCADE ON DELETE CASCADE;
+    END IF;
+END;
+$$;
@@ -0,0 +1,99 @@
+"""Catalogue Change Feed Endpoint.
+
+Changes of the service catalogue are streamed at GET /changes as Server-Sent Events, so that
+aggregators can apply them to their copy of the catalogue instead of fetching it again. The ID of
+each event is the sequence number of the change, and the stream resumes after the sequence number
+given in the `since` parameter or in the `Last-Event-ID` header. Clients start from the sequence
+number sent with GET /services. Changes are kept for a week, older sequence numbers are answered
+with 410 Gone, and the client has to fetch the catalogue again.
+
+Subscribers read new changes from the database only when the catalogue has changed. Writes through
+this worker wake them immediately, and changes made through other workers when the database
+notifies this worker of them, see notifications.py.
+"""
+
+import asyncio
+import ujson
+
+import uvloop
+
+from aiohttp import web
+
+from ..utils.db_ops import db_get_event_range, db_get_events
+from ..utils.logging import LOG
+
+asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+# Seconds between keep-alive comments on an idle event stream, proxies may close silent connections
+HEARTBEAT = 15
+
+# Maximum number of changes read from the database at once
+BATCH_SIZE = 500
+
+# Event of the next change, shared by all subscribers of this worker
+FEED = {"changed": None}
+
+
+def next_change():
+    """Return event that is set at the next change of the catalogue."""
+    if FEED["changed"] is None:
+        FEED["changed"] = asyncio.Event()
+    return FEED["changed"]
+
+
+def notify_subscribers():
+    """Wake subscribers to read new changes."""
+    if FEED["changed"] is not None:
+        FEED["changed"].set()
+        FEED["changed"] = None
+
+
+def parse_sequence(request):
+    """Return sequence number to resume after, the header of a reconnecting event source takes precedence."""
+    value = request.headers.get("Last-Event-ID", request.query.get("since"))
+    if value is None:
+        raise web.HTTPBadRequest(text='Missing parameter "since", use the Catalogue-Sequence header of GET /services.')
+    try:
+        sequence = int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f'Invalid sequence number "{value}".')
+    if sequence < 0:
+        raise web.HTTPBadRequest(text=f'Invalid sequence number "{value}".')
+    return sequence
+
+
+def change_event(change):
+    """Format change as a Server-Sent Event, removed services are sent with their ID only."""
+    data = change["service"] if change["action"] != "deleted" else {"id": change["id"]}
+    return f"event: {change['action']}\nid: {change['sequence']}\ndata: {ujson.dumps(data, escape_forward_slashes=False)}\n\n".encode("utf-8")
+
+
+async def stream_changes(request, db_pool):
+    """Stream changes after the requested sequence number, and then new changes as they happen."""
+    LOG.debug("Stream catalogue changes.")
+    since = parse_sequence(request)
+    async with db_pool.acquire() as connection:
+        oldest, latest = await db_get_event_range(connection)
+    # Sequence numbers beyond the latest one belong to another database
+    if since > latest or since < oldest - 1:
+        raise web.HTTPGone(text="Changes since the sequence number are no longer available, fetch the catalogue again.")
+
+    # X-Accel-Buffering disables buffering at nginx reverse proxies
+    stream = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    await stream.prepare(request)
+    while True:
+        # Taken before reading, so that a change committed meanwhile is not missed
+        changed = next_change()
+        async with db_pool.acquire() as connection:
+            changes = await db_get_events(connection, since, BATCH_SIZE)
+        for change in changes:
+            # Changes of services that no longer exist are followed by their deletion
+            if change["action"] == "deleted" or change["service"] is not None:
+                await stream.write(change_event(change))
+            since = change["sequence"]
+        if len(changes) == BATCH_SIZE:
+            continue
+        try:
+            await asyncio.wait_for(changed.wait(), HEARTBEAT)
+        except asyncio.TimeoutError:
+            await stream.write(b": heartbeat\n\n")
@@ -6,7 +6,8 @@ from aiohttp import web
 
 from ..config import CONFIG
 from ..utils.logging import LOG
-from ..utils.db_ops import db_check_service_id, db_register_service, db_get_service_details
+from ..utils.db_ops import db_check_service_id, db_register_service
+from ..utils.catalogue import get_catalogue, parse_timestamp
 from ..utils.db_ops import db_update_sequence, db_delete_services, db_delete_api_key
 from ..utils.utils import http_request_info, generate_service_id, parse_service_info, query_params
 
@@ -61,16 +62,27 @@ async def register_service(request, db_pool):
 
 
 async def get_services(request, db_pool):
-    """Return service details."""
+    """Return service details as JSON encoded bytes."""
     LOG.debug("Return services.")
 
     # Parse query params from path
     service_id, params = await query_params(request)
 
-    # Take connection from the database pool
-    async with db_pool.acquire() as connection:
-        # Fetch services from database
-        response = await db_get_service_details(connection, id=service_id, service_type=params.get("type", None), api_version=params.get("apiVersion", None))
+    # Only services changed and deleted after this time are returned, if given
+    updated_since = None
+    if params.get("updatedSince", None) is not None:
+        updated_since = parse_timestamp(params["updatedSince"])
+        if updated_since is None:
+            raise web.HTTPBadRequest(text="Parameter updatedSince must be an ISO 8601 timestamp.")
+
+    # Services are read from the in-memory catalogue snapshot, the database is only read when it is rebuilt
+    response = await get_catalogue(
+        db_pool,
+        service_id=service_id,
+        service_type=params.get("type", None),
+        api_version=params.get("apiVersion", None),
+        updated_since=updated_since,
+    )
 
     return response
 
@@ -1,55 +1,147 @@
-"""Update Endpoint."""
+"""Update Endpoint.
+
+Service infos of all registered services are updated in a background job, so that the request
+starting it returns immediately. A limited number of workers request the service infos through
+a shared session, so that the database connection pool is not exhausted. Progress of the job
+is kept in the database, so that it can be read from any worker.
+
+Service infos are requested conditionally with the ETag of the previous response, and their
+content hash is compared to the previous one, so that unchanged service infos are neither
+parsed nor written. Aggregators are only notified if a service info changed.
+"""
+
+import hashlib
 
 import asyncio
+import time
+import uuid
+import ujson
+
+import aiohttp
 import uvloop
 
-from ..utils.db_ops import db_get_service_details, db_update_service
-from ..utils.utils import parse_service_info, http_request_info
+from ..config import CONFIG
+from ..utils.catalogue import refresh_catalogue
+from ..utils.db_ops import db_get_service_info_states, db_refresh_service, db_save_service_info_state
+from ..utils.db_ops import db_create_update_job, db_save_update_job, db_get_update_job
+from ..utils.utils import parse_service_info, http_request_info_changes
+from ..utils.outbox import wake_dispatcher
+from .changes import notify_subscribers
 from ..utils.logging import LOG
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
+# Seconds between saves of job progress
+PROGRESS_INTERVAL = 1
+
+# Update job started by this worker, a new job is not started while it is running
+RUNNING = {"id": None, "task": None}
 
-async def update_service_infos(request, db_pool):
-    """Update service infos for registered services."""
-    LOG.debug("Update service infos for registered services.")
 
-    tasks = []
-    failures = []
-    services = []
+async def start_update_job(db_pool):
+    """Start updating service infos in the background, and return the job ID."""
+    LOG.debug("Start update job.")
+    if RUNNING["task"] is not None and not RUNNING["task"].done():
+        return RUNNING["id"]
+    job_id = uuid.uuid4().hex
+    async with db_pool.acquire() as connection:
+        await db_create_update_job(connection, job_id)
+    RUNNING["id"], RUNNING["task"] = job_id, asyncio.ensure_future(update_job(job_id, db_pool))
+    return job_id
+
 
+async def get_update_job(request, db_pool):
+    """Return progress of an update job."""
+    LOG.debug("Return progress of update job.")
     async with db_pool.acquire() as connection:
-        # Get a listing of all registered services
-        services = await db_get_service_details(connection)
+        return await db_get_update_job(connection, request.match_info["job_id"])
 
-        # Generate async task queue
-        for service in services:
-            task = asyncio.ensure_future(update_sequence(service, db_pool))
-            tasks.append(task)
 
-    # Initiate async queue
-    results = await asyncio.gather(*tasks)
-    # Filter successes away
-    failures = [service for service in results if service is not None]
+async def update_job(job_id, db_pool):
+    """Update service infos, and record the outcome of the job."""
+    job = {"id": job_id, "total": 0, "succeeded": 0, "changed": 0, "failed": [], "saved": time.monotonic()}
+    status = "finished"
+    try:
+        fail, total = await update_service_infos(db_pool, job)
+        LOG.info("Update job %s finished with %s successful update(s) and %s failed update(s).", job_id, total - fail, fail)
+    except Exception as e:
+        LOG.error("Update job %s failed: %s.", job_id, e)
+        status = "error"
+    try:
+        async with db_pool.acquire() as connection:
+            await db_save_update_job(connection, job, status=status)
+        if job["changed"]:
+            # Rebuild catalogue snapshot served at GET /services in the background, and notify aggregators and change feed subscribers
+            refresh_catalogue(db_pool)
+            wake_dispatcher()
+            notify_subscribers()
+    except Exception as e:
+        LOG.error("Error at finishing update job %s: %s.", job_id, e)
 
-    LOG.debug(f"Failed updates: {failures}.")
+
+async def update_service_infos(db_pool, job):
+    """Update service infos for registered services."""
+    LOG.debug("Update service infos for registered services.")
+
+    async with db_pool.acquire() as connection:
+        # Get a listing of all registered services with the state of their last fetched service infos
+        services = await db_get_service_info_states(connection)
+        job["total"] = len(services)
+        await db_save_update_job(connection, job)
+
+    # Workers take services from the queue until it is empty
+    queue = asyncio.Queue()
+    for service in services:
+        queue.put_nowait(service)
+    async with aiohttp.ClientSession() as session:
+        workers = [asyncio.ensure_future(update_worker(queue, session, db_pool, job)) for _ in range(min(CONFIG.update_workers, len(services)))]
+        await asyncio.gather(*workers)
+
+    LOG.debug("Failed updates: %s.", job["failed"])
     # Return fails and total
-    return len(failures), len(services)
+    return len(job["failed"]), len(services)
 
 
-async def update_sequence(service, db_pool):
-    """Update sequence tasks."""
+async def update_worker(queue, session, db_pool, job):
+    """Update services from the queue, and record progress."""
+    while not queue.empty():
+        service = queue.get_nowait()
+        try:
+            changed = await asyncio.wait_for(update_sequence(service, db_pool, session), CONFIG.update_timeout)
+        except asyncio.TimeoutError:
+            LOG.error("Update timed out for %s.", service["id"])
+            job["failed"].append(service["id"])
+        except Exception as e:
+            LOG.error("Update failed for %s: %s.", service["id"], e)
+            job["failed"].append(service["id"])
+        else:
+            job["succeeded"] += 1
+            job["changed"] += changed
+        if time.monotonic() - job["saved"] > PROGRESS_INTERVAL:
+            job["saved"] = time.monotonic()
+            async with db_pool.acquire() as connection:
+                await db_save_update_job(connection, job)
+
+
+async def update_sequence(service, db_pool, session):
+    """Update service info of a service, and return True if it changed."""
     LOG.debug("Updating service info.")
 
-    try:
-        # Request service info from given url
-        service_info = await http_request_info(service["url"])
-        # Parse and validate service info object
-        req = {"url": service["url"]}
-        parsed_service_info = await parse_service_info(service["id"], service_info, req=req)
-        # Update service info
-        async with db_pool.acquire() as connection:
-            await db_update_service(connection, service["id"], parsed_service_info)
-    except Exception as e:
-        LOG.error(f'Update failed for {service["id"]}: {e}.')
-        return service["id"]
+    # Request service info from given url, unless it has not changed since the previous request
+    content, etag = await http_request_info_changes(service["url"], session, service["info_etag"])
+    if content is None:
+        LOG.debug("Service info of %s has not been modified.", service["id"])
+        return False
+    info_hash = hashlib.sha256(content).hexdigest()
+    if info_hash == service["info_hash"]:
+        LOG.debug("Service info of %s is unchanged.", service["id"])
+        if etag != service["info_etag"]:
+            async with db_pool.acquire() as connection:
+                await db_save_service_info_state(connection, service["id"], info_hash, etag)
+        return False
+    # Parse and validate service info object
+    req = {"url": service["url"]}
+    parsed_service_info = await parse_service_info(service["id"], ujson.loads(content), req=req)
+    # Update service info, the update time is only changed if the parsed service info changed
+    async with db_pool.acquire() as connection:
+        return await db_refresh_service(connection, service["id"], parsed_service_info, info_hash, etag)
@@ -1,6 +1,7 @@
 """Beacon Registry API."""
 
 import sys
+import asyncio
 import ujson
 
 import aiohttp_cors
@@ -15,11 +16,17 @@ from .endpoints.services import (
     update_service,
     delete_services,
 )
-from .endpoints.update import update_service_infos
+from .utils.catalogue import CATALOGUE, catalogue_headers, ensure_catalogue, etag_matches, refresh_catalogue
+from .endpoints.update import start_update_job, get_update_job
+from .endpoints.changes import stream_changes, notify_subscribers
 from .schemas import load_schema
-from .utils.utils import invalidate_aggregator_caches, application_security
+from .utils.utils import application_security
+from .utils.outbox import dispatch_periodically, wake_dispatcher
+from .utils.notifications import listen
 from .utils.validate import validate, api_key
 from .utils.db_pool import init_db_pool
+from .utils.migrations import migrate_database
+from .utils.statements import report_statistics, report_statistics_periodically
 from .utils.logging import LOG
 from .config import CONFIG
 
@@ -64,8 +71,12 @@ async def services_post(request):
     # Send request for processing
     response = await register_service(request, db_pool)
 
-    # Notify aggregators of changed service catalogue
-    await invalidate_aggregator_caches(request, db_pool)
+    # Rebuild catalogue snapshot served at GET /services in the background
+    refresh_catalogue(db_pool)
+
+    # Notify aggregators and change feed subscribers of changed service catalogue in the background, the change was recorded with the write
+    wake_dispatcher()
+    notify_subscribers()
 
     # Return confirmation and service key if no problems occurred during processing
     return web.HTTPCreated(body=ujson.dumps(response, escape_forward_slashes=False), content_type="application/json")
@@ -82,11 +93,31 @@ async def services_get(request):
     # Tap into the database pool
     db_pool = request.app["pool"]
 
-    # Send request for processing
+    # Clients that already have the current catalogue version need not download it again,
+    # which is checked before the response is built
+    await ensure_catalogue(db_pool)
+    if etag_matches(request.headers.get("If-None-Match"), CATALOGUE["etag"]):
+        return web.Response(status=304, headers=catalogue_headers())
+
+    # Send request for processing, services are served from a pre-serialized snapshot
     response = await get_services(request, db_pool)
 
     # Return results
-    return web.json_response(response)
+    return web.Response(body=response, content_type="application/json", headers=catalogue_headers())
+
+
+@routes.get("/changes")
+async def changes(request):
+    """GET request to the /changes endpoint.
+
+    Stream changes of the service catalogue as Server-Sent Events.
+    """
+    LOG.debug("GET /changes received.")
+    # Tap into the database pool
+    db_pool = request.app["pool"]
+
+    # Stream is kept open until the client disconnects
+    return await stream_changes(request, db_pool)
 
 
 @routes.put("/services/{service_id}")
@@ -103,8 +134,12 @@ async def services_put(request):
     # Send request for processing
     response = await update_service(request, db_pool)
 
-    # # Notify aggregators of changed service catalogue
-    await invalidate_aggregator_caches(request, db_pool)
+    # Rebuild catalogue snapshot served at GET /services in the background
+    refresh_catalogue(db_pool)
+
+    # Notify aggregators and change feed subscribers of changed service catalogue in the background, the change was recorded with the write
+    wake_dispatcher()
+    notify_subscribers()
 
     # Return confirmation
     return web.json_response(response)
@@ -124,8 +159,12 @@ async def services_delete(request):
     # Send request for processing
     await delete_services(request, db_pool)
 
-    # Notify aggregators of changed service catalogue
-    await invalidate_aggregator_caches(request, db_pool)
+    # Rebuild catalogue snapshot served at GET /services in the background
+    refresh_catalogue(db_pool)
+
+    # Notify aggregators and change feed subscribers of changed service catalogue in the background, the change was recorded with the write
+    wake_dispatcher()
+    notify_subscribers()
 
     # Return confirmation
     return web.Response(text="Service has been deleted.")
@@ -133,20 +172,38 @@ async def services_delete(request):
 
 @routes.get("/update/services")
 async def update_services(request):
-    """Update registered service infos."""
+    """Start update of registered service infos in the background."""
     LOG.debug("GET /update/services received.")
     # Tap into the database pool
     db_pool = request.app["pool"]
 
-    # Notify aggregators of changed service catalogue
-    fail, total = await update_service_infos(request, db_pool)
+    # Service infos are updated in a background job, which also rebuilds the catalogue snapshot
+    job_id = await start_update_job(db_pool)
 
-    # Return confirmation
-    return web.Response(text=f"{total - fail} successful update(s). {fail} failed update(s).")
+    # Return job ID and the location of its progress
+    location = f"/update/services/{job_id}"
+    return web.json_response({"jobId": job_id, "location": location}, status=202, headers={"Location": location})
+
+
+@routes.get("/update/services/{job_id}")
+async def update_services_status(request):
+    """Return progress of an update of service infos."""
+    LOG.debug("GET /update/services/{job_id} received.")
+    # Tap into the database pool
+    db_pool = request.app["pool"]
+
+    # Send request for processing
+    response = await get_update_job(request, db_pool)
+
+    # Return progress
+    return web.json_response(response)
 
 
 async def init_db(app):
     """Initialise a database connection pool."""
+    if CONFIG.migrate:
+        # Applied before the pool is created, as its connections prepare statements of the current schema
+        await migrate_database()
     LOG.info("Creating database connection pool.")
     app["pool"] = await init_db_pool(
         host=CONFIG.db_host,
@@ -163,6 +220,37 @@ async def close_db(app):
     await app["pool"].close()
 
 
+async def start_statistics(app):
+    """Start reporting database statement statistics."""
+    app["statistics"] = asyncio.ensure_future(report_statistics_periodically())
+
+
+async def stop_statistics(app):
+    """Stop reporting, and report statistics since the previous report."""
+    app["statistics"].cancel()
+    report_statistics()
+
+
+async def start_dispatcher(app):
+    """Start delivering catalogue changes to aggregators."""
+    app["dispatcher"] = asyncio.ensure_future(dispatch_periodically(app["pool"]))
+
+
+async def stop_dispatcher(app):
+    """Stop delivering catalogue changes, undelivered changes are delivered by other workers or after restart."""
+    app["dispatcher"].cancel()
+
+
+async def start_listener(app):
+    """Start listening to database notifications of changes made through other workers."""
+    app["listener"] = asyncio.ensure_future(listen(app["pool"]))
+
+
+async def stop_listener(app):
+    """Stop listening to database notifications."""
+    app["listener"].cancel()
+
+
 def set_cors(app):
     """Set CORS rules."""
     LOG.debug("Applying CORS rules.")
@@ -198,6 +286,12 @@ async def init_app():
         set_cors(app)
     app.on_startup.append(init_db)
     app.on_cleanup.append(close_db)
+    app.on_startup.append(start_statistics)
+    app.on_cleanup.append(stop_statistics)
+    app.on_startup.append(start_dispatcher)
+    app.on_cleanup.append(stop_dispatcher)
+    app.on_startup.append(start_listener)
+    app.on_cleanup.append(stop_listener)
     return app
 
 
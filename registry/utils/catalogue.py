@@ -0,0 +1,171 @@
+"""Pre-Serialized Service Catalogue.
+
+The catalogue is read from the database once, and kept in memory as JSON encoded bytes
+for every combination of the `type` and `apiVersion` filters and for every service ID,
+so that GET /services is served without database queries or JSON encoding.
+The catalogue is rebuilt when services are changed, and periodically, so that changes
+made through other workers are seen.
+
+The catalogue version is derived from the latest update and deletion of services, so that
+all workers agree on it. It is sent as an ETag, and clients that already have the current
+catalogue receive 304 Not Modified. Clients may also fetch only the services changed and
+deleted since they last fetched the catalogue with the `updatedSince` parameter.
+
+The sequence number of the latest catalogue event included in the catalogue is sent along, so
+that clients can follow further changes from it at GET /changes. Workers are notified of changes
+made through other workers by the database, and rebuild their catalogue unless it already
+includes the change, see notifications.py.
+"""
+
+import time
+import asyncio
+import hashlib
+import ujson
+
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from ..config import CONFIG
+from .logging import LOG
+from .db_ops import db_get_service_details, db_get_deleted_services, db_get_latest_event
+
+CATALOGUE = {"built": 0.0, "task": None, "builds": 0, "applied": 0, "filters": {}, "ids": {}, "services": [], "deleted": [], "etag": None, "sequence": None}
+
+
+def serialize(data):
+    """Return data as JSON encoded bytes."""
+    return ujson.dumps(data, escape_forward_slashes=False).encode("utf-8")
+
+
+def parse_timestamp(value):
+    """Parse ISO 8601 timestamp into an aware datetime, timestamps without offset are in UTC, return None if invalid."""
+    try:
+        timestamp = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+
+def catalogue_etag(services, deleted):
+    """Return catalogue version as a quoted ETag."""
+    updated = max((service["updatedAt"] for service in services), default="")
+    removed = max((service["deletedAt"] for service in deleted), default="")
+    version = f"{updated}|{removed}|{len(services)}|{len(deleted)}"
+    return '"' + hashlib.sha256(version.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(header, etag):
+    """Return True if If-None-Match header value matches the ETag."""
+    if not header or etag is None:
+        return False
+    # Weak comparison, as required for If-None-Match
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def index_catalogue(services):
+    """Group services by filter combinations and by ID, and serialize each group."""
+    filters = {}
+    for service in services:
+        service_type, api_version = service["type"]["artifact"], service["type"]["version"]
+        # None stands for a filter that was not given
+        for key in {(None, None), (service_type, None), (None, api_version), (service_type, api_version)}:
+            filters.setdefault(key, []).append(service)
+    return {key: serialize(group) for key, group in filters.items()}, {service["id"]: serialize(service) for service in services}
+
+
+async def build_catalogue(db_pool):
+    """Read all services from database, and replace the catalogue unless a build started later already has."""
+    LOG.debug("Build catalogue snapshot.")
+    CATALOGUE["builds"] += 1
+    build = CATALOGUE["builds"]
+    async with db_pool.acquire() as connection:
+        # Read before the services, events up to it are committed and thus included in the services read after
+        sequence = await db_get_latest_event(connection)
+        try:
+            services = await db_get_service_details(connection)
+        except web.HTTPNotFound:
+            services = []
+        deleted = await db_get_deleted_services(connection)
+    if build < CATALOGUE["applied"]:
+        # Builds may overlap, and one that started earlier may have read the services before they were changed
+        LOG.debug("Catalogue snapshot superseded by a later build.")
+        return
+    CATALOGUE["applied"] = build
+    CATALOGUE["filters"], CATALOGUE["ids"] = index_catalogue(services)
+    CATALOGUE["services"], CATALOGUE["deleted"] = services, deleted
+    CATALOGUE["etag"] = catalogue_etag(services, deleted)
+    CATALOGUE["sequence"] = sequence
+    CATALOGUE["built"] = time.monotonic()
+    LOG.info("Catalogue snapshot built with %s services.", len(services))
+
+
+def refresh_catalogue(db_pool):
+    """Rebuild catalogue in the background after services have been changed, and return the rebuild.
+
+    A rebuild in progress may have read the services before the change, so a new one is always started.
+    Requests for the catalogue wait for it, but the request that changed the services does not.
+    """
+    CATALOGUE["task"] = asyncio.ensure_future(build_catalogue(db_pool))
+    return CATALOGUE["task"]
+
+
+async def catch_up_catalogue(db_pool, sequence):
+    """Rebuild catalogue unless it already includes the catalogue event with the given sequence number."""
+    while CATALOGUE["sequence"] is None or CATALOGUE["sequence"] < sequence:
+        # Notifications of several changes wait for the same rebuild
+        if CATALOGUE["task"] is None or CATALOGUE["task"].done():
+            CATALOGUE["task"] = asyncio.ensure_future(build_catalogue(db_pool))
+        await asyncio.shield(CATALOGUE["task"])
+
+
+def catalogue_changes(since, service_type=None, api_version=None):
+    """Return services changed and deleted after the given time, matching the filters."""
+
+    def selected(service):
+        return service_type in (None, service["type"]["artifact"]) and api_version in (None, service["type"]["version"])
+
+    def changed(timestamp):
+        # Services without a valid timestamp are always included
+        return (parsed := parse_timestamp(timestamp)) is None or parsed > since
+
+    return {
+        "services": [service for service in CATALOGUE["services"] if selected(service) and changed(service["updatedAt"])],
+        "deleted": [service for service in CATALOGUE["deleted"] if selected(service) and changed(service["deletedAt"])],
+    }
+
+
+async def ensure_catalogue(db_pool):
+    """Rebuild catalogue if it is older than the refresh interval, and wait for a rebuild in progress."""
+    if time.monotonic() - CATALOGUE["built"] > CONFIG.catalogue_refresh and (CATALOGUE["task"] is None or CATALOGUE["task"].done()):
+        CATALOGUE["task"] = asyncio.ensure_future(build_catalogue(db_pool))
+    if CATALOGUE["task"] is not None and not CATALOGUE["task"].done():
+        # Concurrent requests wait for the same rebuild, which includes the changes made before it started
+        await asyncio.shield(CATALOGUE["task"])
+
+
+def catalogue_headers():
+    """Return version and sequence number headers of the catalogue."""
+    headers = {"ETag": CATALOGUE["etag"]} if CATALOGUE["etag"] else {}
+    if CATALOGUE["sequence"] is not None:
+        # Clients follow changes of the catalogue from this sequence number at GET /changes
+        headers["Catalogue-Sequence"] = str(CATALOGUE["sequence"])
+    return headers
+
+
+async def get_catalogue(db_pool, service_id=None, service_type=None, api_version=None, updated_since=None):
+    """Return serialized services matching the filters, a single service by ID, or changes since a time."""
+    LOG.debug("Return services from catalogue snapshot.")
+    await ensure_catalogue(db_pool)
+
+    if service_id is None and updated_since is not None:
+        # Changes are requested rarely compared to the full catalogue, so they are not pre-serialized
+        return serialize(catalogue_changes(updated_since, service_type, api_version))
+    if service_id is not None:
+        body = CATALOGUE["ids"].get(service_id)
+    else:
+        body = CATALOGUE["filters"].get((service_type, api_version))
+    if body is None:
+        raise web.HTTPNotFound(text="Service(s) not found.")
+    return body
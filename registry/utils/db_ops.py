@@ -3,6 +3,8 @@
 from aiohttp import web
 
 from .logging import LOG
+from .key_cache import KEY_CACHE
+from .statements import SERVICE_FILTERS, run, service_details
 from .utils import construct_json, generate_service_key
 
 
@@ -11,9 +13,7 @@ async def db_check_service_id(connection, id):
     LOG.debug("Querying database for service id.")
     try:
         # Database query
-        query = """SELECT name FROM services WHERE id=$1"""
-        statement = await connection.prepare(query)
-        response = await statement.fetch(id)
+        response = await run(connection, "check_service_id", id)
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to verify availability of service ID.")
@@ -32,12 +32,7 @@ async def db_store_service_key(connection, id, service_key):
     try:
         # Database commit occurs on transaction closure
         async with connection.transaction():
-            await connection.execute(
-                """INSERT INTO service_keys (service_id, service_key)
-                                     VALUES ($1, $2)""",
-                id,
-                service_key,
-            )
+            await run(connection, "store_service_key", id, service_key)
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to store service key.")
@@ -47,7 +42,9 @@ async def db_update_service_key(connection, old_id, new_id):
     """Update stored service key's service id."""
     LOG.debug("Update service key's service id.")
     try:
-        await connection.execute("""UPDATE service_keys SET service_id=$1 WHERE service_id=$2""", new_id, old_id)
+        await run(connection, "update_service_key", new_id, old_id)
+        if new_id != old_id:
+            KEY_CACHE.discard_scope("service", old_id)
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to update service key's service id.")
@@ -57,7 +54,8 @@ async def db_delete_service_key(connection, id):
     """Delete stored service key."""
     LOG.debug("Delete service key.")
     try:
-        await connection.execute("""DELETE FROM service_keys WHERE service_id=$1""", id)
+        await run(connection, "delete_service_key", id)
+        KEY_CACHE.discard_scope("service", id)
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to delete service key.")
@@ -69,11 +67,9 @@ async def db_register_service(connection, service):
     try:
         # Database commit occurs on transaction closure
         async with connection.transaction():
-            await connection.execute(
-                """INSERT INTO services (id, name, type, description, url, contact_url,
-                                     api_version, service_version, environment, organization,
-                                     organization_url, organization_logo, created_at, updated_at)
-                                     VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, NOW(), NOW())""",
+            await run(
+                connection,
+                "register_service",
                 service["id"],
                 service["name"],
                 service["type"],
@@ -87,6 +83,9 @@ async def db_register_service(connection, service):
                 service["organization_url"],
                 service["organization_logo"],
             )
+            # A previously deleted service ID may be registered again
+            await run(connection, "forget_deletion", service["id"])
+            await db_record_event(connection, service["id"], "registered")
             # If service registration was successful, generate and store a service key
             service_key = await generate_service_key()
             await db_store_service_key(connection, service["id"], service_key)
@@ -102,22 +101,10 @@ async def db_get_service_details(connection, id=None, service_type=None, api_ver
     LOG.debug("Get service details.")
     services = []
 
-    # For handling prepared parameters
-    sql_id = id if id is not None else True
-    sql_service_type = service_type if service_type is not None else True
-    sql_api_version = api_version if api_version is not None else True
-
     try:
-        # Database query
-        query = f"""SELECT id, name, type, description, url, contact_url, api_version,
-                    service_version, environment, organization, organization_url,
-                    organization_logo, created_at, updated_at
-                    FROM services
-                    WHERE {'id=$1' if id is not None else '$1'}
-                    AND {'type=$2' if service_type is not None else '$2'}
-                    AND {'api_version=$3' if api_version is not None else '$3'}"""
-        statement = await connection.prepare(query)
-        response = await statement.fetch(sql_id, sql_service_type, sql_api_version)
+        # Database query, with the statement of the given filters
+        filters = {column: value for column, value in zip(SERVICE_FILTERS, (id, service_type, api_version)) if value is not None}
+        response = await run(connection, service_details(*filters), *filters.values())
         if len(response) > 0:
             for record in response:
                 # Build JSON response
@@ -137,13 +124,40 @@ async def db_get_service_details(connection, id=None, service_type=None, api_ver
     raise web.HTTPNotFound(text="Service(s) not found.")
 
 
+async def db_record_deletion(connection, id):
+    """Record deletion of service, so that catalogue changes include it."""
+    LOG.debug("Record deletion of service.")
+    await run(connection, "record_deletion", id)
+
+
+async def db_get_deleted_services(connection):
+    """Get deleted services."""
+    LOG.debug("Get deleted services.")
+    try:
+        response = await run(connection, "get_deleted_services")
+        return [
+            {
+                "id": record["id"],
+                "type": {"group": "org.ga4gh", "artifact": record["type"], "version": record["api_version"]},
+                "deletedAt": str(record["deleted_at"]),
+            }
+            for record in response
+        ]
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to get deleted services.")
+
+
 async def db_delete_services(connection, id=None):
     """Delete all or specified service(s)."""
     LOG.debug("Delete service(s).")
 
     try:
-        await connection.execute("""DELETE FROM services WHERE id=$1""", id)
-        await db_delete_service_key(connection, id)
+        async with connection.transaction():
+            await db_record_deletion(connection, id)
+            await run(connection, "delete_service", id)
+            await db_delete_service_key(connection, id)
+            await db_record_event(connection, id, "deleted")
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to delete service(s).")
@@ -162,12 +176,14 @@ async def db_update_service(connection, id, service):
 
     # Apply updates
     try:
-        await connection.execute(
-            """UPDATE services SET id=$1, name=$2, type=$3, description=$4,
-                                 url=$5, contact_url=$6, api_version=$7, service_version=$8,
-                                 environment=$9, organization=$10, organization_url=$11, organization_logo=$12,
-                                 updated_at=NOW()
-                                 WHERE id=$13""",
+        if not id == service["id"]:
+            # The old service ID disappears from the catalogue, and the new one may have been deleted before
+            await db_record_deletion(connection, id)
+            await run(connection, "forget_deletion", service["id"])
+            await db_record_event(connection, id, "deleted")
+        await run(
+            connection,
+            "update_service",
             service["id"],
             service["name"],
             service["type"],
@@ -187,6 +203,59 @@ async def db_update_service(connection, id, service):
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to update service details.")
 
 
+async def db_get_service_info_states(connection):
+    """Get URL, content hash and ETag of the last fetched service info of all services."""
+    LOG.debug("Get service info states.")
+    try:
+        response = await run(connection, "get_service_info_states")
+        return [dict(record) for record in response]
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to get service details.")
+
+
+async def db_refresh_service(connection, id, service, info_hash, info_etag):
+    """Update service from a changed service info, and return True if the parsed service info changed."""
+    LOG.debug("Refresh service.")
+    try:
+        async with connection.transaction():
+            response = await run(
+                connection,
+                "refresh_service",
+                id,
+                service["name"],
+                service["type"],
+                service["description"],
+                service["url"],
+                service["contact_url"],
+                service["api_version"],
+                service["service_version"],
+                service["environment"],
+                service["organization"],
+                service["organization_url"],
+                service["organization_logo"],
+                info_hash,
+                info_etag,
+            )
+            changed = bool(response) and response[0]["changed"]
+            if changed:
+                await db_record_event(connection, id, "updated")
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to update service details.")
+    return changed
+
+
+async def db_save_service_info_state(connection, id, info_hash, info_etag):
+    """Save content hash and ETag of an unchanged service info."""
+    LOG.debug("Save service info state.")
+    try:
+        await run(connection, "save_service_info_state", id, info_hash, info_etag)
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to update service details.")
+
+
 async def db_update_sequence(connection, id, updates):
     """Start update sequence."""
     LOG.debug("Initiate update sequence.")
@@ -197,6 +266,134 @@ async def db_update_sequence(connection, id, updates):
         await db_update_service(connection, id, updates)
         # Update service id at service_keys in case it changed
         await db_update_service_key(connection, id, updates["id"])
+        await db_record_event(connection, updates["id"], "updated")
+
+
+async def db_record_event(connection, service_id, action):
+    """Record a change of the catalogue in the outbox, within the transaction of the change."""
+    LOG.debug("Record catalogue event.")
+    await run(connection, "record_event", service_id, action)
+
+
+async def db_get_latest_event(connection):
+    """Get ID of the latest catalogue event, which is the sequence number of the catalogue."""
+    LOG.debug("Get latest catalogue event.")
+    try:
+        return (await run(connection, "get_latest_event"))[0]["id"]
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to get catalogue sequence number.")
+
+
+async def db_get_event_range(connection):
+    """Get IDs of the oldest and the latest kept catalogue event."""
+    LOG.debug("Get range of catalogue events.")
+    try:
+        record = (await run(connection, "get_event_range"))[0]
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to get catalogue changes.")
+    return record["oldest"], record["latest"]
+
+
+async def db_get_events(connection, since, limit):
+    """Get catalogue events after the given sequence number, with the current details of registered and updated services."""
+    LOG.debug("Get catalogue events.")
+    try:
+        response = await run(connection, "get_events", since, limit)
+        # Services that no longer exist have no details, they were deleted or renamed in a later event
+        return [
+            {
+                "sequence": record["sequence"],
+                "action": record["action"],
+                "id": record["service_id"],
+                "service": await construct_json(record) if record["id"] is not None else None,
+            }
+            for record in response
+        ]
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to get catalogue changes.")
+
+
+async def db_claim_deliveries(connection, lease):
+    """Claim due deliveries of catalogue changes to aggregators for lease seconds, and return them with the latest event."""
+    LOG.debug("Claim deliveries of catalogue events.")
+    try:
+        async with connection.transaction():
+            latest = (await run(connection, "get_latest_event"))[0]["id"]
+            await run(connection, "add_deliveries", latest)
+            deliveries = [dict(record) for record in await run(connection, "claim_deliveries", latest, float(lease))]
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to claim deliveries.")
+    return latest, deliveries
+
+
+async def db_complete_delivery(connection, aggregator_id, event):
+    """Record that events up to the given one have been delivered to an aggregator."""
+    LOG.debug("Complete delivery of catalogue events.")
+    await run(connection, "complete_delivery", aggregator_id, event)
+
+
+async def db_fail_delivery(connection, aggregator_id, retry_after, error):
+    """Record a failed delivery to an aggregator, to be retried after the given seconds."""
+    LOG.debug("Record failed delivery of catalogue events.")
+    await run(connection, "fail_delivery", aggregator_id, float(retry_after), error[:512])
+
+
+async def db_delete_old_events(connection):
+    """Delete events older than a week, and delivery states of removed aggregators."""
+    LOG.debug("Delete old catalogue events.")
+    async with connection.transaction():
+        await run(connection, "delete_old_events")
+        await run(connection, "delete_stale_deliveries")
+
+
+async def db_create_update_job(connection, job_id):
+    """Record a new update job, and forget jobs older than 30 days."""
+    LOG.debug("Create update job.")
+    try:
+        async with connection.transaction():
+            await run(connection, "delete_old_update_jobs")
+            await run(connection, "create_update_job", job_id)
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to create update job.")
+
+
+async def db_save_update_job(connection, job, status="running"):
+    """Save progress of an update job."""
+    LOG.debug("Save progress of update job.")
+    try:
+        await run(connection, "save_update_job", job["id"], status, job["total"], job["succeeded"], job["changed"], job["failed"])
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to save update job.")
+
+
+async def db_get_update_job(connection, job_id):
+    """Get progress of an update job."""
+    LOG.debug("Get progress of update job.")
+    try:
+        response = await run(connection, "get_update_job", job_id)
+    except Exception as e:
+        LOG.debug("DB error: %s", e)
+        raise web.HTTPInternalServerError(text="Database error occurred while attempting to get update job.")
+    if len(response) == 0:
+        raise web.HTTPNotFound(text="Update job not found.")
+    record = response[0]
+    return {
+        "jobId": record["id"],
+        "status": record["status"],
+        "total": record["total"],
+        "succeeded": record["succeeded"],
+        "changed": record["changed"],
+        "failed": list(record["failed"]),
+        "startedAt": str(record["started_at"]),
+        "finishedAt": str(record["finished_at"]) if record["finished_at"] else None,
+        "duration": round(float(record["duration"]), 3),
+    }
 
 
 async def db_verify_service_key(connection, service_id=None, service_key=None):
@@ -204,9 +401,7 @@ async def db_verify_service_key(connection, service_id=None, service_key=None):
     LOG.debug("Querying database to verify Beacon-Service-Key.")
     try:
         # Database query
-        query = """SELECT service_id FROM service_keys WHERE service_id=$1 AND service_key=$2"""
-        statement = await connection.prepare(query)
-        response = await statement.fetch(service_id, service_key)
+        response = await run(connection, "verify_service_key", service_id, service_key)
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to verify Beacon Service Key.")
@@ -222,9 +417,7 @@ async def db_verify_api_key(connection, api_key):
     LOG.debug('Querying database to verify "Authorization" API key.')
     try:
         # Database query
-        query = """SELECT comment FROM api_keys WHERE api_key=$1"""
-        statement = await connection.prepare(query)
-        response = await statement.fetch(api_key)
+        response = await run(connection, "verify_api_key", api_key)
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text='Database error occurred while attempting to verify "Authorization" API key.')
@@ -240,9 +433,7 @@ async def db_verify_admin_key(connection, api_key):
     LOG.debug('Querying database to verify "Authorization" Admin key.')
     try:
         # Database query
-        query = """SELECT comment FROM admin_keys WHERE admin_key=$1"""
-        statement = await connection.prepare(query)
-        response = await statement.fetch(api_key)
+        response = await run(connection, "verify_admin_key", api_key)
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text='Database error occurred while attempting to verify "Authorization" API key.')
@@ -260,7 +451,8 @@ async def db_delete_api_key(connection, api_key):
     """
     LOG.debug("Deleting API key.")
     try:
-        await connection.execute("""DELETE FROM api_keys WHERE api_key=$1""", api_key)
+        await run(connection, "delete_api_key", api_key)
+        KEY_CACHE.discard("api", api_key)
     except Exception as e:
         LOG.debug(f"DB error: {e}")
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to expire OTP.")
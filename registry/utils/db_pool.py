@@ -2,11 +2,14 @@
 
 import asyncpg
 
+from .statements import RegistryConnection, prepare_statements
+
 
 async def init_db_pool(host, port, user, passwd, db):
     """Create a connection pool.
 
     As we will have frequent requests to the database it is recommended to create a connection pool.
+    All registry statements are prepared when a connection is opened, see statements.py.
     """
     return await asyncpg.create_pool(
         host=host,
@@ -22,6 +25,9 @@ async def init_db_pool(host, port, user, passwd, db):
         max_queries=50000,
         timeout=120,
         command_timeout=180,
-        max_cached_statement_lifetime=0,
+        # statements prepared outside of the registry statements are cached by asyncpg
+        statement_cache_size=100,
+        connection_class=RegistryConnection,
+        init=prepare_statements,
         max_inactive_connection_lifetime=180,
     )
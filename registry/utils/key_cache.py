@@ -0,0 +1,65 @@
+"""Verified Key Cache.
+
+API, admin and service keys that have been verified against the database are remembered
+for a short time, so that bursts of authenticated requests don't cost a database query each.
+Only hashes of the keys are kept in memory. Keys are forgotten when they are deleted or their
+service is removed. Other workers forget them when the database notifies them of the change,
+see notifications.py, or at the latest once their time to live has passed.
+"""
+
+import hashlib
+import time
+
+from ..config import CONFIG
+
+# Expired entries are purged when the cache grows beyond this size
+MAX_KEYS = 10000
+
+
+class KeyCache:
+    """Remember verified keys for a limited time."""
+
+    def __init__(self, ttl):
+        """Initialise cache, a time to live of 0 disables caching."""
+        self.ttl = ttl
+        self.entries = {}  # (kind, scope, hashed key) -> expires
+
+    def entry(self, kind, key, scope=None):
+        """Return cache entry of a key, keys of services are scoped by the service ID."""
+        return kind, scope, hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def verified(self, kind, key, scope=None):
+        """Return True if key has been verified recently."""
+        if not key:
+            return False
+        return self.entries.get(self.entry(kind, key, scope), 0) > time.monotonic()
+
+    def add(self, kind, key, scope=None):
+        """Remember key as verified."""
+        if self.ttl <= 0 or not key:
+            return
+        if len(self.entries) >= MAX_KEYS:
+            now = time.monotonic()
+            self.entries = {entry: expires for entry, expires in self.entries.items() if expires > now}
+        if len(self.entries) < MAX_KEYS:
+            self.entries[self.entry(kind, key, scope)] = time.monotonic() + self.ttl
+
+    def discard(self, kind, key, scope=None):
+        """Forget key, when it is deleted."""
+        if key:
+            self.entries.pop(self.entry(kind, key, scope), None)
+
+    def discard_hashed(self, kind, hashed_key, scope=None):
+        """Forget key by its hash, when another worker deleted it."""
+        self.entries.pop((kind, scope, hashed_key), None)
+
+    def discard_scope(self, kind, scope):
+        """Forget all keys of a scope, when the service is removed or its ID changes."""
+        self.entries = {entry: expires for entry, expires in self.entries.items() if entry[:2] != (kind, scope)}
+
+    def clear(self):
+        """Forget all keys, when changes may have been missed."""
+        self.entries = {}
+
+
+KEY_CACHE = KeyCache(ttl=CONFIG.key_cache_ttl)
@@ -1,10 +1,98 @@
-"""Logging formatting."""
+"""Logging formatting.
+
+Records are put on a queue, and formatted and written by a listener thread, so that log I/O
+doesn't block the event loop. Set LOG_FORMAT=json for one JSON object per line, and sample
+debug and info records of busy modules with e.g. LOG_SAMPLING=utils=0.1,query=0.5.
+"""
 
 import os
+import atexit
+import queue
+import random
 import logging
+import logging.handlers
+import ujson
 
 from distutils.util import strtobool
 
 formatting = "[%(asctime)s][%(name)s][%(process)d %(processName)s][%(levelname)-8s] (L:%(lineno)s) %(module)s | %(funcName)s: %(message)s"
-logging.basicConfig(level=logging.DEBUG if bool(strtobool(os.environ.get("DEBUG", "False"))) else logging.INFO, format=formatting)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON objects."""
+
+    def format(self, record):
+        """Return record as a single line of JSON."""
+        data = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "process": record.process,
+            "level": record.levelname,
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return ujson.dumps(data, escape_forward_slashes=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of debug and info records of each module, warnings and errors are always kept."""
+
+    def __init__(self, rates):
+        """Initialise filter with rates as a dict of module name and fraction of records to keep."""
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        """Return True if record is kept."""
+        if record.levelno >= logging.WARNING or record.module not in self.rates:
+            return True
+        return random.random() < self.rates[record.module]  # nosec, not used for security
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without formatting them, the listener thread formats them."""
+
+    def prepare(self, record):
+        """Return record as is, message arguments are formatted only if the record is written."""
+        return record
+
+
+def parse_sampling(value):
+    """Parse sampling rates from module=rate,... format."""
+    rates = {}
+    for item in value.split(","):
+        if "=" in item:
+            module, rate = item.split("=", 1)
+            rates[module.strip()] = float(rate)
+    return rates
+
+
+def start_listener():
+    """Start writing queued records in a listener thread, also in each forked worker."""
+    global LISTENER
+    HANDLER.queue = queue.SimpleQueue()
+    LISTENER = logging.handlers.QueueListener(HANDLER.queue, OUTPUT, respect_handler_level=True)
+    LISTENER.start()
+
+
+def stop_listener():
+    """Write remaining queued records before exit."""
+    LISTENER.stop()
+
+
+OUTPUT = logging.StreamHandler()
+OUTPUT.setFormatter(JsonFormatter() if os.environ.get("LOG_FORMAT", "text").lower() == "json" else logging.Formatter(formatting))
+HANDLER = LazyQueueHandler(queue.SimpleQueue())
+HANDLER.addFilter(SamplingFilter(parse_sampling(os.environ.get("LOG_SAMPLING", ""))))
+LISTENER = None
+start_listener()
+# Threads are not copied to forked processes, e.g. gunicorn workers of a preloaded application
+os.register_at_fork(after_in_child=start_listener)
+atexit.register(stop_listener)
+
+logging.basicConfig(level=logging.DEBUG if bool(strtobool(os.environ.get("DEBUG", "False"))) else logging.INFO, handlers=[HANDLER])
 LOG = logging.getLogger("bn")
@@ -0,0 +1,83 @@
+"""Database Migrations.
+
+The schema of a new database is created by init.sql, and changes to the schema are shipped as
+numbered scripts in registry/db/migrations, which are applied once to existing databases in order
+of their number. Applied versions are recorded in the schema_migrations table, and init.sql records
+the versions it already includes, so a new migration is also added to init.sql. Scripts are written
+so that applying them again does no harm, as databases created before versions were recorded get
+all of them applied.
+
+Migrations are applied at startup by every worker, and workers starting at the same time wait for
+each other on an advisory lock. They are applied on a connection of their own, as the connections of
+the pool prepare statements of the current schema. With `migrate=False` they are applied beforehand
+with `beacon_registry_migrate`.
+"""
+
+import asyncio
+import os
+import re
+
+import asyncpg
+
+from ..config import CONFIG
+from .logging import LOG
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "db", "migrations")
+
+# Scripts are named like 0001_deleted_services.sql
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+CREATE_VERSIONS = """CREATE TABLE IF NOT EXISTS schema_migrations (
+                     version INTEGER, name VARCHAR(256), applied_at TIMESTAMP WITH TIME ZONE, PRIMARY KEY (version))"""
+
+
+def load_migrations(path=MIGRATIONS_DIR):
+    """Return version, name and script of all migrations in order of their version."""
+    migrations = []
+    for filename in os.listdir(path):
+        if (match := MIGRATION_FILE.match(filename)) is not None:
+            with open(os.path.join(path, filename), "r") as script:
+                migrations.append((int(match.group(1)), match.group(2), script.read()))
+    return sorted(migrations)
+
+
+async def migrate(connection, migrations):
+    """Apply migrations that have not been applied yet, and return their versions."""
+    applied = []
+    # Held until released, so that workers starting at the same time don't apply the same migrations
+    await connection.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+    try:
+        await connection.execute(CREATE_VERSIONS)
+        done = {record["version"] for record in await connection.fetch("SELECT version FROM schema_migrations")}
+        for version, name, script in migrations:
+            if version in done:
+                continue
+            LOG.info("Applying database migration %04d_%s.", version, name)
+            # Each migration is applied completely or not at all
+            async with connection.transaction():
+                await connection.execute(script)
+                await connection.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES ($1, $2, NOW())", version, name)
+            applied.append(version)
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+    return applied
+
+
+async def migrate_database():
+    """Apply pending migrations to the configured database."""
+    connection = await asyncpg.connect(host=CONFIG.db_host, port=CONFIG.db_port, user=CONFIG.db_user, password=CONFIG.db_pass, database=CONFIG.db_name)
+    try:
+        applied = await migrate(connection, load_migrations())
+    finally:
+        await connection.close()
+    LOG.info("Database schema is up to date, %s migration(s) applied.", len(applied))
+    return applied
+
+
+def main():
+    """Apply pending migrations from the command line."""
+    asyncio.get_event_loop().run_until_complete(migrate_database())
+
+
+if __name__ == "__main__":
+    main()
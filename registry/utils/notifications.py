@@ -0,0 +1,94 @@
+"""Database Notifications.
+
+Each worker keeps the catalogue snapshot and verified keys in memory, and change feed subscribers
+wait in it for changes. Database triggers notify all workers of changes at commit with PostgreSQL
+NOTIFY, whether the changes were made through any worker or directly in the database. Each worker
+listens on a dedicated connection, and updates its caches as soon as it is notified. The connection
+is kept outside the pool, as connections released to the pool stop listening. Notifications sent
+while the connection was lost are missed, so all caches are refreshed when it is reconnected.
+"""
+
+import asyncio
+
+import asyncpg
+
+from ..config import CONFIG
+from ..endpoints.changes import notify_subscribers
+from .catalogue import CATALOGUE, catch_up_catalogue, refresh_catalogue
+from .key_cache import KEY_CACHE
+from .logging import LOG
+from .outbox import wake_dispatcher
+
+CHANNEL = "registry_changes"
+
+# Seconds between checks that the connection is alive, a broken connection may otherwise go unnoticed
+CHECK_INTERVAL = 30
+
+# Seconds before reconnecting after a failure, doubled for every following failure up to the maximum
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+
+async def catch_up(db_pool, sequence=None):
+    """Rebuild catalogue unless it already includes the change, the whole catalogue if the change is not known."""
+    try:
+        if sequence is None:
+            await refresh_catalogue(db_pool)
+        else:
+            await catch_up_catalogue(db_pool, sequence)
+    except Exception as e:
+        LOG.error("Error at rebuilding catalogue after notification: %s.", e)
+
+
+def handle_notification(db_pool, payload):
+    """Apply a change notified by the database to the caches of this worker."""
+    LOG.debug("Database notification: %s.", payload)
+    kind, _, value = payload.partition(" ")
+    if kind == "catalogue":
+        # Subscribers and the dispatcher read the changes from the database, not from the catalogue
+        notify_subscribers()
+        wake_dispatcher()
+        asyncio.ensure_future(catch_up(db_pool, int(value)))
+    elif kind == "service":
+        KEY_CACHE.discard_scope("service", value)
+    elif kind in ("api", "admin"):
+        KEY_CACHE.discard_hashed(kind, value)
+
+
+def refresh_caches(db_pool):
+    """Refresh all caches of this worker, when notifications may have been missed."""
+    KEY_CACHE.clear()
+    notify_subscribers()
+    wake_dispatcher()
+    if CATALOGUE["sequence"] is not None:
+        asyncio.ensure_future(catch_up(db_pool))
+
+
+async def listen(db_pool):
+    """Listen to database notifications until cancelled, reconnecting when the connection is lost."""
+    failures = 0
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(host=CONFIG.db_host, port=CONFIG.db_port, user=CONFIG.db_user, password=CONFIG.db_pass, database=CONFIG.db_name)
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _: lost.set())
+            await connection.add_listener(CHANNEL, lambda _connection, _pid, _channel, payload: handle_notification(db_pool, payload))
+            LOG.info("Listening to database notifications.")
+            failures = 0
+            refresh_caches(db_pool)
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    await connection.fetchval("SELECT 1", timeout=CHECK_INTERVAL)
+            LOG.warning("Database connection for notifications was lost.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOG.error("Error at listening to database notifications: %s.", e)
+        finally:
+            if connection is not None:
+                connection.terminate()
+        await asyncio.sleep(min(RECONNECT_DELAY * 2**failures, MAX_RECONNECT_DELAY))
+        failures += 1
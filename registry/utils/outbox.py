@@ -0,0 +1,86 @@
+"""Outbox of Catalogue Changes.
+
+Changes of the service catalogue are recorded as events in the database, in the same transaction
+as the change itself, so that requests changing the catalogue don't wait for aggregators.
+A dispatcher in each worker delivers the events in the background. Aggregators clear their whole
+cache on notification, so all events pending for an aggregator are delivered with a single request.
+Failed deliveries are retried with exponential backoff, and the delivery state of each aggregator
+is kept in the database, so that workers share it and it survives restarts.
+"""
+
+import asyncio
+import time
+
+import aiohttp
+
+from .logging import LOG
+from .db_ops import db_claim_deliveries, db_complete_delivery, db_fail_delivery, db_delete_old_events
+from .utils import invalidate_cache
+
+# Seconds between checks for retries and for missed notifications, catalogue changes wake the dispatcher immediately
+DISPATCH_INTERVAL = 5
+
+# Seconds a claimed delivery is reserved for the worker that claimed it
+DELIVERY_LEASE = 60
+
+# Seconds before the first retry of a failed delivery, doubled for every following failure up to the maximum
+RETRY_BACKOFF = 5
+MAX_RETRY_BACKOFF = 3600
+
+# Seconds between deletions of old events
+CLEANUP_INTERVAL = 3600
+
+OUTBOX = {"wake": None}
+
+
+def wake_dispatcher():
+    """Deliver pending events without waiting for the next check."""
+    if OUTBOX["wake"] is not None:
+        OUTBOX["wake"].set()
+
+
+def retry_after(attempts):
+    """Return seconds to wait before retrying a delivery that has failed attempts times before."""
+    return min(RETRY_BACKOFF * 2**attempts, MAX_RETRY_BACKOFF)
+
+
+async def deliver(db_pool, session, delivery, event):
+    """Notify aggregator of events up to the given one, and record the outcome."""
+    error = await invalidate_cache(delivery, session)
+    async with db_pool.acquire() as connection:
+        if error is None:
+            await db_complete_delivery(connection, delivery["aggregator_id"], event)
+        else:
+            LOG.warning("Delivery of catalogue changes to %s failed %s time(s): %s", delivery["aggregator_id"], delivery["attempts"] + 1, error)
+            await db_fail_delivery(connection, delivery["aggregator_id"], retry_after(delivery["attempts"]), error)
+
+
+async def dispatch(db_pool, session):
+    """Deliver pending events to all aggregators that are due, and return the number of deliveries."""
+    async with db_pool.acquire() as connection:
+        latest, deliveries = await db_claim_deliveries(connection, DELIVERY_LEASE)
+    if deliveries:
+        LOG.debug("Deliver catalogue changes up to event %s to %s aggregator(s).", latest, len(deliveries))
+        await asyncio.gather(*[deliver(db_pool, session, delivery, latest) for delivery in deliveries])
+    return len(deliveries)
+
+
+async def dispatch_periodically(db_pool):
+    """Deliver pending events whenever woken up, and periodically for retries."""
+    OUTBOX["wake"] = asyncio.Event()
+    cleaned = 0.0
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DELIVERY_LEASE / 2)) as session:
+        while True:
+            try:
+                await asyncio.wait_for(OUTBOX["wake"].wait(), DISPATCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            OUTBOX["wake"].clear()
+            try:
+                await dispatch(db_pool, session)
+                if time.monotonic() - cleaned > CLEANUP_INTERVAL:
+                    cleaned = time.monotonic()
+                    async with db_pool.acquire() as connection:
+                        await db_delete_old_events(connection)
+            except Exception as e:
+                LOG.error("Error at delivering catalogue changes: %s.", e)
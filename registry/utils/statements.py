@@ -0,0 +1,172 @@
+"""Prepared Statements.
+
+All queries of the registry are prepared once per database connection when the connection pool
+opens it, so that executing them skips parsing and planning. Executions and their durations are
+counted per statement, and reported in the log periodically.
+"""
+
+import asyncio
+import itertools
+import time
+
+import asyncpg
+
+from .logging import LOG
+
+# Seconds between reports of statement statistics
+REPORT_INTERVAL = 300
+
+STATEMENTS = {
+    "check_service_id": """SELECT name FROM services WHERE id=$1""",
+    "store_service_key": """INSERT INTO service_keys (service_id, service_key) VALUES ($1, $2)""",
+    "update_service_key": """UPDATE service_keys SET service_id=$1 WHERE service_id=$2""",
+    "delete_service_key": """DELETE FROM service_keys WHERE service_id=$1""",
+    "register_service": """INSERT INTO services (id, name, type, description, url, contact_url,
+                           api_version, service_version, environment, organization,
+                           organization_url, organization_logo, created_at, updated_at)
+                           VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, NOW(), NOW())""",
+    "record_deletion": """INSERT INTO deleted_services (id, type, api_version, deleted_at)
+                          SELECT id, type, api_version, NOW() FROM services WHERE id=$1
+                          ON CONFLICT (id) DO UPDATE SET type=EXCLUDED.type, api_version=EXCLUDED.api_version, deleted_at=EXCLUDED.deleted_at""",
+    "forget_deletion": """DELETE FROM deleted_services WHERE id=$1""",
+    "get_deleted_services": """SELECT id, type, api_version, deleted_at FROM deleted_services""",
+    "delete_service": """DELETE FROM services WHERE id=$1""",
+    "update_service": """UPDATE services SET id=$1, name=$2, type=$3, description=$4,
+                         url=$5, contact_url=$6, api_version=$7, service_version=$8,
+                         environment=$9, organization=$10, organization_url=$11, organization_logo=$12,
+                         updated_at=NOW(), info_hash=NULL, info_etag=NULL
+                         WHERE id=$13""",
+    "get_service_info_states": """SELECT id, url, info_hash, info_etag FROM services""",
+    # The update time is kept if the parsed service info has not changed, so that catalogue versions don't change
+    "refresh_service": """UPDATE services SET name=$2, type=$3, description=$4,
+                          url=$5, contact_url=$6, api_version=$7, service_version=$8,
+                          environment=$9, organization=$10, organization_url=$11, organization_logo=$12,
+                          updated_at=CASE WHEN (name, type, description, url, contact_url, api_version, service_version,
+                                                environment, organization, organization_url, organization_logo)
+                                               IS DISTINCT FROM ($2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+                                          THEN NOW() ELSE updated_at END,
+                          info_hash=$13, info_etag=$14
+                          WHERE id=$1
+                          RETURNING updated_at=NOW() AS changed""",
+    "save_service_info_state": """UPDATE services SET info_hash=$2, info_etag=$3 WHERE id=$1""",
+    "verify_service_key": """SELECT service_id FROM service_keys WHERE service_id=$1 AND service_key=$2""",
+    "verify_api_key": """SELECT comment FROM api_keys WHERE api_key=$1""",
+    "verify_admin_key": """SELECT comment FROM admin_keys WHERE admin_key=$1""",
+    "delete_api_key": """DELETE FROM api_keys WHERE api_key=$1""",
+    "create_update_job": """INSERT INTO update_jobs (id, status, total, succeeded, changed, failed, started_at)
+                            VALUES ($1, 'running', 0, 0, 0, '{}', NOW())""",
+    "delete_old_update_jobs": """DELETE FROM update_jobs WHERE started_at < NOW() - INTERVAL '30 days'""",
+    "save_update_job": """UPDATE update_jobs SET status=$2, total=$3, succeeded=$4, changed=$5, failed=$6,
+                          finished_at=CASE WHEN $2='running' THEN NULL ELSE NOW() END
+                          WHERE id=$1""",
+    "get_update_job": """SELECT id, status, total, succeeded, changed, failed, started_at, finished_at,
+                         EXTRACT(EPOCH FROM COALESCE(finished_at, NOW()) - started_at) AS duration
+                         FROM update_jobs WHERE id=$1""",
+    # Writers of events are serialized until commit, so that events become visible in the order of their IDs
+    # and change feed subscribers reading past the latest ID they have seen never skip one
+    "record_event": """WITH ordered AS (SELECT pg_advisory_xact_lock(hashtext('catalogue_events')))
+                       INSERT INTO catalogue_events (service_id, action, created_at) SELECT $1, $2, NOW() FROM ordered""",
+    "get_latest_event": """SELECT COALESCE(MAX(id), 0) AS id FROM catalogue_events""",
+    "get_event_range": """SELECT COALESCE(MIN(id), 0) AS oldest, COALESCE(MAX(id), 0) AS latest FROM catalogue_events""",
+    # Services are joined as they are now, a service that changed again has a later event too
+    "get_events": """SELECT e.id AS sequence, e.action, e.service_id, s.id, s.name, s.type, s.description, s.url,
+                     s.contact_url, s.api_version, s.service_version, s.environment, s.organization,
+                     s.organization_url, s.organization_logo, s.created_at, s.updated_at
+                     FROM catalogue_events e LEFT JOIN services s ON s.id=e.service_id AND e.action<>'deleted'
+                     WHERE e.id > $1 ORDER BY e.id LIMIT $2""",
+    # New aggregators start from the latest event, as they have not cached anything from before
+    "add_deliveries": """INSERT INTO aggregator_deliveries (aggregator_id, delivered_event, attempts, next_attempt_at)
+                         SELECT id, $1, 0, NOW() FROM services WHERE type='beacon-aggregator'
+                         ON CONFLICT (aggregator_id) DO NOTHING""",
+    # Claimed deliveries are not due again until the lease expires, so that other workers don't send them too
+    "claim_deliveries": """UPDATE aggregator_deliveries d SET next_attempt_at=NOW() + make_interval(secs => $2)
+                           FROM services s, service_keys k
+                           WHERE d.aggregator_id=s.id AND k.service_id=s.id
+                           AND d.delivered_event < $1 AND d.next_attempt_at <= NOW()
+                           RETURNING d.aggregator_id, d.attempts, s.url AS service_url, k.service_key""",
+    "complete_delivery": """UPDATE aggregator_deliveries
+                            SET delivered_event=GREATEST(delivered_event, $2), attempts=0, next_attempt_at=NOW(), last_error=NULL
+                            WHERE aggregator_id=$1""",
+    "fail_delivery": """UPDATE aggregator_deliveries
+                        SET attempts=attempts + 1, next_attempt_at=NOW() + make_interval(secs => $2), last_error=$3
+                        WHERE aggregator_id=$1""",
+    # The latest event is kept, so that change feed subscribers can tell whether they have missed events
+    "delete_old_events": """DELETE FROM catalogue_events WHERE created_at < NOW() - INTERVAL '7 days'
+                            AND id < (SELECT MAX(id) FROM catalogue_events)""",
+    "delete_stale_deliveries": """DELETE FROM aggregator_deliveries
+                                  WHERE aggregator_id NOT IN (SELECT id FROM services WHERE type='beacon-aggregator')""",
+}
+
+# Columns services can be filtered by. Each combination of filters has a statement of its own, so that
+# each is planned for the filters it has, and can use the index of the filtered columns
+SERVICE_FILTERS = ("id", "type", "api_version")
+
+
+def service_details(*columns):
+    """Return name of the statement that selects services filtered by the given columns."""
+    return f"get_service_details_by_{'_and_'.join(columns)}" if columns else "get_service_details"
+
+
+def service_details_statements():
+    """Return statements that select services, one for each combination of filters."""
+    statements = {}
+    for count in range(len(SERVICE_FILTERS) + 1):
+        for columns in itertools.combinations(SERVICE_FILTERS, count):
+            conditions = " AND ".join(f"{column}=${number}" for number, column in enumerate(columns, start=1))
+            statements[
+                service_details(*columns)
+            ] = f"""SELECT id, name, type, description, url, contact_url, api_version,
+                                                     service_version, environment, organization, organization_url,
+                                                     organization_logo, created_at, updated_at
+                                                     FROM services{f" WHERE {conditions}" if conditions else ""}"""
+    return statements
+
+
+STATEMENTS.update(service_details_statements())
+
+# Statement name -> [executions, total duration in seconds]
+STATISTICS = {}
+
+
+class RegistryConnection(asyncpg.Connection):
+    """Database connection that keeps the registry statements prepared."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialise connection."""
+        super().__init__(*args, **kwargs)
+        self.statements = {}
+
+
+async def prepare_statements(connection):
+    """Prepare all registry statements, used as the init hook of the connection pool."""
+    for name, query in STATEMENTS.items():
+        connection.statements[name] = await connection.prepare(query)
+
+
+async def run(connection, name, *args):
+    """Execute registry statement, and return the resulting records."""
+    statement = getattr(connection, "statements", {}).get(name)
+    if statement is None:
+        # Connections not opened by the pool prepare statements on demand, served from the statement cache of asyncpg
+        statement = await connection.prepare(STATEMENTS[name])
+    start = time.monotonic()
+    try:
+        return await statement.fetch(*args)
+    finally:
+        statistics = STATISTICS.setdefault(name, [0, 0.0])
+        statistics[0] += 1
+        statistics[1] += time.monotonic() - start
+
+
+def report_statistics():
+    """Log executions and durations of statements since the previous report, slowest in total first."""
+    for name, (count, duration) in sorted(STATISTICS.items(), key=lambda item: item[1][1], reverse=True):
+        LOG.info("Statement %s executed %s times in %.3f s, %.2f ms on average.", name, count, duration, duration * 1000 / count)
+    STATISTICS.clear()
+
+
+async def report_statistics_periodically():
+    """Report statement statistics periodically."""
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        report_statistics()
@@ -7,7 +7,6 @@ import ssl
 import re
 
 import aiohttp
-import asyncio
 
 from aiohttp import web
 from aiocache import cached
@@ -16,22 +15,45 @@ from .logging import LOG
 from urllib.parse import urlparse
 
 
-async def http_request_info(url):
-    """Request service info of given URL."""
+async def http_request_info(url, session=None):
+    """Request service info of given URL, using the given session if any."""
     LOG.debug("Send a request to given URL to get service info.")
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, ssl=await request_security()) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result
-                else:
-                    LOG.debug(f"{url} not found.")
-                    raise web.HTTPNotFound(text=f"{url} not found.")
-        except Exception as e:
-            LOG.debug(f"Query error {e}.")
-            raise web.HTTPInternalServerError(text="An error occurred while attempting to contact service.")
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await http_request_info(url, session)
+
+    try:
+        async with session.get(url, ssl=await request_security()) as response:
+            if response.status == 200:
+                result = await response.json()
+                return result
+            else:
+                LOG.debug("%s not found.", url)
+                raise web.HTTPNotFound(text=f"{url} not found.")
+    except Exception as e:
+        LOG.debug("Query error %s.", e)
+        raise web.HTTPInternalServerError(text="An error occurred while attempting to contact service.")
+
+
+async def http_request_info_changes(url, session, etag=None):
+    """Request service info of given URL, conditionally if the ETag of the previous response is known.
+
+    Return the raw content and ETag of the response, the content is None if the service info has not changed.
+    """
+    LOG.debug("Send a conditional request to given URL to get service info.")
+    headers = {"If-None-Match": etag} if etag else {}
+    try:
+        async with session.get(url, headers=headers, ssl=await request_security()) as response:
+            if response.status == 304 and etag:
+                return None, etag
+            if response.status == 200:
+                return await response.read(), response.headers.get("ETag")
+            LOG.debug("%s not found.", url)
+            raise web.HTTPNotFound(text=f"{url} not found.")
+    except Exception as e:
+        LOG.debug("Query error %s.", e)
+        raise web.HTTPInternalServerError(text="An error occurred while attempting to contact service.")
 
 
 async def parse_service_info(id, service, req={}):
@@ -151,7 +173,11 @@ async def query_params(request):
     """Parse query string params from path."""
     LOG.debug("Parse query params.")
     # Query string params
-    params = {"type": request.query.get("type", None), "apiVersion": request.query.get("apiVersion", None)}
+    params = {
+        "type": request.query.get("type", None),
+        "apiVersion": request.query.get("apiVersion", None),
+        "updatedSince": request.query.get("updatedSince", None),
+    }
     # Path param
     service_id = request.match_info.get("service_id", None)
     return service_id, params
@@ -183,69 +209,24 @@ async def db_get_service_urls(connection, service_type=None):
         raise web.HTTPInternalServerError(text="Database error occurred while attempting to fetch service urls.")
 
 
-# db function temporarily placed here due to import-loop issues
-async def db_get_recaching_credentials(connection):
-    """Return queryable service urls and service keys."""
-    LOG.debug("Querying database for service urls and keys.")
-    credentials = []
-    try:
-        # Database query
-        query = """SELECT a.url AS url, b.service_key AS service_key
-                   FROM services a, service_keys b
-                   WHERE type='aggregator'
-                   AND a.id=b.service_id"""
-        statement = await connection.prepare(query)
-        response = await statement.fetch()
-        if len(response) > 0:
-            # Parse urls from psql records and append to list
-            for record in response:
-                credentials.append({"service_url": record["url"], "service_key": record["service_key"]})
-            return credentials
-        else:
-            return credentials
-    except Exception as e:
-        LOG.debug(f"DB error: {e}")
-        raise web.HTTPInternalServerError(text="Database error occurred while attempting to fetch service urls.")
-
-
-async def invalidate_aggregator_caches(request, db_pool):
-    """Invalidate caches at Aggregators."""
-    LOG.debug("Invalidate cached Beacons at Aggregators.")
-
-    tasks = []  # requests to be done
-    # Take connection from the database pool
-    async with db_pool.acquire() as connection:
-        aggregators = await db_get_recaching_credentials(connection)  # service urls (aggregators) to be queried, with service keys
-
-    for aggregator in aggregators:
-        # Generate task queue
-        task = asyncio.ensure_future(invalidate_cache(aggregator))
-        tasks.append(task)
-
-    # Prepare and initiate co-routines
-    await asyncio.gather(*tasks)
-
-
-async def invalidate_cache(service):
-    """Contact given service and tell them to delete their cache."""
+async def invalidate_cache(service, session):
+    """Contact given service and tell them to delete their cache, return None if successful or the error."""
     LOG.debug("Notify service to delete their cache.")
 
     # Send invalidation notification (request) to service (aggregator)
-    async with aiohttp.ClientSession() as session:
-        try:
-            # Aggregator URLs end with /service-info in the DB, replace them with /cache
-            async with session.delete(
-                service["service_url"].replace("service-info", "cache"), headers={"Authorization": service["service_key"]}, ssl=await request_security()
-            ) as response:
-                if response.status in [200, 204]:
-                    LOG.debug(f"Service received notification and responded with {response.status}.")
-                else:
-                    # Low priority log, it doesn't matter if the invalidation was unsuccessful
-                    LOG.debug(f"Service encountered a problem with notification: {response.status}.")
-        except Exception as e:
-            LOG.debug(f"Query error {e}.")
-            # web.HTTPInternalServerError(text=f'An error occurred while attempting to send request to Aggregator.')
-            pass  # We don't care if a notification failed
+    try:
+        # Aggregator URLs end with /service-info in the DB, replace them with /cache
+        async with session.delete(
+            service["service_url"].replace("service-info", "cache"), headers={"Authorization": service["service_key"]}, ssl=await request_security()
+        ) as response:
+            if response.status in [200, 204]:
+                LOG.debug("Service received notification and responded with %s.", response.status)
+                return None
+            LOG.debug("Service encountered a problem with notification: %s.", response.status)
+            return f"Service responded with {response.status}."
+    except Exception as e:
+        LOG.debug("Query error %s.", e)
+        return f"Query error {e}."
 
 
 async def generate_service_key():
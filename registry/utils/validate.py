@@ -1,14 +1,21 @@
 """Validation Utilities."""
 
+import re
+
 from functools import wraps
 
 from aiohttp import web
 from jsonschema import Draft7Validator, validators
 from jsonschema.exceptions import ValidationError
 
+from ..config import CONFIG
 from .logging import LOG
+from .key_cache import KEY_CACHE
 from .db_ops import db_verify_api_key, db_verify_service_key, db_verify_admin_key
 
+# Paths of /update/services and the progress of its jobs, which require an admin key
+UPDATE_PATH = re.compile(r"^/update/services(/[^/]+)?$")
+
 
 def extend_with_default(validator_class):
     """Include default values present in JSON Schema.
@@ -59,7 +66,7 @@ def validate(schema):
                 LOG.debug("Validate against JSON schema")
                 DefaultValidatingDraft7Validator(schema).validate(request_body)
             except ValidationError as e:
-                LOG.debug(f"ERROR: Could not validate -> {request_body}, {request.host}, {e.message}")
+                LOG.debug("ERROR: Could not validate -> %s, %s, %s", request_body, request.host, e.message)
                 raise web.HTTPBadRequest(text=f"Could not validate request body: {e.message}")
 
             return await func(*args)
@@ -69,6 +76,19 @@ def validate(schema):
     return wrapper
 
 
+async def verify_key(request, kind, key, verify, scope=None):
+    """Verify key with the database query verify, unless it has been verified recently."""
+    if KEY_CACHE.verified(kind, key, scope):
+        LOG.debug("Key has been verified recently.")
+        return
+    # Take one connection from the active database pool
+    async with request.app["pool"].acquire() as connection:
+        await verify(connection)
+    # OTPs are used only once, and must not be accepted by other workers after they have expired
+    if not (kind == "api" and CONFIG.api_otp):
+        KEY_CACHE.add(kind, key, scope)
+
+
 def api_key():
     """Check if API key is valid."""
     LOG.debug("Validate API key.")
@@ -81,15 +101,14 @@ def api_key():
             raise web.HTTPBadRequest(text="Invalid HTTP Request.")
 
         # Check which endpoint user is requesting and sort according to method
-        if request.path == "/update/services" and request.method == "GET":
+        if UPDATE_PATH.match(request.path) and request.method == "GET":
             LOG.debug("In /update/services endpoint using GET.")
             if "Authorization" not in request.headers:
                 LOG.debug('Missing "Authorization" from headers.')
                 raise web.HTTPBadRequest(text='Missing header "Authorization".')
-            # Take one connection from the active database pool
-            async with request.app["pool"].acquire() as connection:
-                # Check if provided api key is valid
-                await db_verify_admin_key(connection, request.headers.get("Authorization"))
+            # Check if provided api key is valid
+            key = request.headers.get("Authorization")
+            await verify_key(request, "admin", key, lambda connection: db_verify_admin_key(connection, key))
             # None of the checks failed
             return await handler(request)
 
@@ -100,26 +119,24 @@ def api_key():
                 if "Authorization" not in request.headers:
                     LOG.debug('Missing "Authorization" from headers.')
                     raise web.HTTPBadRequest(text='Missing header "Authorization".')
-                # Take one connection from the active database pool
-                async with request.app["pool"].acquire() as connection:
-                    # Check if provided api key is valid
-                    await db_verify_api_key(connection, request.headers.get("Authorization"))
+                # Check if provided api key is valid
+                key = request.headers.get("Authorization")
+                await verify_key(request, "api", key, lambda connection: db_verify_api_key(connection, key))
                 # None of the checks failed
                 return await handler(request)
 
             # Handle other methods
             elif request.method in ["PUT", "DELETE"]:
-                LOG.debug(f"Using {request.method} method.")
+                LOG.debug("Using %s method.", request.method)
                 if request.match_info.get("service_id"):
                     if "Beacon-Service-Key" not in request.headers:
                         LOG.debug('Missing "Beacon-Service-Key" from headers.')
                         raise web.HTTPBadRequest(text='Missing header "Beacon-Service-Key".')
-                    # Take one connection from the active database pool
-                    async with request.app["pool"].acquire() as connection:
-                        # Verify that provided service key is authorised
-                        await db_verify_service_key(
-                            connection, service_id=request.match_info.get("service_id"), service_key=request.headers.get("Beacon-Service-Key")
-                        )
+                    # Verify that provided service key is authorised
+                    service_id, key = request.match_info.get("service_id"), request.headers.get("Beacon-Service-Key")
+                    await verify_key(
+                        request, "service", key, lambda connection: db_verify_service_key(connection, service_id=service_id, service_key=key), scope=service_id
+                    )
                 else:
                     raise web.HTTPBadRequest(text='Missing path paremeter "/services/<service_id>".')
                 # None of the checks failed
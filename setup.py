@@ -20,14 +20,16 @@ setup(
         "aggregator",
         "aggregator/config",
         "aggregator/endpoints",
+        "aggregator/schemas",
         "aggregator/utils",
         "registry",
         "registry/config",
+        "registry/db/migrations",
         "registry/endpoints",
         "registry/schemas",
         "registry/utils",
     ],
-    package_data={"": ["*.json", "*.ini"]},
+    package_data={"": ["*.json", "*.ini", "*.sql"]},
     install_requires=[
         "asyncio==3.4.3",
         "aiohttp==3.8.5",
@@ -60,6 +62,7 @@ setup(
         "console_scripts": [
             "beacon_registry=registry.registry:main",
             "beacon_aggregator=aggregator.aggregator:main",
+            "beacon_registry_migrate=registry.utils.migrations:main",
         ],
     },
 )
@@ -1,5 +1,7 @@
 import asynctest
 
+from urllib import parse
+
 from aiohttp.test_utils import unittest_run_loop
 
 from aggregator.endpoints.cache import invalidate_cache
@@ -30,6 +32,7 @@ class MockRequest:
     def __init__(self, query_string="", host=""):
         """Initialise object."""
         self.query_string = query_string
+        self.query = dict(parse.parse_qsl(query_string))
         self.host = host
         self._loop = True
 
@@ -60,6 +63,22 @@ class TestUtils(asynctest.TestCase):
         query_results = await send_beacon_query(m_request)
         self.assertEqual(query_results, [{"exists": True}, {"exists": True}])
 
+    @asynctest.mock.patch("aggregator.endpoints.query.get_filtering_terms")
+    @asynctest.mock.patch("aggregator.endpoints.query.query_service")
+    @asynctest.mock.patch("aggregator.endpoints.query.get_access_token")
+    @asynctest.mock.patch("aggregator.endpoints.query.get_services")
+    async def test_send_beacon_query_filters(self, m_services, m_token, m_query, m_terms):
+        """Test beacon query with filtering terms served from memory."""
+        m_request = MockRequest(query_string="assemblyId=GRCh38&filters=filter", host="aggregator.csc.fi")
+        m_services.return_value = ["https://beacon1.csc.fi/query", "https://beacon2.csc.fi/query"]
+        m_token.return_value = "token"
+        m_query.return_value = {"exists": True}
+        m_terms.return_value = [{"response": {"filteringTerms": []}}]
+        query_results = await send_beacon_query(m_request)
+        # Services are queried once, filtering terms are not fetched again
+        self.assertEqual(m_query.call_count, 2)
+        self.assertEqual(query_results, [{"exists": True}, {"exists": True}, {"response": {"filteringTerms": []}}])
+
     @asynctest.mock.patch("aggregator.endpoints.query.web.WebSocketResponse")
     @asynctest.mock.patch("aggregator.endpoints.query.query_service")
     @asynctest.mock.patch("aggregator.endpoints.query.get_access_token")
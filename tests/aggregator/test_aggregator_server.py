@@ -4,12 +4,19 @@ import asynctest
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
 
 from aggregator.aggregator import init_app
+from aggregator.utils.utils import CACHE_GENERATION
+
+
+async def start_following_mock(app):
+    """Mock following change feeds of registries."""
+    app["following"] = []
 
 
 class AppTestCase(AioHTTPTestCase):
     """Test aggregator endpoints."""
 
-    async def get_application(self):
+    @asynctest.mock.patch("aggregator.aggregator.start_following", side_effect=start_following_mock)
+    async def get_application(self, mock_following):
         """Retrieve web application for test."""
         return await init_app()
 
@@ -43,6 +50,21 @@ class AppTestCase(AioHTTPTestCase):
         assert 200 == resp.status
         assert "Cache has been deleted." == await resp.text()
 
+    @asynctest.mock.patch("aggregator.utils.utils.clear_local_cache")
+    @unittest_run_loop
+    async def test_cache_generation(self, m_clear):
+        """Test that cache cleared by another worker is cleared at next request."""
+        resp = await self.client.request("GET", "/")
+        m_clear.assert_not_called()
+        # Another worker received DELETE /cache
+        with CACHE_GENERATION.get_lock():
+            CACHE_GENERATION.value += 1
+        resp = await self.client.request("GET", "/")
+        assert 200 == resp.status
+        m_clear.assert_called_once()
+        resp = await self.client.request("GET", "/")
+        m_clear.assert_called_once()
+
     @asynctest.mock.patch("aggregator.aggregator.send_beacon_query")
     @unittest_run_loop
     async def test_query_normal(self, m_query):
@@ -53,6 +75,86 @@ class AppTestCase(AioHTTPTestCase):
         assert 200 == resp.status
         assert data == ["normal query"]
 
+    @asynctest.mock.patch("aggregator.aggregator.send_filtering_terms")
+    @unittest_run_loop
+    async def test_filtering_terms(self, m_terms):
+        """Test filtering terms endpoint."""
+        m_terms.return_value = [{"id": "NCIT:C20197", "label": "Male", "type": "ontologyTerm", "beacons": ["fi.beacon"]}]
+        resp = await self.client.request("GET", "/filtering_terms")
+        data = await resp.json()
+        assert 200 == resp.status
+        assert data[0]["id"] == "NCIT:C20197"
+
+    @unittest_run_loop
+    async def test_filtering_terms_autocomplete_bad_limit(self):
+        """Test filtering terms autocomplete endpoint, invalid limit."""
+        resp = await self.client.request("GET", "/filtering_terms/autocomplete?q=mal&limit=none")
+        assert 400 == resp.status
+
+    @asynctest.mock.patch("aggregator.aggregator.send_beacon_query")
+    @unittest_run_loop
+    async def test_query_compressed(self, m_query):
+        """Test query endpoint, large response is compressed."""
+        m_query.return_value = [{"beaconId": "fi.beacon", "exists": True}] * 100
+        resp = await self.client.request("GET", "/query", headers={"Accept-Encoding": "gzip"})
+        data = await resp.json()
+        assert 200 == resp.status
+        assert "gzip" == resp.headers.get("Content-Encoding")
+        assert data == [{"beaconId": "fi.beacon", "exists": True}] * 100
+        resp = await self.client.request("GET", "/query", headers={"Accept-Encoding": "gzip;q=0, identity"})
+        assert resp.headers.get("Content-Encoding") is None
+
+    @asynctest.mock.patch("aggregator.endpoints.query.query_service")
+    @asynctest.mock.patch("aggregator.endpoints.query.get_services")
+    @unittest_run_loop
+    async def test_query_sse(self, m_services, m_query):
+        """Test query endpoint, Server-Sent Events."""
+        m_services.return_value = ["https://beacon1.csc.fi/query", "https://aggregator.csc.fi/query"]
+        m_query.side_effect = [{"exists": True}, [{"exists": False}, {"exists": None}]]
+        resp = await self.client.request("GET", "/query", headers={"Accept": "text/event-stream"})
+        body = await resp.text()
+        assert 200 == resp.status
+        assert "text/event-stream" == resp.headers.get("Content-Type")
+        assert 3 == body.count('\ndata: {"exists"')
+        assert body.endswith('event: done\ndata: {"results":3}\n\n')
+
+    @asynctest.mock.patch("aggregator.endpoints.query.get_services")
+    @unittest_run_loop
+    async def test_query_sse_bad_authorization(self, m_services):
+        """Test query endpoint, Server-Sent Events with malformed authorization get a HTTP 400 instead of a stream."""
+        resp = await self.client.request("GET", "/query", headers={"Accept": "text/event-stream", "Authorization": "Basic"})
+        assert 400 == resp.status
+        m_services.assert_not_called()
+
+    @asynctest.mock.patch("aggregator.endpoints.query.query_service")
+    @asynctest.mock.patch("aggregator.endpoints.query.get_services")
+    @unittest_run_loop
+    async def test_query_diagnostics(self, m_services, m_query):
+        """Test query endpoint, diagnostics mode adds Server-Timing header."""
+        m_services.return_value = ["https://beacon1.csc.fi/query"]
+        m_query.return_value = {"exists": True}
+        resp = await self.client.request("GET", "/query?diagnostics=true")
+        assert 200 == resp.status
+        assert m_query.call_args[1]["timing"] is True
+        assert ["catalogue", "fanout", "serialize"] == [metric.split(";")[0] for metric in resp.headers["Server-Timing"].split(", ")]
+        resp = await self.client.request("GET", "/query")
+        assert "Server-Timing" not in resp.headers
+
+    @unittest_run_loop
+    async def test_metrics(self):
+        """Test metrics endpoint."""
+        resp = await self.client.request("GET", "/metrics")
+        body = await resp.text()
+        assert 200 == resp.status
+        assert "# TYPE aggregator_service_requests_total counter" in body
+        assert "# TYPE aggregator_event_loop_lag_seconds histogram" in body
+
+    @unittest_run_loop
+    async def test_query_invalid(self):
+        """Test query endpoint, malformed query is rejected."""
+        resp = await self.client.request("GET", "/query?assemblyId=GRCh38&referenceName=chr99&start=9")
+        assert 400 == resp.status
+
     # Doesn't go to the websocket block at all even with the headers
     # fails with 'aiohttp.client_exceptions.ServerDisconnectedError'
     # @asynctest.mock.patch('aggregator.aggregator.send_beacon_query_websocket')
@@ -1,12 +1,36 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import ujson
+
+import aiohttp
 import asynctest
 
-from aioresponses import aioresponses
+from aioresponses import aioresponses, CallbackResult
+from yarl import URL
 from aiohttp import web
 
 from aggregator.utils.utils import http_get_service_urls, get_services, process_url, find_query_endpoint
 from aggregator.utils.utils import remove_self, get_access_token, parse_results, query_service
 from aggregator.utils.utils import validate_service_key, clear_cache, ws_bundle_return
 from aggregator.utils.utils import parse_version, pre_process_payload
+from aggregator.utils.utils import merge_filtering_terms, harvest_filtering_terms, get_filtering_terms
+from aggregator.utils.utils import parse_projection, project
+from aggregator.utils.validate import normalize_query
+from aggregator.utils.prefix_index import build_prefix_index, update_prefix_index, search_prefix_index
+from aggregator.utils.result_cache import ResultCache
+from aggregator.utils.heavy_hitters import HeavyHitters
+from aggregator.utils.http_cache import HttpCache
+from aggregator.utils.metrics import Metrics, render
+from aggregator.utils.logging import JsonFormatter, SamplingFilter, parse_sampling
+from aggregator.utils.tracing import Span, CURRENT_SPAN, SPANS, span, trace_headers, export_spans
+from aggregator.utils.utils import warm_popular_queries, is_warmer
+from aggregator.utils.utils import load_catalogue_snapshot, save_catalogue_snapshot, warm_start_services
+from aggregator.utils.utils import REGISTRY_CATALOGUES, FOLLOWED_REGISTRIES, CATALOGUE
+from aggregator.utils.change_feed import follow_changes
+from aggregator.config import CONFIG
 
 
 class BadCache:
@@ -71,6 +95,17 @@ class TestUtils(asynctest.TestCase):
         info = await http_get_service_urls("https://beacon-registry.fi/services")
         self.assertEqual([("https://beacon.fi/", 1, "beacon")], info)
 
+    @aioresponses()
+    async def test_http_get_service_urls_not_modified(self, m):
+        """Test request of service urls: unchanged service list is revalidated."""
+        data = [{"type": {"group": "org.ga4gh", "artifact": "beacon", "version": "1.0.0"}, "url": "https://beacon.fi/"}]
+        m.get("https://beacon-registry.fi/services?v", status=200, payload=data, headers={"ETag": '"v1"'})
+        m.get("https://beacon-registry.fi/services?v", status=304)
+        self.assertEqual([("https://beacon.fi/", 1, "beacon")], await http_get_service_urls("https://beacon-registry.fi/services?v"))
+        self.assertEqual([("https://beacon.fi/", 1, "beacon")], await http_get_service_urls("https://beacon-registry.fi/services?v"))
+        request = list(m.requests.values())[0][1]
+        self.assertEqual(request.kwargs["headers"]["If-None-Match"], '"v1"')
+
     @aioresponses()
     async def test_http_get_service_urls_empty(self, m):
         """Test empty request of service urls."""
@@ -80,6 +115,44 @@ class TestUtils(asynctest.TestCase):
         info = await http_get_service_urls("https://beacon-registry.fi/services")
         self.assertEqual([], info)
 
+    @asynctest.mock.patch("aggregator.utils.change_feed.clear_local_cache")
+    @aioresponses()
+    async def test_follow_changes(self, m_clear, m):
+        """Test change feed: streamed changes are applied to the service list, which is then used without requests."""
+        registry = "https://beacon-registry.fi/services?feed"
+        beacon = {"id": "fi.beacon", "type": {"group": "org.ga4gh", "artifact": "beacon", "version": "1.0.0"}, "url": "https://beacon.fi/"}
+        m.get(registry, status=200, payload=[beacon], headers={"ETag": '"v1"', "Catalogue-Sequence": "3"})
+        self.assertEqual([("https://beacon.fi/", 1, "beacon")], await http_get_service_urls(registry))
+        other = {**beacon, "id": "fi.other", "url": "https://other.fi/"}
+        body = (
+            f"event: registered\nid: 4\ndata: {ujson.dumps(other, escape_forward_slashes=False)}\n\n"
+            ": heartbeat\n\n"
+            'event: deleted\nid: 5\ndata: {"id": "fi.beacon"}\n\n'
+        )
+        m.get("https://beacon-registry.fi/changes?since=3", status=200, body=body, headers={"Content-Type": "text/event-stream"})
+        async with aiohttp.ClientSession() as session:
+            self.assertTrue(await follow_changes(session, registry))
+        self.assertEqual(REGISTRY_CATALOGUES[registry], {"etag": None, "services": [other], "sequence": 5})
+        self.assertEqual(m_clear.call_count, 2)
+        # The registry is not requested while its change feed is followed
+        self.assertEqual([("https://other.fi/", 1, "beacon")], await http_get_service_urls(registry))
+        FOLLOWED_REGISTRIES.discard(registry)
+
+    @aioresponses()
+    async def test_follow_changes_gone(self, m):
+        """Test change feed: the service list is fetched again if the changes since its sequence number are gone."""
+        registry = "https://beacon-registry.fi/services?gone"
+        REGISTRY_CATALOGUES[registry] = {"etag": None, "services": [], "sequence": 3}
+        m.get("https://beacon-registry.fi/changes?since=3", status=410)
+        async with aiohttp.ClientSession() as session:
+            with self.assertRaises(ValueError):
+                await follow_changes(session, registry)
+        self.assertNotIn(registry, REGISTRY_CATALOGUES)
+        m.get("https://beacon-registry.fi/changes?since=3", status=404)
+        REGISTRY_CATALOGUES[registry] = {"etag": None, "services": [], "sequence": 3}
+        async with aiohttp.ClientSession() as session:
+            self.assertFalse(await follow_changes(session, registry))
+
     # Looks like an exception can only occur if the aiohttp.ClientSession somehow fails
     # @aioresponses()
     # async def test_http_get_service_urls_fail(self, m):
@@ -99,6 +172,38 @@ class TestUtils(asynctest.TestCase):
         services = await get_services("beacon-aggregator.fi")
         self.assertEqual(["https://beacon1.fi/query", "https://beacon2.fi/query"], services)
 
+    @asynctest.mock.patch("aggregator.utils.utils.http_get_service_urls")
+    async def test_get_services_snapshot(self, http):
+        """Test catalogue snapshot: saved on success, used when registries return nothing, and loaded at startup."""
+        with tempfile.TemporaryDirectory() as directory:
+            with asynctest.mock.patch("aggregator.utils.utils.CONFIG", CONFIG._replace(catalogue_snapshot=os.path.join(directory, "catalogue.json"))):
+                self.assertIsNone(load_catalogue_snapshot())
+                http.return_value = [("https://beacon1.fi/", 1, "beacon")]
+                services = await get_services("beacon-aggregator.fi", cache_read=False, cache_write=False)
+                self.assertEqual(load_catalogue_snapshot(), {"host": "beacon-aggregator.fi", "services": [[["https://beacon1.fi/query", 1]]]})
+                # Registry outage
+                http.return_value = []
+                self.assertEqual(await get_services("beacon-aggregator.fi", cache_read=False, cache_write=False), [[["https://beacon1.fi/query", 1]]])
+                # Startup, the snapshot is served without copying it into the cache until the catalogue is fetched
+                await get_services.cache.delete("beacon_urls")
+                with asynctest.mock.patch("aggregator.utils.utils.asyncio.ensure_future") as m_refresh:
+                    await warm_start_services()
+                    m_refresh.call_args[0][0].close()
+                self.assertEqual(await get_services("beacon-aggregator.fi"), [[["https://beacon1.fi/query", 1]]])
+                self.assertIsNone(await get_services.cache.get("beacon_urls"))
+                http.return_value = [("https://beacon2.fi/", 1, "beacon")]
+                self.assertEqual(await get_services("beacon-aggregator.fi", preloaded=False), [[("https://beacon2.fi/query", 1)]])
+                self.assertIsNone(CATALOGUE["preloaded"])
+                self.assertEqual(await get_services.cache.get("beacon_urls"), [[["https://beacon2.fi/query", 1]]])
+                await get_services.cache.delete("beacon_urls")
+                self.assertEqual(len(services), 1)
+
+    async def test_save_catalogue_snapshot_disabled(self):
+        """Test catalogue snapshot when it is disabled."""
+        with asynctest.mock.patch("aggregator.utils.utils.CONFIG", CONFIG._replace(catalogue_snapshot="")):
+            save_catalogue_snapshot("beacon-aggregator.fi", [])
+            self.assertIsNone(load_catalogue_snapshot())
+
     async def test_process_url_1(self):
         """Test url processing type 1."""
         processed = await process_url(("https://beacon.fi/", 1))
@@ -208,6 +313,244 @@ class TestUtils(asynctest.TestCase):
         response = await query_service(processed, "", "token")
         self.assertEqual(response, data)
 
+    @aioresponses()
+    async def test_query_service_http_projection(self, m):
+        """Test querying of service: http success, response trimmed to projection."""
+        data = {"beaconId": "fi.beacon", "exists": True, "datasetAlleleResponses": [{"datasetId": "a", "info": {"big": "data"}}]}
+        m.post("https://beacon.fi/query", status=200, payload=data)
+        processed = await process_url(("https://beacon.fi/", 1))
+        response = await query_service(processed, "", None, projection=parse_projection("beaconId,datasetAlleleResponses.datasetId"))
+        self.assertEqual(response, {"beaconId": "fi.beacon", "datasetAlleleResponses": [{"datasetId": "a"}]})
+
+    async def test_project(self):
+        """Test projection of nested responses."""
+        self.assertEqual(parse_projection(""), {})
+        self.assertEqual(parse_projection("exists, response.resultSets.id,"), {"exists": {}, "response": {"resultSets": {"id": {}}}})
+        data = [{"exists": True, "response": {"resultSets": [{"id": "a", "results": [1, 2]}], "numTotalResults": 2}}, {"exists": False}]
+        self.assertEqual(project(data, parse_projection("")), data)
+        self.assertEqual(
+            project(data, parse_projection("exists,response.resultSets.id")),
+            [{"exists": True, "response": {"resultSets": [{"id": "a"}]}}, {"exists": False}],
+        )
+
+    @aioresponses()
+    async def test_query_service_http_cached(self, m):
+        """Test querying of service: anonymous result is served from cache on repeated query."""
+        data = {"exists": True, "datasetAlleleResponses": [{"datasetId": "a"}]}
+        m.post("https://beacon.fi/query", status=200, payload=data)
+        processed = await process_url(("https://beacon.fi/", 1))
+        with asynctest.mock.patch("aggregator.utils.utils.RESULT_CACHE", ResultCache(ttl=60, memory_size=10)):
+            self.assertEqual(await query_service(processed, "referenceName=1", None), data)
+            # Only one response is mocked, the second query must not reach the service
+            self.assertEqual(await query_service(processed, "referenceName=1", None, projection=parse_projection("exists")), {"exists": True})
+
+    @aioresponses()
+    async def test_query_service_http_cache_control(self, m):
+        """Test querying of service: fresh response to POST is reused, and stale response is queried again unconditionally."""
+        data = {"exists": True}
+
+        def respond(url, **kwargs):
+            # A conditional POST matching the ETag fails the precondition
+            if "If-None-Match" in kwargs["headers"]:
+                return CallbackResult(status=412)
+            return CallbackResult(status=200, payload=data, headers={"Cache-Control": "max-age=60", "ETag": '"v1"'})
+
+        m.post("https://beacon.fi/query", callback=respond, repeat=True)
+        processed = await process_url(("https://beacon.fi/", 1))
+        cache = HttpCache(size=10)
+        with asynctest.mock.patch("aggregator.utils.utils.HTTP_CACHE", cache):
+            self.assertEqual(await query_service(processed, "referenceName=1", None), data)
+            # Fresh, the service is not asked again
+            self.assertEqual(await query_service(processed, "referenceName=1", None), data)
+            self.assertEqual(len(m.requests[("POST", URL("https://beacon.fi/query"))]), 1)
+            # Responses to POST are not kept for revalidation
+            key = cache.key("https://beacon.fi/query", "referenceName=1")
+            self.assertIsNone(cache.lookup(key)[1])
+            cache.entries[key] = (0, '"v1"', data)
+            self.assertEqual(await query_service(processed, "referenceName=1", None), data)
+            self.assertEqual(len(m.requests[("POST", URL("https://beacon.fi/query"))]), 2)
+            self.assertTrue(cache.lookup(key)[0])
+
+    @aioresponses()
+    async def test_query_service_http_cache_revalidate_get(self, m):
+        """Test querying of service: stale response to GET is revalidated with a conditional GET."""
+        data = {"exists": True}
+        m.post("https://beacon.fi/query", status=405, repeat=True)
+        m.get("https://beacon.fi/query?referenceName=1", status=200, payload=data, headers={"Cache-Control": "no-cache", "ETag": '"v1"'})
+        m.get("https://beacon.fi/query?referenceName=1", status=304, headers={"Cache-Control": "max-age=60"})
+        processed = await process_url(("https://beacon.fi/", 1))
+        cache = HttpCache(size=10)
+        with asynctest.mock.patch("aggregator.utils.utils.HTTP_CACHE", cache):
+            self.assertEqual(await query_service(processed, "referenceName=1", None), data)
+            self.assertEqual(await query_service(processed, "referenceName=1", None), data)
+            self.assertNotIn("If-None-Match", m.requests[("POST", URL("https://beacon.fi/query"))][1].kwargs["headers"])
+            request = m.requests[("GET", URL("https://beacon.fi/query?referenceName=1"))][1]
+            self.assertEqual(request.kwargs["headers"]["If-None-Match"], '"v1"')
+            self.assertTrue(cache.lookup(cache.key("https://beacon.fi/query", "referenceName=1"))[0])
+
+    def test_metrics_files(self):
+        """Test metrics files: workers read each other's files, and only files of workers are removed."""
+        with tempfile.TemporaryDirectory() as directory:
+            worker = Metrics(path=directory)
+            worker.inc("aggregator_sessions_total", transport="sse")
+            worker.write()
+            with open(os.path.join(directory, "12345.json"), "w") as snapshot:
+                snapshot.write(ujson.dumps({**worker.snapshot(), "pid": 12345}))
+            with open(os.path.join(directory, "other.json"), "w") as other:
+                other.write("{}")
+            self.assertEqual(len(worker.collect()), 2)
+            worker.remove(12345)
+            self.assertEqual(sorted(os.listdir(directory)), sorted([f"{os.getpid()}.json", "other.json"]))
+            worker.remove()
+            self.assertEqual(os.listdir(directory), ["other.json"])
+
+    def test_metrics(self):
+        """Test metrics of two workers are merged and rendered in the Prometheus text format."""
+        worker1, worker2 = Metrics(), Metrics()
+        worker1.inc("aggregator_service_requests_total", service="https://beacon.fi", status=200)
+        worker2.inc("aggregator_service_requests_total", service="https://beacon.fi", status=200)
+        worker1.observe("aggregator_service_request_duration_seconds", 0.2, service="https://beacon.fi")
+        worker2.observe("aggregator_service_request_duration_seconds", 3, service="https://beacon.fi")
+        worker1.add("aggregator_sessions", 1, transport="websocket")
+        worker2.add("aggregator_sessions", 2, transport="websocket")
+        text = render([worker1.snapshot(), worker2.snapshot()])
+        self.assertIn('aggregator_service_requests_total{service="https://beacon.fi",status="200"} 2', text)
+        self.assertIn('aggregator_service_request_duration_seconds_bucket{service="https://beacon.fi",le="0.25"} 1', text)
+        self.assertIn('aggregator_service_request_duration_seconds_bucket{service="https://beacon.fi",le="+Inf"} 2', text)
+        self.assertIn('aggregator_service_request_duration_seconds_sum{service="https://beacon.fi"} 3.2', text)
+        self.assertIn('aggregator_sessions{transport="websocket"} 3', text)
+
+    async def test_tracing_spans(self):
+        """Test tracing: child spans continue the trace, and are exported as OTLP JSON lines."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "spans.jsonl")
+            with asynctest.mock.patch("aggregator.utils.tracing.CONFIG", CONFIG._replace(tracing=path)):
+                root = Span("GET /query", "0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", kind=2)
+                token = CURRENT_SPAN.set(root)
+                with span("query_service", kind=3) as child:
+                    self.assertEqual(trace_headers(), {"traceparent": f"00-{root.trace_id}-{child.span_id}-01"})
+                CURRENT_SPAN.reset(token)
+                self.assertEqual(child.parent_id, root.span_id)
+                self.assertIn(child, SPANS)
+                await export_spans()
+                self.assertEqual(SPANS, [])
+                with open(path) as spans_file:
+                    exported = ujson.loads(spans_file.readline())["resourceSpans"][0]["scopeSpans"][0]["spans"]
+                self.assertEqual(exported[-1]["name"], "query_service")
+                self.assertEqual(exported[-1]["parentSpanId"], root.span_id)
+
+    def test_logging_sampling_and_json(self):
+        """Test log records are sampled by module, and formatted as JSON."""
+        sampling = SamplingFilter(parse_sampling("utils=0, query=1"))
+        debug = logging.LogRecord("bn", logging.DEBUG, "/aggregator/utils/utils.py", 1, "result: %s", ({"exists": True},), None)
+        warning = logging.LogRecord("bn", logging.WARNING, "/aggregator/utils/utils.py", 1, "slow", None, None)
+        self.assertFalse(sampling.filter(debug))
+        self.assertTrue(sampling.filter(warning))
+        self.assertEqual(ujson.loads(JsonFormatter().format(debug))["message"], "result: {'exists': True}")
+
+    def test_http_cache_store(self):
+        """Test HTTP cache: responses are stored only if their headers allow it."""
+        cache = HttpCache(size=10)
+        cache.store("a", {"Cache-Control": "private, max-age=60"}, {})
+        cache.store("b", {"Cache-Control": "max-age=60"}, {}, authorized=True)
+        cache.store("c", {"Cache-Control": "public, max-age=60"}, {}, authorized=True)
+        cache.store("d", {}, {})
+        cache.store("e", {"Cache-Control": "no-cache", "ETag": '"e"'}, {})
+        self.assertEqual(list(cache.entries), ["c", "e"])
+        self.assertFalse(cache.lookup("e")[0])
+        self.assertNotEqual(cache.key("url", "a=1", "token"), cache.key("url", "a=1", "other"))
+
+    @aioresponses()
+    async def test_query_service_timing(self, m):
+        """Test querying of service: diagnostics add timings to result, without modifying cached result."""
+        data = {"exists": True}
+        m.post("https://beacon.fi/query", status=200, payload=data)
+        processed = await process_url(("https://beacon.fi/", 1))
+        cache = ResultCache(ttl=60, memory_size=10)
+        with asynctest.mock.patch("aggregator.utils.utils.RESULT_CACHE", cache):
+            result = await query_service(processed, "referenceName=1", None, timing=True)
+            self.assertIn("total", result["_timing"])
+            cached = await query_service(processed, "referenceName=1", None, timing=True)
+            self.assertTrue(cached["_timing"]["cached"])
+            self.assertNotIn("_timing", await query_service(processed, "referenceName=1", None))
+
+    async def test_result_cache_memory(self):
+        """Test in-memory tier of result cache: expiry and LRU eviction."""
+        cache = ResultCache(ttl=60, memory_size=2)
+        await cache.set("a", {"exists": True})
+        await cache.set("b", {"exists": False})
+        self.assertEqual(await cache.get("a"), {"exists": True})
+        await cache.set("c", {"exists": None})
+        # b was the least recently used result
+        self.assertIsNone(await cache.get("b"))
+        self.assertEqual(await cache.get("a"), {"exists": True})
+        cache.ttl = -1
+        await cache.set("d", {"exists": True})
+        self.assertIsNone(await cache.get("d"))
+
+    async def test_result_cache_disk(self):
+        """Test on-disk tier of result cache: persistence and size cap."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "results.db")
+            cache = ResultCache(ttl=60, memory_size=10, path=path, disk_size=1000)
+            await cache.set("a", {"exists": True})
+            # A new cache, e.g. in a restarted worker, finds the result on disk
+            restarted = ResultCache(ttl=60, memory_size=10, path=path, disk_size=1000)
+            self.assertEqual(await restarted.get("a"), {"exists": True})
+            for i in range(10):
+                await restarted.set(str(i), {"data": "x" * 200})
+            restarted.memory.clear()
+            await asyncio.get_event_loop().run_in_executor(restarted.executor, restarted._disk_compact)
+            self.assertIsNone(await restarted.get("a"))
+            self.assertEqual(await restarted.get("9"), {"data": "x" * 200})
+            await restarted.clear()
+            self.assertIsNone(await restarted.get("9"))
+
+    def test_heavy_hitters(self):
+        """Test tracking of most frequent keys in constant memory."""
+        tracker = HeavyHitters(k=2, width=64, depth=4)
+        for key, count in [("a", 5), ("b", 1), ("c", 3), ("d", 4)]:
+            for _ in range(count):
+                tracker.add(key)
+        self.assertEqual(tracker.most_common(), ["a", "d"])
+        self.assertLessEqual(len(tracker.heap), 4 * tracker.k)
+        self.assertGreaterEqual(tracker.sketch.estimate("c"), 3)
+        tracker.decay()
+        self.assertEqual(tracker.top["a"], 2)
+
+    @asynctest.mock.patch("aggregator.utils.utils.get_services")
+    @asynctest.mock.patch("aggregator.utils.utils.query_service")
+    async def test_warm_popular_queries(self, m_query, m_services):
+        """Test warming of popular queries: cached results are refreshed from all services."""
+        tracker = HeavyHitters(k=2)
+        tracker.add("referenceName=1")
+        m_services.return_value = ["https://beacon1.fi/", "https://beacon2.fi/"]
+        with asynctest.mock.patch("aggregator.utils.utils.POPULAR_QUERIES", tracker):
+            with asynctest.mock.patch("aggregator.utils.utils.RESULT_CACHE", ResultCache(ttl=60, memory_size=10)):
+                await warm_popular_queries("aggregator.fi")
+        m_query.assert_any_call("https://beacon2.fi/", "referenceName=1", None, cache_read=False)
+        self.assertEqual(m_query.call_count, 2)
+
+    @asynctest.mock.patch("aggregator.utils.utils.RESULT_CACHE", ResultCache(60, 10, "results.sqlite"))
+    async def test_is_warmer(self):
+        """Test election of the warming worker: with a shared result cache only one worker warms, until it exits."""
+        with asynctest.mock.patch("aggregator.utils.utils.WARMER", multiprocessing.Value("i", 0)) as warmer:
+            self.assertTrue(is_warmer())
+            self.assertTrue(is_warmer())
+            # Another live worker is warming
+            warmer.value = os.getppid()
+            self.assertFalse(is_warmer())
+            with asynctest.mock.patch("aggregator.utils.utils.process_alive", return_value=False):
+                self.assertTrue(is_warmer())
+            self.assertEqual(warmer.value, os.getpid())
+
+    @asynctest.mock.patch("aggregator.utils.utils.RESULT_CACHE", ResultCache(60, 10))
+    async def test_is_warmer_unshared(self):
+        """Test election of the warming worker: without a shared result cache every worker warms its own queries."""
+        with asynctest.mock.patch("aggregator.utils.utils.WARMER", multiprocessing.Value("i", os.getppid())) as warmer:
+            self.assertTrue(is_warmer())
+            self.assertEqual(warmer.value, os.getppid())
+
     @aioresponses()
     async def test_query_service_http_fail(self, m):
         """Test querying of service: http fail."""
@@ -351,6 +694,107 @@ class TestUtils(asynctest.TestCase):
         self.assertEqual(await pre_process_payload(2, query_strings[3]), expected_v2[3])
         self.assertEqual(await pre_process_payload(2, query_strings[4]), expected_v2[4])
 
+    async def test_merge_filtering_terms(self):
+        """Test merging of filtering terms from multiple services."""
+        responses = [
+            (
+                "https://beacon1.fi/filtering_terms",
+                {"meta": {"beaconId": "fi.beacon1"}, "response": {"filteringTerms": [{"id": "NCIT:C20197", "type": "ontologyTerm"}]}},
+            ),
+            ("https://beacon2.fi/filtering_terms", {"response": {"filteringTerms": [{"id": "NCIT:C20197", "label": "Male"}, {"id": "HP:0000001"}]}}),
+            ("https://beacon3.fi/filtering_terms", {"response": {"filteringTerms": [{"id": 42, "label": "Answer"}, {"id": "HP:0000001", "label": None}]}}),
+        ]
+        terms = merge_filtering_terms(responses)
+        self.assertEqual(
+            terms,
+            [
+                {"id": "HP:0000001", "label": "", "type": "", "beacons": ["https://beacon2.fi/filtering_terms", "https://beacon3.fi/filtering_terms"]},
+                {"id": "NCIT:C20197", "label": "Male", "type": "ontologyTerm", "beacons": ["fi.beacon1", "https://beacon2.fi/filtering_terms"]},
+            ],
+        )
+
+    @aioresponses()
+    async def test_harvest_filtering_terms(self, m):
+        """Test harvesting of filtering terms, only Beacon 2.0 services are contacted."""
+        data = {"response": {"filteringTerms": [{"id": "NCIT:C20197", "label": "Male"}]}}
+        m.post("https://beacon2.fi/filtering_terms", status=200, payload=data)
+        services = [await process_url(("https://beacon1.fi/", 1)), await process_url(("https://beacon2.fi/", 2))]
+        await harvest_filtering_terms(services)
+        self.assertEqual(await get_filtering_terms(responses=True), [data])
+        self.assertEqual(await get_filtering_terms(), [{"id": "NCIT:C20197", "label": "Male", "type": "", "beacons": ["https://beacon2.fi/filtering_terms"]}])
+
+    async def test_search_prefix_index(self):
+        """Test ranked prefix search of filtering terms."""
+        terms = [
+            {"id": "NCIT:C20197", "label": "Male", "beacons": ["a"]},
+            {"id": "NCIT:C16576", "label": "Female", "beacons": ["a"]},
+            {"id": "HP:0000001", "label": "All", "beacons": ["a"]},
+            {"id": "EFO:0009656", "label": "Male infertility", "beacons": ["a", "b"]},
+            {"id": "HP:0000144", "label": "Decreased fertility in males", "beacons": ["a"]},
+        ]
+        index = build_prefix_index(terms)
+        results = [term["id"] for term in search_prefix_index(index, "MAL")]
+        self.assertEqual(results, ["EFO:0009656", "NCIT:C20197", "HP:0000144"])
+        self.assertEqual([term["id"] for term in search_prefix_index(index, "hp:0000001")], ["HP:0000001"])
+        self.assertEqual(len(search_prefix_index(index, "hp", limit=1)), 1)
+        self.assertEqual(search_prefix_index(index, "xyz"), [])
+        self.assertEqual(search_prefix_index(index, ""), [])
+        # Terms sent as is by beacons, with null labels and ids that are not strings
+        index = build_prefix_index([{"id": "HP:0000002", "label": None}, {"id": 42, "label": "Answer"}])
+        self.assertEqual([term["id"] for term in search_prefix_index(index, "hp")], ["HP:0000002"])
+        self.assertEqual(search_prefix_index(index, "answer"), [])
+
+    async def test_search_prefix_index_short_prefix(self):
+        """Test ranked prefix search: the best match is found among many matching keys."""
+        terms = [{"id": f"HP:{number:07d}", "label": f"Phenotype {number}"} for number in range(2000)]
+        # Sorts after the other keys starting with "h", but is provided by most beacons
+        terms.append({"id": "HZ:0000001", "label": "Zzz", "beacons": ["a", "b"]})
+        index = build_prefix_index(terms)
+        self.assertEqual(search_prefix_index(index, "h")[0]["id"], "HZ:0000001")
+
+    async def test_update_prefix_index(self):
+        """Test incremental updates of the prefix index, which match a rebuilt index."""
+        terms = [{"id": f"HP:{number:07d}", "label": f"Phenotype {number}"} for number in range(100)]
+        index = build_prefix_index(terms)
+        terms = terms[1:] + [{"id": "NCIT:C20197", "label": "Male"}]
+        terms[0] = {"id": terms[0]["id"], "label": "Relabelled"}
+        updated = update_prefix_index(index, terms)
+        self.assertIs(updated, index)
+        self.assertEqual(updated, build_prefix_index(terms))
+        # Many changes rebuild the index
+        self.assertIsNot(update_prefix_index(index, terms[:10]), index)
+
+    async def test_normalize_query(self):
+        """Test query canonicalization."""
+        canonical = "alternateBases=C&assemblyId=GRCh38&includeDatasetResponses=HIT&referenceBases=T&referenceName=MT&start=9"
+        query_strings = [
+            "assemblyId=GRCh38&referenceName=MT&start=9&referenceBases=T&alternateBases=C&includeDatasetResponses=HIT",
+            "includeDatasetResponses=hit&alternateBases=c&referenceBases=t&start=009&referenceName=chrM&assemblyId=GRCh38",
+            "assemblyId=GRCh38&referenceName=chrMT&start=9&end=&referenceBases=T&alternateBases=C&includeDatasetResponses=HIT",
+        ]
+        for query_string in query_strings:
+            self.assertEqual(await normalize_query(query_string), canonical)
+        self.assertEqual(await normalize_query(""), "")
+        self.assertEqual(await normalize_query("datasetIds=a,b&filters=filter"), "datasetIds=a,b&filters=filter")
+        self.assertEqual(await normalize_query("fields=exists&filters=filter"), "filters=filter")
+
+    async def test_normalize_query_invalid(self):
+        """Test rejection of malformed queries."""
+        query_strings = [
+            "assemblyId=GRCh38&referenceName=chr99&start=9",
+            "assemblyId=GRCh38&referenceName=1&start=nine",
+            "assemblyId=GRCh38&referenceName=1&start=9&referenceBases=Z",
+            "assemblyId=GRCh38&referenceName=1&startMin=5",
+            "assemblyId=GRCh38&referenceName=1&start=10&end=5",
+            "assemblyId=GRCh38&start=9",
+            "includeDatasetResponses=SOME",
+            "assemblyId=GRCh38&referenceName=1&start=\u00b2",
+            "assemblyId=GRCh38&referenceName=1&start=9&start=10",
+        ]
+        for query_string in query_strings:
+            with self.assertRaises(web.HTTPBadRequest):
+                await normalize_query(query_string)
+
 
 if __name__ == "__main__":
     asynctest.main()
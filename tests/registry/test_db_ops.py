@@ -5,8 +5,11 @@ from aiohttp import web
 from registry.utils.db_pool import init_db_pool
 from registry.utils.db_ops import db_check_service_id, db_store_service_key, db_update_service_key
 from registry.utils.db_ops import db_delete_service_key, db_register_service, db_delete_api_key
-from registry.utils.db_ops import db_get_service_details, db_delete_services, db_update_service
+from registry.utils.db_ops import db_get_service_details, db_delete_services, db_update_service, db_get_deleted_services
 from registry.utils.db_ops import db_update_sequence, db_verify_service_key, db_verify_api_key, db_verify_admin_key
+from registry.utils.db_ops import db_get_update_job, db_get_events
+
+from registry.utils.statements import STATEMENTS, STATISTICS, prepare_statements, run
 
 from .db_test_classes import Connection, BadConnection
 
@@ -21,6 +24,20 @@ class TestDatabase(asynctest.TestCase):
         db_mock.create_pool = asynctest.CoroutineMock()
         await init_db_pool(host="localhost", port="8080", user="user", passwd="pass", db="db")
         db_mock.create_pool.assert_called()
+        self.assertEqual(db_mock.create_pool.call_args[1]["init"], prepare_statements)
+
+    async def test_prepare_statements(self):
+        """Test registry statements are prepared once per connection, and executions are counted."""
+        connection = Connection(return_value=[{"name": "Beacon"}])
+        connection.statements = {}
+        await prepare_statements(connection)
+        self.assertEqual(set(connection.statements), set(STATEMENTS))
+        connection.prepare = asynctest.CoroutineMock()
+        STATISTICS.clear()
+        self.assertEqual(await run(connection, "check_service_id", "fi.beacon"), [{"name": "Beacon"}])
+        await run(connection, "check_service_id", "fi.beacon")
+        connection.prepare.assert_not_called()
+        self.assertEqual(STATISTICS["check_service_id"][0], 2)
 
 
 class TestDatabaseOperations(asynctest.TestCase):
@@ -145,6 +162,18 @@ class TestDatabaseOperations(asynctest.TestCase):
         # Requested all services, so response is [{}, ...]
         self.assertEqual(len(details), 3)
 
+    @asynctest.mock.patch("registry.utils.db_ops.construct_json")
+    @asynctest.mock.patch("registry.utils.db_ops.run")
+    async def test_db_get_service_details_filters(self, mock_run, mock_cons):
+        """Test the retrieval of service details: each combination of filters has a statement of its own."""
+        mock_run.return_value = [{}]
+        await db_get_service_details(Connection(), service_type="beacon", api_version="1.0.0")
+        mock_run.assert_called_with(asynctest.mock.ANY, "get_service_details_by_type_and_api_version", "beacon", "1.0.0")
+        self.assertIn("WHERE type=$1 AND api_version=$2", STATEMENTS["get_service_details_by_type_and_api_version"])
+        await db_get_service_details(Connection())
+        mock_run.assert_called_with(asynctest.mock.ANY, "get_service_details")
+        self.assertNotIn("WHERE", STATEMENTS["get_service_details"])
+
     async def test_db_get_service_details_none(self):
         """Test the retrieval of service details: none found."""
         connection = Connection()
@@ -171,6 +200,55 @@ class TestDatabaseOperations(asynctest.TestCase):
         with self.assertRaises(web.HTTPInternalServerError):
             await db_delete_services(connection, "fi.beacon")
 
+    async def test_db_get_deleted_services(self):
+        """Test the retrieval of deleted services."""
+        connection = Connection(return_value=[{"id": "fi.beacon", "type": "beacon", "api_version": "1.0.0", "deleted_at": "2020-01-01 12:00:00+00:00"}])
+        deleted = await db_get_deleted_services(connection)
+        self.assertEqual(deleted[0]["id"], "fi.beacon")
+        self.assertEqual(deleted[0]["type"]["artifact"], "beacon")
+        self.assertEqual(deleted[0]["deletedAt"], "2020-01-01 12:00:00+00:00")
+
+    async def test_db_get_deleted_services_fail(self):
+        """Test the retrieval of deleted services: database error."""
+        connection = BadConnection()
+        with self.assertRaises(web.HTTPInternalServerError):
+            await db_get_deleted_services(connection)
+
+    async def test_db_get_events(self):
+        """Test the retrieval of catalogue events: services that no longer exist have no details."""
+        connection = Connection(
+            return_value=[
+                {"sequence": 4, "action": "registered", "service_id": "fi.beacon", "id": "fi.beacon", "type": "beacon", "api_version": "1.0.0"},
+                {"sequence": 6, "action": "updated", "service_id": "fi.old", "id": None},
+                {"sequence": 7, "action": "deleted", "service_id": "fi.old", "id": None},
+            ]
+        )
+        events = await db_get_events(connection, 3, 500)
+        self.assertEqual([event["sequence"] for event in events], [4, 6, 7])
+        self.assertEqual(events[0]["service"]["type"]["artifact"], "beacon")
+        self.assertIsNone(events[1]["service"])
+        self.assertEqual((events[2]["action"], events[2]["id"]), ("deleted", "fi.old"))
+
+    async def test_db_get_update_job(self):
+        """Test the retrieval of update job progress."""
+        record = {
+            "id": "abc",
+            "status": "running",
+            "total": 3,
+            "succeeded": 1,
+            "changed": 1,
+            "failed": ["fi.beacon"],
+            "started_at": "2020-01-01 12:00:00+00:00",
+            "finished_at": None,
+            "duration": 1.5,
+        }
+        job = await db_get_update_job(Connection(return_value=[record]), "abc")
+        self.assertEqual(job["jobId"], "abc")
+        self.assertEqual(job["failed"], ["fi.beacon"])
+        self.assertIsNone(job["finishedAt"])
+        with self.assertRaises(web.HTTPNotFound):
+            await db_get_update_job(Connection(return_value=[]), "abc")
+
     async def test_db_update_service_success(self):
         """Test the updating of a service: successful update."""
         connection = Connection()
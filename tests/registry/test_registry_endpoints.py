@@ -1,7 +1,9 @@
+import asyncio
+import hashlib
 import asynctest
 import aiohttp
 
-from registry.endpoints.update import update_service_infos, update_sequence
+from registry.endpoints.update import update_service_infos, update_sequence, start_update_job, RUNNING
 from registry.endpoints.services import register_service, update_service
 from registry.endpoints.services import get_services, delete_services
 
@@ -144,41 +146,107 @@ class TestUtils(asynctest.TestCase):
             "at your Aggregator in case of catalogue changes.",
         )
 
+    @asynctest.mock.patch("registry.endpoints.update.db_save_update_job")
     @asynctest.mock.patch("registry.endpoints.update.update_sequence")
-    @asynctest.mock.patch("registry.endpoints.update.db_get_service_details")
-    async def test_update_service_infos(self, m_db, m_update):
+    @asynctest.mock.patch("registry.endpoints.update.db_get_service_info_states")
+    async def test_update_service_infos(self, m_db, m_update, m_save):
         """Test updating of service infos."""
-        m_db.return_value = ["https://aggregator.csc.fi/service-info"]
-        m_update.return_value = None
+        m_db.return_value = [
+            {"id": "fi.csc.aggregator", "url": "https://aggregator.csc.fi/service-info"},
+            {"id": "fi.csc.beacon", "url": "https://beacon.fi"},
+            {"id": "fi.csc.beacon2", "url": "https://beacon2.fi"},
+        ]
+        m_update.side_effect = [True, False, aiohttp.web.HTTPInternalServerError()]
         m_pool = asynctest.CoroutineMock()
         m_pool.acquire().__aenter__.return_value = True
-        fails, total = await update_service_infos({}, m_pool)
-        self.assertEqual(0, fails)
-        self.assertEqual(1, total)
+        job = {"id": "1", "total": 0, "succeeded": 0, "changed": 0, "failed": [], "saved": 0}
+        fails, total = await update_service_infos(m_pool, job)
+        self.assertEqual(1, fails)
+        self.assertEqual(3, total)
+        self.assertEqual(job["succeeded"], 2)
+        self.assertEqual(job["changed"], 1)
+        self.assertEqual(job["failed"], ["fi.csc.beacon2"])
+        # Progress is saved when the total is known, and at most once a second after that
+        self.assertEqual(m_save.call_count, 2)
 
-    @asynctest.mock.patch("registry.endpoints.update.db_update_service")
+    @asynctest.mock.patch("registry.endpoints.update.wake_dispatcher")
+    @asynctest.mock.patch("registry.endpoints.update.refresh_catalogue")
+    @asynctest.mock.patch("registry.endpoints.update.db_save_update_job")
+    @asynctest.mock.patch("registry.endpoints.update.db_create_update_job")
+    @asynctest.mock.patch("registry.endpoints.update.update_service_infos")
+    async def test_start_update_job(self, m_update, m_create, m_save, m_refresh, m_invalidate):
+        """Test update job: returns immediately, and a running job is not started again."""
+        finish = asyncio.Event()
+
+        async def update(db_pool, job):
+            await finish.wait()
+            job["changed"] = 1
+            return 0, 1
+
+        m_update.side_effect = update
+        m_pool = asynctest.CoroutineMock()
+        m_pool.acquire().__aenter__.return_value = True
+        job_id = await start_update_job(m_pool)
+        self.assertEqual(job_id, await start_update_job(m_pool))
+        m_create.assert_called_once()
+        finish.set()
+        await RUNNING["task"]
+        self.assertEqual(m_save.call_args[1]["status"], "finished")
+        m_refresh.assert_called_once()
+        m_invalidate.assert_called_once()
+        # Aggregators are not notified if nothing changed
+        m_update.side_effect = None
+        m_update.return_value = 0, 1
+        self.assertNotEqual(job_id, await start_update_job(m_pool))
+        await RUNNING["task"]
+        m_invalidate.assert_called_once()
+
+    @asynctest.mock.patch("registry.endpoints.update.db_refresh_service")
+    @asynctest.mock.patch("registry.endpoints.update.parse_service_info")
+    @asynctest.mock.patch("registry.endpoints.update.http_request_info_changes")
+    async def test_update_service_info_not_modified(self, m_http, m_parse, m_db):
+        """Test updating of service info: service info is unchanged."""
+        content = b'{"id": "fi.csc.aggregator"}'
+        service = {"id": "fi.csc.aggregator", "url": "https://aggregator.csc.fi", "info_hash": hashlib.sha256(content).hexdigest(), "info_etag": '"1"'}
+        m_pool = asynctest.CoroutineMock()
+        m_http.return_value = None, '"1"'
+        self.assertFalse(await update_sequence(service, m_pool, None))
+        m_http.return_value = content, '"1"'
+        self.assertFalse(await update_sequence(service, m_pool, None))
+        m_parse.assert_not_called()
+        m_db.assert_not_called()
+
+    @asynctest.mock.patch("registry.endpoints.update.db_refresh_service")
     @asynctest.mock.patch("registry.endpoints.update.parse_service_info")
-    @asynctest.mock.patch("registry.endpoints.update.http_request_info")
+    @asynctest.mock.patch("registry.endpoints.update.http_request_info_changes")
     async def test_update_service_info_success(self, m_http, m_parse, m_db):
         """Test updating of service info: successful update."""
-        service = {"id": "fi.csc.aggregator", "url": "https://aggregator.csc.fi"}
-        m_http.return_value = service
+        service = {"id": "fi.csc.aggregator", "url": "https://aggregator.csc.fi", "info_hash": None, "info_etag": None}
+        m_http.return_value = b'{"id": "fi.csc.aggregator"}', None
         m_parse.return_value = service
         m_db.return_value = True
         m_pool = asynctest.CoroutineMock()
         m_pool.acquire().__aenter__.return_value = True
-        await update_sequence(service, m_pool)
+        self.assertTrue(await update_sequence(service, m_pool, None))
+        self.assertEqual(m_db.call_args[0][3], hashlib.sha256(b'{"id": "fi.csc.aggregator"}').hexdigest())
 
-    @asynctest.mock.patch("registry.endpoints.services.db_get_service_details")
+    @asynctest.mock.patch("registry.endpoints.services.get_catalogue")
     @asynctest.mock.patch("registry.endpoints.services.query_params")
-    async def test_get_services(self, m_params, m_db):
+    async def test_get_services(self, m_params, m_catalogue):
         """Test retrieval of services."""
         m_params.return_value = "fi.csc.aggregator", {}
-        m_db.return_value = {"id": "fi.csc.aggregator"}
+        m_catalogue.return_value = b'{"id":"fi.csc.aggregator"}'
         m_pool = asynctest.CoroutineMock()
-        m_pool.acquire().__aenter__.return_value = True
         response = await get_services({}, m_pool)
-        self.assertEqual(response, {"id": "fi.csc.aggregator"})
+        self.assertEqual(response, b'{"id":"fi.csc.aggregator"}')
+        m_catalogue.assert_called_with(m_pool, service_id="fi.csc.aggregator", service_type=None, api_version=None, updated_since=None)
+
+    @asynctest.mock.patch("registry.endpoints.services.query_params")
+    async def test_get_services_bad_updated_since(self, m_params):
+        """Test retrieval of services: invalid updatedSince parameter."""
+        m_params.return_value = None, {"updatedSince": "yesterday"}
+        with self.assertRaises(aiohttp.web.HTTPBadRequest):
+            await get_services({}, asynctest.CoroutineMock())
 
     @asynctest.mock.patch("registry.endpoints.services.db_delete_services")
     @asynctest.mock.patch("registry.endpoints.services.db_check_service_id")
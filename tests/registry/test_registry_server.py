@@ -15,11 +15,17 @@ async def create_db_mock(app):
     return app
 
 
+async def start_listener_mock(app):
+    """Mock listening to database notifications."""
+    app["listener"] = asynctest.mock.Mock()
+
+
 class TestRegistryEndpoints(AioHTTPTestCase):
     """Test registry endpoints."""
 
+    @asynctest.mock.patch("registry.registry.start_listener", side_effect=start_listener_mock)
     @asynctest.mock.patch("registry.registry.init_db", side_effect=create_db_mock)
-    async def get_application(self, mock_db):
+    async def get_application(self, mock_db, mock_listener):
         """Retrieve web application for test."""
         return await init_app()
 
@@ -77,26 +83,89 @@ class TestRegistryEndpoints(AioHTTPTestCase):
     #     # assert 'Service has been registered.' == data['message']
     #     # assert 'fi.beacon' == data['serviceId']
 
+    @asynctest.mock.patch("registry.registry.ensure_catalogue")
     @asynctest.mock.patch("registry.registry.get_services")
     @unittest_run_loop
-    async def test_get_services(self, mock_get):
+    async def test_get_services(self, mock_get, mock_ensure):
         """Test services endpoint: get list of services."""
-        mock_get.return_value = {"id": "fi.beacon"}
+        mock_get.return_value = b'{"id": "fi.beacon"}'
         resp = await self.client.request("GET", "/services")
         data = await resp.json()
         assert 200 == resp.status
         assert "fi.beacon" == data["id"]
 
+    @asynctest.mock.patch("registry.registry.ensure_catalogue")
+    @asynctest.mock.patch("registry.registry.get_services")
+    @unittest_run_loop
+    async def test_get_services_not_modified(self, mock_get, mock_ensure):
+        """Test services endpoint: catalogue version known by client, the response is not built."""
+        mock_get.return_value = b'[{"id": "fi.beacon"}]'
+        with asynctest.mock.patch.dict("registry.utils.catalogue.CATALOGUE", {"etag": '"v1"', "sequence": 7}):
+            resp = await self.client.request("GET", "/services", headers={"If-None-Match": '"v1"'})
+            assert 304 == resp.status
+            assert '"v1"' == resp.headers["ETag"]
+            mock_ensure.assert_called_once()
+            mock_get.assert_not_called()
+            resp = await self.client.request("GET", "/services", headers={"If-None-Match": '"v0"'})
+            assert 200 == resp.status
+            assert '"v1"' == resp.headers["ETag"]
+            assert "7" == resp.headers["Catalogue-Sequence"]
+
+    @asynctest.mock.patch("registry.utils.validate.verify_key")
+    @asynctest.mock.patch("registry.registry.start_update_job")
+    @unittest_run_loop
+    async def test_update_services(self, mock_start, mock_verify):
+        """Test update endpoint: the location of the progress of the update job is returned."""
+        mock_start.return_value = "abc"
+        resp = await self.client.request("GET", "/update/services", headers={"Authorization": "secret"})
+        assert 202 == resp.status
+        assert "/update/services/abc" == resp.headers["Location"]
+        assert {"jobId": "abc", "location": "/update/services/abc"} == await resp.json()
+        mock_verify.assert_called_once()
+        # Paths only starting like the endpoint don't require an admin key
+        resp = await self.client.request("GET", "/update/servicesX")
+        assert 404 == resp.status
+        mock_verify.assert_called_once()
+
+    @asynctest.mock.patch("registry.registry.ensure_catalogue")
     @asynctest.mock.patch("registry.registry.get_services")
     @unittest_run_loop
-    async def test_get_service_id(self, mock_get):
+    async def test_get_service_id(self, mock_get, mock_ensure):
         """Test services endpoint: get service by id."""
-        mock_get.return_value = {"id": "fi.beacon"}
+        mock_get.return_value = b'{"id": "fi.beacon"}'
         resp = await self.client.request("GET", "/services/fi.beacon")
         data = await resp.json()
         assert 200 == resp.status
         assert "fi.beacon" == data["id"]
 
+    @asynctest.mock.patch("registry.endpoints.changes.db_get_events")
+    @asynctest.mock.patch("registry.endpoints.changes.db_get_event_range")
+    @unittest_run_loop
+    async def test_get_changes(self, mock_range, mock_events):
+        """Test changes endpoint: changes are streamed after the sequence number, which must still be available."""
+        self.app["pool"].acquire = asynctest.MagicMock()
+        mock_range.return_value = (3, 8)
+        mock_events.side_effect = [
+            [
+                {"sequence": 6, "action": "updated", "id": "fi.beacon", "service": {"id": "fi.beacon"}},
+                {"sequence": 7, "action": "updated", "id": "fi.old", "service": None},
+                {"sequence": 8, "action": "deleted", "id": "fi.old", "service": None},
+            ],
+            [],
+        ]
+        resp = await self.client.request("GET", "/changes")
+        assert 400 == resp.status
+        resp = await self.client.request("GET", "/changes?since=1")
+        assert 410 == resp.status
+        resp = await self.client.request("GET", "/changes?since=1", headers={"Last-Event-ID": "5"})
+        assert 200 == resp.status
+        assert "text/event-stream" == resp.headers["Content-Type"]
+        lines = [(await resp.content.readline()).decode("utf-8") for _ in range(8)]
+        assert ["event: updated\n", "id: 6\n", 'data: {"id":"fi.beacon"}\n', "\n"] == lines[:4]
+        assert ["event: deleted\n", "id: 8\n", 'data: {"id":"fi.old"}\n', "\n"] == lines[4:]
+        assert 5 == mock_events.call_args_list[0][0][1]
+        resp.close()
+
 
 class TestRegistryStartUp(asynctest.TestCase):
     """Test registry start up functions."""
@@ -1,12 +1,25 @@
+import asyncio
+import hashlib
+import os
+
 import asynctest
+import ujson
 
 from aioresponses import aioresponses
 import aiohttp
 
-from registry.utils.utils import http_request_info, parse_service_info, construct_json
-from registry.utils.utils import query_params, db_get_service_urls, db_get_recaching_credentials
+from registry.utils.utils import http_request_info, http_request_info_changes, parse_service_info, construct_json
+from registry.utils.utils import query_params, db_get_service_urls
 from registry.utils.utils import generate_service_key, generate_service_id, validate_service_info
-from registry.utils.utils import invalidate_aggregator_caches, invalidate_cache
+from registry.utils.utils import invalidate_cache
+from registry.utils.outbox import dispatch, retry_after
+
+from registry.utils.catalogue import CATALOGUE, build_catalogue, get_catalogue, etag_matches, parse_timestamp
+from registry.utils.catalogue import catch_up_catalogue
+from registry.utils.key_cache import KeyCache
+from registry.utils.migrations import MIGRATIONS_DIR, load_migrations, migrate
+from registry.utils.notifications import handle_notification
+from registry.utils.validate import verify_key
 
 from .db_test_classes import Connection
 
@@ -38,6 +51,17 @@ class TestUtils(asynctest.TestCase):
         with self.assertRaises(aiohttp.web_exceptions.HTTPInternalServerError):
             await http_request_info("https://beacon.fi/service-info")
 
+    @aioresponses()
+    async def test_http_request_info_changes(self, m):
+        """Test conditional request of service info."""
+        m.get("https://beacon.fi/service-info", status=200, body=b'{"name": "Best Beacon"}', headers={"ETag": '"1"'})
+        m.get("https://beacon.fi/service-info", status=304)
+        async with aiohttp.ClientSession() as session:
+            self.assertEqual(await http_request_info_changes("https://beacon.fi/service-info", session), (b'{"name": "Best Beacon"}', '"1"'))
+            self.assertEqual(await http_request_info_changes("https://beacon.fi/service-info", session, '"1"'), (None, '"1"'))
+        request = list(m.requests.values())[0][1]
+        self.assertEqual(request.kwargs["headers"], {"If-None-Match": '"1"'})
+
     async def test_parse_service_info_ga4gh(self):
         """Test parsing of service info in GA4GH format."""
         service_id = "fi.beacon"
@@ -140,14 +164,14 @@ class TestUtils(asynctest.TestCase):
         request = MockRequest(service_type="beacon", api_version="1.0.0", service_id="fi.beacon")
         service_id, params = await query_params(request)
         self.assertEqual(service_id, "fi.beacon")
-        self.assertEqual(params, {"type": "beacon", "apiVersion": "1.0.0"})
+        self.assertEqual(params, {"type": "beacon", "apiVersion": "1.0.0", "updatedSince": None})
 
     async def test_query_params_none(self):
         """Test parsing of path query params."""
         request = MockRequest()
         service_id, params = await query_params(request)
         self.assertEqual(service_id, None)
-        self.assertEqual(params, {"type": None, "apiVersion": None})
+        self.assertEqual(params, {"type": None, "apiVersion": None, "updatedSince": None})
 
     async def test_get_service_urls_found(self):
         """Test retrieval of service urls: urls found."""
@@ -161,18 +185,6 @@ class TestUtils(asynctest.TestCase):
         service_urls = await db_get_service_urls(connection, service_type="beacon")
         self.assertEqual(len(service_urls), 0)
 
-    async def test_get_recaching_credentials_found(self):
-        """Test retrieval of recaching credentials: creds found."""
-        connection = Connection(return_value=[{"url": "https://beacon1.fi", "service_key": "abc123"}, {"url": "https://beacon1.fi", "service_key": "abc123"}])
-        credentials = await db_get_recaching_credentials(connection)
-        self.assertEqual(len(credentials), 2)
-
-    async def test_get_recaching_credentials_none(self):
-        """Test retrieval of recaching credentials: none found."""
-        connection = Connection(return_value=[])
-        credentials = await db_get_recaching_credentials(connection)
-        self.assertEqual(len(credentials), 0)
-
     async def test_generate_service_key(self):
         """Test generation of service key."""
         key = await generate_service_key()
@@ -221,15 +233,24 @@ class TestUtils(asynctest.TestCase):
         await validate_service_info(service, "fi.beacon")
         # Passed validation
 
-    @asynctest.mock.patch("registry.utils.utils.db_get_recaching_credentials")
-    @asynctest.mock.patch("registry.utils.utils.invalidate_cache")
-    async def test_invalidate_aggregator_caches(self, m_invalidate, m_db):
-        """Test invalidation of aggregator caches."""
-        m_db.return_value = ["https://aggregator.csc.fi/service-info"]
-        m_invalidate.return_value = True
+    @asynctest.mock.patch("registry.utils.outbox.db_fail_delivery")
+    @asynctest.mock.patch("registry.utils.outbox.db_complete_delivery")
+    @asynctest.mock.patch("registry.utils.outbox.db_claim_deliveries")
+    @asynctest.mock.patch("registry.utils.outbox.invalidate_cache")
+    async def test_dispatch(self, m_invalidate, m_claim, m_complete, m_fail):
+        """Test delivery of catalogue changes: outcomes are recorded per aggregator."""
+        m_claim.return_value = 7, [
+            {"aggregator_id": "fi.aggregator", "attempts": 0, "service_url": "https://aggregator.fi/service-info", "service_key": "a"},
+            {"aggregator_id": "fi.down", "attempts": 2, "service_url": "https://down.fi/service-info", "service_key": "b"},
+        ]
+        m_invalidate.side_effect = [None, "Service responded with 500."]
         m_pool = asynctest.CoroutineMock()
         m_pool.acquire().__aenter__.return_value = True
-        await invalidate_aggregator_caches({}, m_pool)
+        self.assertEqual(await dispatch(m_pool, None), 2)
+        m_complete.assert_called_once_with(True, "fi.aggregator", 7)
+        m_fail.assert_called_once_with(True, "fi.down", retry_after(2), "Service responded with 500.")
+        self.assertEqual(retry_after(2), 20)
+        self.assertEqual(retry_after(20), 3600)
 
     @aioresponses()
     @asynctest.mock.patch("registry.utils.utils.LOG")
@@ -237,8 +258,9 @@ class TestUtils(asynctest.TestCase):
         """Test invalidation of cache: successful invalidation."""
         service = {"service_url": "https://aggregator.csc.fi/service-info", "service_key": "secret"}
         m_resp.delete("https://aggregator.csc.fi/cache", status=200)
-        await invalidate_cache(service)
-        m_log.debug.assert_called_with("Service received notification and responded with 200.")
+        async with aiohttp.ClientSession() as session:
+            self.assertIsNone(await invalidate_cache(service, session))
+        m_log.debug.assert_called_with("Service received notification and responded with %s.", 200)
 
     @aioresponses()
     @asynctest.mock.patch("registry.utils.utils.LOG")
@@ -246,8 +268,9 @@ class TestUtils(asynctest.TestCase):
         """Test invalidation of cache: failed request."""
         service = {"service_url": "https://aggregator.csc.fi/service-info", "service_key": "wrongkey"}
         m_resp.delete("https://aggregator.csc.fi/cache", status=400)
-        await invalidate_cache(service)
-        m_log.debug.assert_called_with("Service encountered a problem with notification: 400.")
+        async with aiohttp.ClientSession() as session:
+            self.assertEqual(await invalidate_cache(service, session), "Service responded with 400.")
+        m_log.debug.assert_called_with("Service encountered a problem with notification: %s.", 400)
 
     @aioresponses()
     @asynctest.mock.patch("registry.utils.utils.LOG")
@@ -255,10 +278,189 @@ class TestUtils(asynctest.TestCase):
         """Test invalidation of cache: errored request."""
         service = {"service_url": "https://aggregator.csc.fi/service-info"}
         m_resp.delete("https://aggregator.csc.fi/cache", status=200)
-        # Exception is raised and then passed, check log message
-        await invalidate_cache(service)
+        # Exception is raised and then returned, check log message
+        async with aiohttp.ClientSession() as session:
+            self.assertEqual(await invalidate_cache(service, session), "Query error 'service_key'.")
         # Could be any kind of error that fails the request, e.g. bad url, but let's test for auth key not found in param dict
-        m_log.debug.assert_called_with("Query error 'service_key'.")
+        message, *args = m_log.debug.call_args[0]
+        self.assertEqual(message % tuple(args), "Query error 'service_key'.")
+
+    @asynctest.mock.patch("registry.utils.catalogue.db_get_latest_event")
+    @asynctest.mock.patch("registry.utils.catalogue.db_get_deleted_services")
+    async def test_catalogue_snapshot(self, m_deleted, m_latest):
+        """Test catalogue snapshot: services are served by filters and ID from memory."""
+        m_deleted.return_value = []
+        m_latest.return_value = 42
+        records = [
+            {"id": "fi.beacon", "type": "beacon", "api_version": "1.0.0", "url": "https://beacon.fi/"},
+            {"id": "fi.aggregator", "type": "beacon-aggregator", "api_version": "1.0.0", "url": "https://aggregator.fi/"},
+        ]
+        m_pool = asynctest.CoroutineMock()
+        m_pool.acquire().__aenter__.return_value = Connection(return_value=records)
+        await build_catalogue(m_pool)
+        self.assertEqual(CATALOGUE["sequence"], 42)
+        self.assertEqual(len(ujson.loads(await get_catalogue(m_pool))), 2)
+        self.assertEqual(len(ujson.loads(await get_catalogue(m_pool, api_version="1.0.0"))), 2)
+        services = ujson.loads(await get_catalogue(m_pool, service_type="beacon", api_version="1.0.0"))
+        self.assertEqual([service["id"] for service in services], ["fi.beacon"])
+        self.assertEqual(ujson.loads(await get_catalogue(m_pool, service_id="fi.aggregator"))["url"], "https://aggregator.fi/")
+        with self.assertRaises(aiohttp.web.HTTPNotFound):
+            await get_catalogue(m_pool, service_type="beacon", api_version="2.0.0")
+
+    @asynctest.mock.patch("registry.utils.catalogue.db_get_latest_event", return_value=0)
+    @asynctest.mock.patch("registry.utils.catalogue.db_get_deleted_services", return_value=[])
+    @asynctest.mock.patch("registry.utils.catalogue.db_get_service_details")
+    async def test_catalogue_overlapping_builds(self, m_services, m_deleted, m_latest):
+        """Test catalogue snapshot: a build that started earlier but finishes last does not replace the catalogue."""
+        beacon = {"id": "fi.beacon", "type": {"artifact": "beacon", "version": "1.0.0"}, "updatedAt": "2020-01-01T12:00:00Z"}
+        aggregator = {"id": "fi.aggregator", "type": {"artifact": "beacon-aggregator", "version": "1.0.0"}, "updatedAt": "2020-02-01T12:00:00Z"}
+        # The first build reads the services before the aggregator is registered
+        reads = [(asyncio.Event(), [beacon]), (asyncio.Event(), [beacon, aggregator])]
+
+        async def read_services(connection):
+            read, services = reads[m_services.call_count - 1]
+            await read.wait()
+            return services
+
+        m_services.side_effect = read_services
+        m_pool = asynctest.CoroutineMock()
+        m_pool.acquire().__aenter__.return_value = Connection()
+        older = asyncio.ensure_future(build_catalogue(m_pool))
+        newer = asyncio.ensure_future(build_catalogue(m_pool))
+        await asyncio.sleep(0)
+        reads[1][0].set()
+        await newer
+        reads[0][0].set()
+        await older
+        self.assertEqual(len(ujson.loads(CATALOGUE["filters"][(None, None)])), 2)
+
+    @asynctest.mock.patch("registry.utils.catalogue.db_get_latest_event")
+    @asynctest.mock.patch("registry.utils.catalogue.db_get_deleted_services")
+    async def test_catalogue_changes(self, m_deleted, m_latest):
+        """Test catalogue changes: only services updated and deleted after the given time are returned."""
+        records = [
+            {"id": "fi.beacon", "type": "beacon", "api_version": "1.0.0", "updated_at": "2020-01-01 12:00:00+00:00"},
+            {"id": "fi.aggregator", "type": "beacon-aggregator", "api_version": "1.0.0", "updated_at": "2020-03-01 12:00:00+00:00"},
+        ]
+        deleted = {"id": "fi.old", "type": {"group": "org.ga4gh", "artifact": "beacon", "version": "1.0.0"}, "deletedAt": "2020-02-01 12:00:00+00:00"}
+        m_deleted.return_value = [deleted]
+        m_pool = asynctest.CoroutineMock()
+        m_pool.acquire().__aenter__.return_value = Connection(return_value=records)
+        await build_catalogue(m_pool)
+        changes = ujson.loads(await get_catalogue(m_pool, updated_since=parse_timestamp("2020-01-15T00:00:00Z")))
+        self.assertEqual([service["id"] for service in changes["services"]], ["fi.aggregator"])
+        self.assertEqual([service["id"] for service in changes["deleted"]], ["fi.old"])
+        changes = ujson.loads(await get_catalogue(m_pool, service_type="beacon", updated_since=parse_timestamp("2020-01-15")))
+        self.assertEqual(changes, {"services": [], "deleted": [deleted]})
+        # The version changes when services are deleted
+        etag = CATALOGUE["etag"]
+        m_deleted.return_value = [deleted, {**deleted, "id": "fi.older", "deletedAt": "2020-04-01 12:00:00+00:00"}]
+        await build_catalogue(m_pool)
+        self.assertNotEqual(CATALOGUE["etag"], etag)
+
+    async def test_etag_matches(self):
+        """Test matching of If-None-Match header values."""
+        self.assertTrue(etag_matches('"a", "b"', '"b"'))
+        self.assertTrue(etag_matches('W/"b"', '"b"'))
+        self.assertTrue(etag_matches("*", '"b"'))
+        self.assertFalse(etag_matches('"a"', '"b"'))
+        self.assertFalse(etag_matches(None, '"b"'))
+        self.assertIsNone(parse_timestamp("yesterday"))
+
+    async def test_key_cache(self):
+        """Test verified key cache: keys are scoped, hashed and forgotten when deleted."""
+        cache = KeyCache(ttl=30)
+        cache.add("service", "secret", scope="fi.beacon")
+        self.assertTrue(cache.verified("service", "secret", scope="fi.beacon"))
+        self.assertFalse(cache.verified("service", "secret", scope="fi.other"))
+        self.assertFalse(cache.verified("api", "secret"))
+        self.assertNotIn("secret", str(cache.entries))
+        cache.discard_scope("service", "fi.beacon")
+        self.assertFalse(cache.verified("service", "secret", scope="fi.beacon"))
+        cache.add("api", "secret")
+        cache.discard("api", "secret")
+        self.assertFalse(cache.verified("api", "secret"))
+        disabled = KeyCache(ttl=0)
+        disabled.add("api", "secret")
+        self.assertFalse(disabled.verified("api", "secret"))
+
+    @asynctest.mock.patch("registry.utils.validate.KEY_CACHE", KeyCache(ttl=30))
+    async def test_verify_key_cached(self):
+        """Test key verification: recently verified keys are not verified from database, OTPs always are."""
+        request = asynctest.MagicMock()
+        request.app = {"pool": asynctest.MagicMock()}
+        verify = asynctest.CoroutineMock()
+        await verify_key(request, "admin", "secret", verify)
+        await verify_key(request, "admin", "secret", verify)
+        verify.assert_called_once()
+        # API keys are OTPs in the test configuration
+        verify.reset_mock()
+        await verify_key(request, "api", "secret", verify)
+        await verify_key(request, "api", "secret", verify)
+        self.assertEqual(verify.call_count, 2)
+        # Failed verifications are not remembered
+        verify.side_effect = aiohttp.web.HTTPUnauthorized()
+        with self.assertRaises(aiohttp.web.HTTPUnauthorized):
+            await verify_key(request, "service", "secret", verify, scope="fi.beacon")
+        with self.assertRaises(aiohttp.web.HTTPUnauthorized):
+            await verify_key(request, "service", "secret", verify, scope="fi.beacon")
+
+    @asynctest.mock.patch("registry.utils.notifications.KEY_CACHE", KeyCache(ttl=30))
+    @asynctest.mock.patch("registry.utils.notifications.catch_up")
+    @asynctest.mock.patch("registry.utils.notifications.wake_dispatcher")
+    @asynctest.mock.patch("registry.utils.notifications.notify_subscribers")
+    async def test_handle_notification(self, m_notify, m_wake, m_catch_up):
+        """Test database notifications: changes of other workers are applied to the caches of this worker."""
+        from registry.utils.notifications import KEY_CACHE
+
+        handle_notification("pool", "catalogue 42")
+        m_notify.assert_called_once()
+        m_wake.assert_called_once()
+        m_catch_up.assert_called_once_with("pool", 42)
+        KEY_CACHE.add("api", "secret")
+        KEY_CACHE.add("service", "secret", scope="fi.beacon")
+        handle_notification("pool", "api " + hashlib.sha256(b"secret").hexdigest())
+        self.assertFalse(KEY_CACHE.verified("api", "secret"))
+        handle_notification("pool", "service fi.beacon")
+        self.assertFalse(KEY_CACHE.verified("service", "secret", scope="fi.beacon"))
+
+    @asynctest.mock.patch("registry.utils.catalogue.build_catalogue")
+    async def test_catch_up_catalogue(self, m_build):
+        """Test catalogue catch up: the catalogue is only rebuilt if it does not include the change."""
+
+        async def build(db_pool):
+            CATALOGUE["sequence"] = 43
+
+        m_build.side_effect = build
+        CATALOGUE["sequence"], CATALOGUE["task"] = 42, None
+        await catch_up_catalogue("pool", 42)
+        m_build.assert_not_called()
+        await catch_up_catalogue("pool", 43)
+        m_build.assert_called_once_with("pool")
+
+    async def test_load_migrations(self):
+        """Test migrations: scripts are loaded in order, and init.sql records each of them as applied."""
+        migrations = load_migrations()
+        versions = [version for version, _, _ in migrations]
+        self.assertEqual(versions, list(range(1, len(migrations) + 1)))
+        with open(os.path.join(MIGRATIONS_DIR, "..", "docker-entrypoint-initdb.d", "init.sql"), "r") as init:
+            script = init.read()
+        for version, name, _ in migrations:
+            self.assertIn(f"({version}, '{name}', NOW())", script)
+
+    async def test_migrate(self):
+        """Test migrations: only migrations that have not been applied are applied, and their versions recorded."""
+        connection = asynctest.MagicMock()
+        connection.execute = asynctest.CoroutineMock()
+        connection.fetch = asynctest.CoroutineMock(return_value=[{"version": 1}])
+        applied = await migrate(connection, [(1, "first", "SELECT 1"), (2, "second", "SELECT 2")])
+        self.assertEqual(applied, [2])
+        scripts = [call.args[0] for call in connection.execute.call_args_list]
+        self.assertNotIn("SELECT 1", scripts)
+        self.assertIn("SELECT 2", scripts)
+        connection.execute.assert_any_call("INSERT INTO schema_migrations (version, name, applied_at) VALUES ($1, $2, NOW())", 2, "second")
+        # The lock is released last
+        self.assertIn("pg_advisory_unlock", scripts[-1])
 
 
 if __name__ == "__main__":